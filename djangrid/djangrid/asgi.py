@@ -3,6 +3,10 @@ ASGI config for pwemail project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+The Django application is wrapped to answer lifespan events, and to run the
+newsletter campaign queue on the server's event loop when
+NEWSLETTER_ASGI_DELIVERY is enabled.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/4.0/howto/deployment/asgi/
 """
@@ -13,4 +17,8 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'djangrid.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from djangridApp.delivery.aio import DeliveryLifespan  # noqa: E402
+
+application = DeliveryLifespan(django_application)
@@ -195,12 +195,22 @@ NEWSLETTER_THUMBNAIL = 'sorl-thumbnail'
 # NEWSLETTER_THUMBNAIL = 'easy-thumbnails'
 NEWSLETTER_RICHTEXT_WIDGET = "tinymce.widgets.TinyMCE"
 SITE_ID = 1
-# Amount of seconds to wait between each email. Here 100ms is used.
-NEWSLETTER_EMAIL_DELAY = 0.1618
-# Amount of seconds to wait between each batch. Here one minute is used.
-NEWSLETTER_BATCH_DELAY = 61.8
-# Number of emails in one batch
-NEWSLETTER_BATCH_SIZE = 62
+# Maximum number of emails sent per second, across all sender threads.
+NEWSLETTER_SEND_RATE = 6
+# Number of emails that may go out at once after the sender has been idle
+NEWSLETTER_SEND_BURST = 62
+# Number of sender threads, each with its own mail connection
+NEWSLETTER_SEND_WORKERS = 4
+# Number of emails handed to the mail backend at once over one connection
+NEWSLETTER_SEND_BATCH_SIZE = 100
+# 'backend' sends one email per profile through EMAIL_BACKEND,
+# 'personalizations' sends up to 1000 profiles per SendGrid API request
+NEWSLETTER_DELIVERY_MODE = 'backend'
+# CSV exports hold personal data; keep them out of the served media
+NEWSLETTER_EXPORT_STORAGE = 'django.core.files.storage.FileSystemStorage'
+NEWSLETTER_EXPORT_STORAGE_OPTIONS = {
+    'location': os.path.join(BASE_DIR, 'private', 'exports'),
+}
 
 DEFAULT_AUTO_FIELD = "django.db.models.AutoField"
 
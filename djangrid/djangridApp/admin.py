@@ -1,13 +1,18 @@
+import json
+from django.apps import apps
 from django.contrib import admin, messages
-from .models import Newsletter, Profile, Segment, Campaign, Attachment
+from .models import Newsletter, Profile, Segment, Campaign, Attachment, Task
 
 import logging
 from django.urls import path
 logger = logging.getLogger(__name__)
 from django.conf import settings
 from django.core import serializers
+from django.core.serializers.json import DjangoJSONEncoder
 from django.core.exceptions import PermissionDenied
-from django.http import HttpResponse, HttpResponseRedirect, Http404
+from django.http import (
+    FileResponse, HttpResponse, HttpResponseRedirect, Http404, JsonResponse
+)
 from django.shortcuts import render
 from django.utils.html import format_html
 from django.utils.translation import gettext as _, ngettext
@@ -22,12 +27,13 @@ except ImportError:  # Django < 1.10
     from django.views.i18n import javascript_catalog
     HAS_CBV_JSCAT = False
 from .admin_utils import (ExtendibleModelAdminMixin, make_profile,
-    ExportCsvMixin, ExportSegmentCsvMixin, CreateSegmentMixin
+    ExportCsvMixin, ExportSegmentCsvMixin, CreateSegmentMixin, message_task
 )
 from .admin_forms import (
     ProfileAdminForm, ImportForm, ConfirmForm, SegmentAdminForm, CampaignAdminForm
 )
 from .admin_filters import SuppressedListFilter, ProfileAdvancedFiltersMixin
+from .tasks import enqueue, get_export_storage
 
 # Construct URL's for icons
 ICON_URLS = {
@@ -38,8 +44,26 @@ ICON_URLS = {
 }
 
 def send_newsletter(modeladmin, request, queryset):
+    """
+    Queue each newsletter as a campaign to all profiles, to be sent by the
+    task workers (or the delivery daemon) rather than during this request.
+    """
     for newsletter in queryset:
-        newsletter.send(request)
+        campaign = newsletter.queue_send()
+        enqueue('submit_campaign', campaign_id=campaign.pk)
+        url = reverse(
+            'admin:%s_%s_progress' % (
+                campaign._meta.app_label, campaign._meta.model_name
+            ),
+            args=(campaign.pk,), current_app=modeladmin.admin_site.name
+        )
+        modeladmin.message_user(
+            request,
+            format_html(
+                _('{} is queued as campaign <a href="{}">{}</a>.'),
+                newsletter, url, campaign.title
+            )
+        )
 
 send_newsletter.short_description = "Send selected Newsletters to all profiles"
 
@@ -268,34 +292,16 @@ class ProfileAdmin(CreateSegmentMixin, ExportCsvMixin, ProfileAdvancedFiltersMix
             form = ConfirmForm(request.POST)
             if form.is_valid():
                 try:
-                    # for email, name, city, postalCode, country in addresses.items():
-                    #     try:
-                    #         address_inst = make_profile(
-                    #             email, name, city, postalCode, country
-                    #         )
-                    for email in addresses:
-                        name = addresses[email]['name']
-                        city = addresses[email]['city']
-                        postalCode = addresses[email]['postalCode']
-                        country = addresses[email]['country']
-
-                        try:
-                            address_inst = make_profile(
-                                email, name, city, postalCode, country
-                            )
-                            address_inst.save()
-                        except IntegrityError:
-                            logging.warning(f'WARNING: email already exists. Dropping duplicate: <{email}>.')
-                            logging.info(f'UNIQUE CONSTRAINT FAILED - Dropped duplicate: <{email}>.')
+                    task = enqueue('import_profiles', addresses=addresses)
                 finally:
                     del request.session['addresses']
                     # del request.session['newsletter_pk']
 
-                messages.success(
-                    request,
+                message_task(
+                    self, request, task,
                     ngettext(
-                        "%d profiles have been successfully added.",
-                        "%d profiles have been successfully added.",
+                        "The import of %d profile is queued.",
+                        "The import of %d profiles is queued.",
                         len(addresses)
                     ) % len(addresses)
                 )
@@ -438,6 +444,7 @@ class CampaignAdmin(ExtendibleModelAdminMixin, admin.ModelAdmin):
     save_as = True
     filter_horizontal = ('segments',)
     exclude = ['recipients']
+    readonly_fields = ('admin_deliveries',)
 
     """ List extensions """
     def admin_message(self, obj):
@@ -491,12 +498,35 @@ class CampaignAdmin(ExtendibleModelAdminMixin, admin.ModelAdmin):
             else:
                 if obj.publish_date > now():
                     return _("Delayed campaign.")
+                elif obj.sending and obj.total_count:
+                    return _("Submitting: %(percent)d%% (%(done)d of "
+                             "%(total)d).") % {
+                        'percent': obj.get_progress()['percent'],
+                        'done': obj.sent_count + obj.failed_count,
+                        'total': obj.total_count,
+                    }
+                elif obj.resume_at:
+                    return _("Sending within its send window: %(done)d of "
+                             "%(total)d.") % {
+                        'done': obj.sent_count + obj.failed_count,
+                        'total': obj.total_count,
+                    }
                 else:
                     return _("Submitting.")
         else:
             return _("Not sent.")
     admin_status_text.short_description = _('Status')
 
+    def admin_deliveries(self, obj):
+        if obj.pk is None:
+            return ''
+        return _(
+            "%(sent)d sent, %(failed)d failed (%(retrying)d to be retried), "
+            "%(queued)d queued; at most %(max_attempts)d attempts per "
+            "recipient."
+        ) % obj.get_delivery_counts()
+    admin_deliveries.short_description = _('Deliveries')
+
     """ Views """
     def submit(self, request, object_id):
         appName = self.model._meta.app_label
@@ -511,12 +541,48 @@ class CampaignAdmin(ExtendibleModelAdminMixin, admin.ModelAdmin):
 
         campaign.prepared = True
         campaign.save()
+        enqueue(
+            'submit_campaign', campaign_id=campaign.pk,
+            run_at=campaign.publish_date
+        )
 
         messages.info(request, _("Your campaign is being sent."))
 
         changelist_url = reverse(f'admin:{appName}_campaign_changelist')
         return HttpResponseRedirect(changelist_url)
 
+    def progress(self, request, object_id):
+        campaign = self._getobj(request, object_id)
+        if not self.has_view_permission(request, campaign):
+            raise PermissionDenied
+
+        return render(
+            request,
+            f"admin/{self.model._meta.app_label}/campaign/progress.html",
+            {
+                **self.admin_site.each_context(request),
+                'opts': self.model._meta,
+                'original': campaign,
+                'title': _('Progress of %s') % campaign,
+            },
+        )
+
+    def progress_json(self, request, object_id):
+        """
+        Progress from the counters persisted on the campaign, without
+        counting recipients or deliveries.
+        """
+        campaign = self._getobj(request, object_id)
+        if not self.has_view_permission(request, campaign):
+            raise PermissionDenied
+
+        progress = campaign.get_progress()
+        progress['status'] = self.admin_status_text(campaign)
+        for key in ('started', 'updated'):
+            if progress[key] is not None:
+                progress[key] = progress[key].isoformat()
+        return JsonResponse(progress)
+
     """ URLs """
     def get_urls(self):
         urls = super().get_urls()
@@ -526,7 +592,118 @@ class CampaignAdmin(ExtendibleModelAdminMixin, admin.ModelAdmin):
                 '<object_id>/submit/',
                 self._wrap(self.submit),
                 name=self._view_name('submit')
+            ),
+            path(
+                '<object_id>/progress/',
+                self._wrap(self.progress),
+                name=self._view_name('progress')
+            ),
+            path(
+                '<object_id>/progress.json',
+                self._wrap(self.progress_json),
+                name=self._view_name('progress_json')
+            ),
+        ]
+
+        return my_urls + urls
+
+
+@admin.register(Task)
+class TaskAdmin(ExtendibleModelAdminMixin, admin.ModelAdmin):
+    list_display = (
+        'name', 'status', 'attempts', 'run_at', 'started', 'finished',
+        'admin_result'
+    )
+    list_filter = ('status', 'name')
+    date_hierarchy = 'created'
+    readonly_fields = (
+        'name', 'kwargs', 'status', 'run_at', 'attempts', 'max_attempts',
+        'claimed_by', 'lease_expires', 'admin_result', 'error', 'created',
+        'started', 'finished'
+    )
+    exclude = ('result',)
+    actions = ['requeue']
+
+    def has_add_permission(self, request):
+        return False
+
+    """ List extensions """
+    def admin_result(self, obj):
+        if obj.result is None:
+            return ''
+        if isinstance(obj.result, dict) and obj.result.get('file'):
+            url = reverse(
+                'admin:%s' % self._view_name('download'),
+                args=[obj.pk], current_app=self.admin_site.name
+            )
+            return format_html(
+                '<a href="{}">{}</a> ({} rows)', url,
+                obj.result['filename'], obj.result['rows']
             )
+        if isinstance(obj.result, dict) and 'filename' in obj.result:
+            return _('%(filename)s (%(rows)d rows, expired)') % obj.result
+        return json.dumps(obj.result, cls=DjangoJSONEncoder)
+    admin_result.short_description = _('result')
+
+    """ Actions """
+    def requeue(self, request, queryset):
+        rows_updated = queryset.exclude(status=Task.RUNNING).update(
+            status=Task.QUEUED, run_at=now(), attempts=0, error='',
+            finished=None
+        )
+        self.message_user(
+            request,
+            ngettext(
+                "%d task has been queued again.",
+                "%d tasks have been queued again.",
+                rows_updated
+            ) % rows_updated
+        )
+    requeue.short_description = _("Run selected tasks again")
+
+    """ Views """
+    def has_export_permission(self, request, task):
+        """
+        Whether the user may view what `task` exported: the exported model,
+        and the profiles for segment exports.
+        """
+        exported = [apps.get_model(task.kwargs['model'])]
+        if task.kwargs.get('profiles'):
+            exported.append(Profile)
+        for model in exported:
+            model_admin = self.admin_site._registry.get(model)
+            if model_admin is None or \
+                    not model_admin.has_view_permission(request):
+                return False
+        return True
+
+    def download(self, request, object_id):
+        task = self._getobj(request, object_id)
+        if not self.has_view_permission(request, task):
+            raise PermissionDenied
+        if task.name != 'export_csv' or \
+                not self.has_export_permission(request, task):
+            raise PermissionDenied
+        if not isinstance(task.result, dict) or not task.result.get('file'):
+            raise Http404
+        storage = get_export_storage()
+        if storage is None or not storage.exists(task.result['file']):
+            raise Http404(_('The export has expired.'))
+        return FileResponse(
+            storage.open(task.result['file']), as_attachment=True,
+            filename=task.result['filename']
+        )
+
+    """ URLs """
+    def get_urls(self):
+        urls = super().get_urls()
+
+        my_urls = [
+            path(
+                '<object_id>/download/',
+                self._wrap(self.download),
+                name=self._view_name('download')
+            ),
         ]
 
         return my_urls + urls
@@ -1,13 +1,15 @@
 from functools import update_wrapper
 
+from django.contrib import messages
 from django.contrib.admin.utils import unquote
 from django.http import Http404
 from django.utils.encoding import force_str
 from django.utils.translation import gettext as _, ngettext
+from django.urls import reverse
+from django.utils.html import format_html
 from .models import Profile, Segment
-from django.http import HttpResponse
+from .tasks import enqueue, get_export_storage
 from django.utils.timezone import now, localtime
-import csv
 
 class ExtendibleModelAdminMixin:
     def _getobj(self, request, object_id):
@@ -64,48 +66,70 @@ def make_profile(email, name=None, city=None, postalCode=None, country=None, ip=
     return addr
 
 
-class ExportCsvMixin:
-    def export_as_csv(self, request, queryset):
-
-        meta = self.model._meta
-        field_names = [field.name for field in meta.fields]
-
-        response = HttpResponse(content_type='text/csv')
-        file_tag = str(meta).replace('.', '_')
-        local_t = localtime(now()).strftime("%Y-%m-%d__%H_%M_%S")
-        response['Content-Disposition'] = 'attachment; filename={}_{}.csv'.format(file_tag, local_t)
-        writer = csv.writer(response)
+def write_csv(writer, queryset):
+    """ Write the fields of the objects in `queryset`; returns the rows. """
+    field_names = [field.name for field in queryset.model._meta.fields]
+
+    writer.writerow(field_names)
+    rows = 0
+    for obj in queryset.iterator():
+        writer.writerow([getattr(obj, field) for field in field_names])
+        rows += 1
+    return rows
+
+
+def write_profiles_csv(writer, queryset):
+    """
+    Write the fields of the profiles in the segments in `queryset`; returns
+    the rows.
+    """
+    field_names = [field.name for field in Profile._meta.fields]
+    mtm_field_names = ["profiles__" + x for x in field_names]
+
+    writer.writerow(field_names)
+    rows = 0
+    for obj in queryset.values_list(*mtm_field_names).iterator():
+        writer.writerow(obj)
+        rows += 1
+    return rows
+
+
+def message_task(modeladmin, request, task, message):
+    """ Tell the user `message`, linking to the admin page of `task`. """
+    url = reverse(
+        'admin:%s_%s_change' % (task._meta.app_label, task._meta.model_name),
+        args=(task.pk,), current_app=modeladmin.admin_site.name
+    )
+    modeladmin.message_user(
+        request, format_html('{} <a href="{}">{}</a>', message, url, task)
+    )
+
+
+def queue_export(modeladmin, request, queryset, **kwargs):
+    """ Queue a CSV export of `queryset`, if there is storage for it. """
+    if get_export_storage() is None:
+        modeladmin.message_user(
+            request,
+            _("Exporting is disabled: NEWSLETTER_EXPORT_STORAGE is not set."),
+            level=messages.ERROR
+        )
+        return
+    task = enqueue(
+        'export_csv', model=modeladmin.model._meta.label,
+        pks=list(queryset.values_list('pk', flat=True)), **kwargs
+    )
+    message_task(modeladmin, request, task, _("The export is queued."))
 
-        writer.writerow(field_names)
-        for obj in queryset:
-            row = writer.writerow([getattr(obj, field) for field in field_names])
 
-        return response
+class ExportCsvMixin:
+    def export_as_csv(self, request, queryset):
+        queue_export(self, request, queryset)
 
     export_as_csv.short_description = "Export Selected to CSV"
 
 class ExportSegmentCsvMixin:
     def export_as_csv(self, request, queryset):
-
-        meta = self.model._meta
-        profile_meta = Profile._meta
-        # profiles_email = meta.get_field('profiles__email')
-        field_names = [field.name for field in profile_meta.fields]
-        mtm_field_names = ["profiles__" + x for x in field_names]
-
-        profiles = queryset.values(*mtm_field_names)
-
-        response = HttpResponse(content_type='text/csv')
-        file_tag = str(meta).replace('.', '_')
-        local_t = localtime(now()).strftime("%Y-%m-%d__%H_%M_%S")
-        response['Content-Disposition'] = 'attachment; filename={}_{}.csv'.format(file_tag, local_t)
-        writer = csv.writer(response)
-
-        writer.writerow(field_names)
-        for obj in profiles:
-            row = writer.writerow([value for value in obj.values()])
-
-        return response
+        queue_export(self, request, queryset, profiles=True)
 
     export_as_csv.short_description = "Export Selected to CSV"
 
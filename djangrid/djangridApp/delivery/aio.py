@@ -0,0 +1,353 @@
+"""
+asyncio delivery engine: many in-flight sends to the email API from one
+process, fed by a bounded queue of rendered messages.
+"""
+
+import asyncio
+import concurrent.futures
+import logging
+import queue
+from contextlib import suppress
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.mail import get_connection
+from django.db import connections
+from django.utils.translation import gettext
+
+from ..settings import newsletter_settings
+from ..signals import message_queued
+from .connection import RECONNECT_ERRORS
+from .ledger import get_message_id
+from .sendgrid import (
+    MAX_PERSONALIZATIONS, get_client, make_base_body, make_content,
+    make_personalization
+)
+
+logger = logging.getLogger(__name__)
+
+# Put on the queue once per sender coroutine to make it stop.
+STOP = object()
+
+SENDGRID_BACKEND = 'sendgrid_backend.SendgridBackend'
+
+
+class SendGridTransport(object):
+    """
+    Sends v3 Mail request bodies with the SendGrid client from a pool of
+    threads; the client's urllib handles proxies, chunked responses and
+    timeouts.
+    """
+
+    def __init__(self, concurrency):
+        self.client = get_client()
+        self.timeout = newsletter_settings.ASYNC_TIMEOUT
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=concurrency, thread_name_prefix='newsletter-sendgrid'
+        )
+
+    def _send(self, body):
+        response = self.client.client.mail.send.post(
+            request_body=body, timeout=self.timeout
+        )
+        return response.headers.get('X-Message-Id')
+
+    async def send(self, body):
+        """ Send a request body and return the provider message id. """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self._send, body)
+
+    async def close(self):
+        self.executor.shutdown(wait=False)
+
+
+class BackendTransport(object):
+    """
+    Sends EmailMessages through the configured mail backend from a pool
+    of threads, keeping one open backend connection per thread.
+    """
+
+    def __init__(self, concurrency):
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=concurrency, thread_name_prefix='newsletter-async'
+        )
+        self._idle = queue.SimpleQueue()
+
+    def _get_connection(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            connection = get_connection(fail_silently=False)
+            connection.open()
+            return connection
+
+    def _send(self, message):
+        connection = self._get_connection()
+        try:
+            try:
+                connection.send_messages([message])
+            except RECONNECT_ERRORS:
+                connection.close()
+                connection.open()
+                connection.send_messages([message])
+        except Exception:
+            with suppress(Exception):
+                connection.close()
+            raise
+        self._idle.put(connection)
+        return get_message_id(message)
+
+    async def send(self, message):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self._send, message)
+
+    async def close(self):
+        while True:
+            try:
+                connection = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            with suppress(Exception):
+                connection.close()
+        self.executor.shutdown(wait=False)
+
+
+def get_transport_name(mode):
+    if mode == 'personalizations':
+        return 'sendgrid'
+    name = newsletter_settings.ASYNC_TRANSPORT
+    if name == 'auto':
+        if settings.EMAIL_BACKEND == SENDGRID_BACKEND:
+            return 'sendgrid'
+        return 'backend'
+    assert name in ('sendgrid', 'backend'), 'Unknown transport: %s' % name
+    return name
+
+
+class Stopped(Exception):
+    """ The engine stopped while the producer was waiting. """
+
+
+class AsyncDeliveryEngine(object):
+    """
+    Delivers a campaign from an event loop.
+
+    A producer thread loads the recipients and renders their messages, and
+    hands them to `concurrency` sender coroutines through a queue holding
+    at most `queue_size` items. When the senders fall behind, the producer
+    waits, so memory stays flat however long the list is.
+
+    With the 'sendgrid' transport (the default for the SendGrid backend,
+    and always in 'personalizations' mode) requests go to the v3 API with
+    the SendGrid client; otherwise messages go through the mail backend.
+    Either way the sends block in a thread pool of `concurrency` threads.
+
+    Outcomes are recorded in the `ledger` when given; it must not flush by
+    itself, as the engine writes it from a thread.
+    """
+
+    def __init__(self, campaign, plan, mode='backend', concurrency=None,
+                 queue_size=None, limiter=None, transport=None, ledger=None):
+        if concurrency is None:
+            concurrency = newsletter_settings.ASYNC_CONCURRENCY
+        if queue_size is None:
+            queue_size = newsletter_settings.ASYNC_QUEUE_SIZE
+
+        self.campaign = campaign
+        self.plan = plan
+        self.mode = mode
+        self.concurrency = max(int(concurrency), 1)
+        self.queue_size = queue_size or self.concurrency * 4
+        self.limiter = limiter
+        self.transport_name = get_transport_name(mode)
+        self.transport = transport
+        self.ledger = ledger
+        self.sent = 0
+        self.failed = 0
+        self._stopped = False
+
+    def make_transport(self):
+        if self.transport_name == 'sendgrid':
+            return SendGridTransport(self.concurrency)
+        return BackendTransport(self.concurrency)
+
+    async def run(self, recipients):
+        """ Send to all `recipients`. """
+        loop = asyncio.get_running_loop()
+        items = asyncio.Queue(maxsize=self.queue_size)
+        if self.transport is None:
+            self.transport = self.make_transport()
+
+        senders = [
+            asyncio.ensure_future(self.consume(items))
+            for i in range(self.concurrency)
+        ]
+        producer = loop.run_in_executor(
+            None, self.produce, recipients, loop, items
+        )
+        try:
+            await asyncio.gather(producer, *senders)
+        finally:
+            self._stopped = True
+            for sender in senders:
+                sender.cancel()
+            await self.transport.close()
+
+    def produce(self, recipients, loop, items):
+        """ Render items in a worker thread and put them on the queue. """
+        try:
+            for item in self.iter_items(recipients):
+                self._put(loop, items, item)
+        except Stopped:
+            return
+        finally:
+            with suppress(Stopped):
+                for i in range(self.concurrency):
+                    self._put(loop, items, STOP)
+            connections.close_all()
+
+    def _put(self, loop, items, item):
+        future = asyncio.run_coroutine_threadsafe(items.put(item), loop)
+        while True:
+            try:
+                return future.result(timeout=1)
+            except concurrent.futures.TimeoutError:
+                if self._stopped:
+                    future.cancel()
+                    raise Stopped()
+
+    def iter_items(self, recipients):
+        """ Yield (payload, recipients) tuples for the transport. """
+        plan = self.plan
+        attachments = list(plan.attachments.parts())
+
+        if self.mode == 'personalizations':
+            plaintext, html_content = plan.render_tagged()
+            base_body = make_base_body(
+                plan.sender, plan.subject, plaintext, html_content, attachments
+            )
+            batch_size = min(
+                newsletter_settings.PERSONALIZATIONS_PER_REQUEST,
+                MAX_PERSONALIZATIONS
+            )
+            batch = []
+            for recipient in recipients:
+                message_queued.send(sender=self.campaign, recipient=recipient)
+                batch.append(recipient)
+                if len(batch) >= batch_size:
+                    yield self._personalizations(base_body, batch), batch
+                    batch = []
+            if batch:
+                yield self._personalizations(base_body, batch), batch
+
+        elif self.transport_name == 'sendgrid':
+            base_body = make_base_body(
+                plan.sender, plan.subject, attachments=attachments
+            )
+            for recipient in recipients:
+                message_queued.send(sender=self.campaign, recipient=recipient)
+                body = dict(base_body)
+                body['content'] = make_content(*plan.render(recipient))
+                body['personalizations'] = [
+                    make_personalization(recipient.email, recipient.name)
+                ]
+                yield body, [recipient]
+
+        else:
+            for recipient in recipients:
+                message_queued.send(sender=self.campaign, recipient=recipient)
+                yield self.campaign.build_message(recipient, plan), [recipient]
+
+    def _personalizations(self, base_body, batch):
+        body = dict(base_body)
+        body['personalizations'] = [
+            make_personalization(
+                recipient.email, recipient.name,
+                self.plan.get_substitutions(recipient)
+            )
+            for recipient in batch
+        ]
+        return body
+
+    async def consume(self, items):
+        while True:
+            item = await items.get()
+            if item is STOP:
+                return
+            payload, recipients = item
+
+            if self.limiter is not None:
+                await self.limiter.aacquire(len(recipients))
+
+            try:
+                message_id = await self.transport.send(payload)
+            except Exception as e:
+                if self.limiter is not None:
+                    self.limiter.on_error(e)
+                for recipient in recipients:
+                    self.on_failed(recipient, e)
+            else:
+                if self.limiter is not None:
+                    self.limiter.on_success(len(recipients))
+                self.on_sent(recipients, message_id)
+
+            if self.ledger is not None and self.ledger.is_full():
+                await sync_to_async(
+                    self.ledger.flush, thread_sensitive=False
+                )()
+
+    def on_sent(self, recipients, message_id):
+        self.sent += len(recipients)
+        if self.ledger is not None:
+            self.ledger.record_sent(recipients, message_id)
+
+    def on_failed(self, recipient, error):
+        self.failed += 1
+        if self.ledger is not None:
+            self.ledger.record_failed(recipient, error)
+        logger.error(
+            gettext('Message %(recipients)s failed '
+                    'with error: %(error)s'),
+            {'recipients': recipient,
+             'error': error}
+        )
+
+
+class DeliveryLifespan(object):
+    """
+    ASGI wrapper answering lifespan events. With NEWSLETTER_ASGI_DELIVERY
+    enabled, it submits the campaign queue on the server's event loop every
+    NEWSLETTER_ASGI_DELIVERY_INTERVAL seconds.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.task = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'lifespan':
+            return await self.app(scope, receive, send)
+
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                if newsletter_settings.ASGI_DELIVERY:
+                    self.task = asyncio.ensure_future(self.deliver())
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.task is not None:
+                    self.task.cancel()
+                    with suppress(asyncio.CancelledError):
+                        await self.task
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def deliver(self):
+        from ..models import Campaign
+
+        while True:
+            try:
+                await Campaign.asubmit_queue()
+            except Exception:
+                logger.exception('Error submitting the campaign queue.')
+            await asyncio.sleep(newsletter_settings.ASGI_DELIVERY_INTERVAL)
@@ -0,0 +1,114 @@
+""" Campaign-scoped cache of encoded attachment MIME parts. """
+
+import logging
+import mimetypes
+import os
+import tempfile
+from email import encoders
+from email.mime.base import MIMEBase
+
+from django.core.mail.message import DEFAULT_ATTACHMENT_MIME_TYPE
+
+from ..settings import newsletter_settings
+
+logger = logging.getLogger(__name__)
+
+
+def make_mime_part(filename, content, mimetype=None):
+    """
+    Return a base64 encoded MIME part for an attachment. Base64 is used for
+    all types so the part can be handed to both the SMTP and the SendGrid
+    backends unchanged.
+    """
+    mimetype = (
+        mimetype or mimetypes.guess_type(filename)[0] or
+        DEFAULT_ATTACHMENT_MIME_TYPE
+    )
+    maintype, subtype = mimetype.split('/', 1)
+    part = MIMEBase(maintype, subtype)
+    part.set_payload(content)
+    encoders.encode_base64(part)
+    set_filename(part, filename)
+    return part
+
+
+def set_filename(part, filename):
+    try:
+        filename.encode('ascii')
+    except UnicodeEncodeError:
+        filename = ('utf-8', '', filename)
+    part.add_header('Content-Disposition', 'attachment', filename=filename)
+
+
+class AttachmentCache(object):
+    """
+    Loads a newsletter's attachments once per submission and keeps their
+    encoded MIME parts for every message.
+
+    Encoded parts are held in memory up to `max_size` bytes in total. Parts
+    beyond that are spilled to a temporary file holding the already encoded
+    payload, which is read back (but not re-encoded) for each message.
+    """
+
+    def __init__(self, attachments, max_size=None):
+        if max_size is None:
+            max_size = newsletter_settings.ATTACHMENT_CACHE_SIZE
+        self.max_size = max_size
+        self.size = 0
+        self._parts = []
+
+        for attachment in attachments:
+            self.add_file(attachment.file.path)
+
+    def __len__(self):
+        return len(self._parts)
+
+    def add_file(self, path):
+        with open(path, 'rb') as f:
+            content = f.read()
+
+        part = make_mime_part(os.path.basename(path), content)
+        payload = part.get_payload()
+
+        if self.size + len(payload) <= self.max_size:
+            self.size += len(payload)
+            self._parts.append((part, None))
+        else:
+            logger.debug('Spilling encoded attachment %s to disk.', path)
+            with tempfile.NamedTemporaryFile(
+                mode='w', suffix='.b64', delete=False
+            ) as spill:
+                spill.write(payload)
+            # Keep the headers only; the payload lives in the spill file.
+            part.set_payload('')
+            self._parts.append((part, spill.name))
+
+    def parts(self):
+        """ Yield the encoded MIME part of every attachment. """
+        for part, spill_path in self._parts:
+            if spill_path is None:
+                yield part
+            else:
+                with open(spill_path) as f:
+                    payload = f.read()
+                spilled = MIMEBase(*part.get_content_type().split('/', 1))
+                for header, value in part.items():
+                    if header.lower() not in ('content-type', 'mime-version'):
+                        spilled[header] = value
+                spilled.set_payload(payload)
+                yield spilled
+
+    def attach_to(self, message):
+        for part in self.parts():
+            message.attach(part)
+
+    def close(self):
+        """ Remove any spill files. """
+        for part, spill_path in self._parts:
+            if spill_path is not None:
+                try:
+                    os.remove(spill_path)
+                except OSError:
+                    pass
+        self._parts = []
+        self.size = 0
@@ -0,0 +1,224 @@
+"""
+Offline benchmark of campaign submission: throughput, per-message latency,
+peak memory and database queries, against local mail backends and a fake
+SendGrid API.
+"""
+
+import asyncio
+import contextlib
+import datetime
+import os
+import statistics
+import tempfile
+import threading
+import time
+
+from django.core import mail
+from django.core.files.base import ContentFile
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.test.utils import override_settings
+from django.utils.timezone import now
+
+from ..signals import message_queued, messages_sent
+from .fake_sendgrid import FakeSendGridServer
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Where a benchmarked submission is sent: Django's in-memory backend, the
+# file backend, or the fake SendGrid API in 'personalizations' mode.
+TARGETS = ('locmem', 'file', 'sendgrid')
+
+BENCHMARK_BODY = (
+    '<html><body><h1>Hello {{ first_name }},</h1>'
+    + '<p>This month in the newsletter: news, offers &amp; more.</p>' * 40
+    + '</body></html>'
+)
+
+
+def get_peak_rss():
+    """ Peak resident set size of this process in bytes, if known. """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS.
+    return peak if os.uname().sysname == 'Darwin' else peak * 1024
+
+
+def count_query(execute, sql, params, many, context):
+    for counter in list(QueryCounter.active):
+        counter.add()
+    return execute(sql, params, many, context)
+
+
+def install_query_counting(sender=None, connection=None, **kwargs):
+    if count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(count_query)
+
+
+class QueryCounter(object):
+    """
+    Counts the queries of all database connections while entered,
+    including those of sender threads and of threads that outlive a
+    submission (e.g. asgiref's executor).
+    """
+    active = set()
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def add(self):
+        with self._lock:
+            self.count += 1
+
+    def __enter__(self):
+        connection_created.connect(install_query_counting, weak=False)
+        for connection in connections.all():
+            install_query_counting(connection=connection)
+        QueryCounter.active.add(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        QueryCounter.active.discard(self)
+
+
+class LatencyRecorder(object):
+    """
+    Per-message latency while entered: from a message being queued for
+    sending until the backend or provider accepted it.
+    """
+
+    def __init__(self):
+        self.queued = {}
+        self.latencies = []
+
+    def on_queued(self, sender, recipient, **kwargs):
+        self.queued[recipient.pk] = time.perf_counter()
+
+    def on_sent(self, sender, recipients, **kwargs):
+        timestamp = time.perf_counter()
+        for recipient in recipients:
+            started = self.queued.pop(recipient.pk, None)
+            if started is not None:
+                self.latencies.append(timestamp - started)
+
+    def __enter__(self):
+        message_queued.connect(self.on_queued, weak=False)
+        messages_sent.connect(self.on_sent, weak=False)
+        return self
+
+    def __exit__(self, *exc_info):
+        message_queued.disconnect(self.on_queued)
+        messages_sent.disconnect(self.on_sent)
+
+    def percentile(self, percent):
+        if len(self.latencies) < 2:
+            return self.latencies[0] if self.latencies else None
+        return statistics.quantiles(
+            self.latencies, n=100, method='inclusive'
+        )[percent - 1]
+
+
+def seed(profiles, body=BENCHMARK_BODY):
+    """
+    Create `profiles` synthetic subscribers in a segment, and a newsletter.
+    Returns a (newsletter, segment) tuple.
+    """
+    from ..models import Newsletter, Profile, Segment
+
+    Profile.objects.bulk_create(
+        [
+            Profile(
+                email='benchmark%d@example.com' % i,
+                name_field='Name%d Benchmark' % (i % 1000), confirmed=True
+            )
+            for i in range(profiles)
+        ],
+        batch_size=1000
+    )
+    segment = Segment.objects.create(segment_name='benchmark')
+    segment.profiles.set(
+        Profile.objects.filter(email__startswith='benchmark')
+    )
+
+    newsletter = Newsletter(
+        title='Benchmark', slug='benchmark', subject='Benchmark'
+    )
+    newsletter.contents.save(
+        'benchmark.html', ContentFile(body.encode('utf-8')), save=False
+    )
+    newsletter.save()
+    return newsletter, segment
+
+
+@contextlib.contextmanager
+def target_settings(target):
+    """ Settings for submitting to `target`, and the delivery mode. """
+    if target == 'locmem':
+        with override_settings(
+                EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend'):
+            yield 'backend'
+        mail.outbox = []
+
+    elif target == 'file':
+        with tempfile.TemporaryDirectory() as path:
+            with override_settings(
+                    EMAIL_BACKEND='django.core.mail.backends.filebased.'
+                                  'EmailBackend',
+                    EMAIL_FILE_PATH=path):
+                yield 'backend'
+
+    elif target == 'sendgrid':
+        server = FakeSendGridServer(keep_requests=False).start()
+        try:
+            with override_settings(
+                    NEWSLETTER_SENDGRID_API_HOST=server.url,
+                    NEWSLETTER_ASYNC_TRANSPORT='sendgrid',
+                    SENDGRID_API_KEY='benchmark'):
+                yield 'personalizations'
+        finally:
+            server.stop()
+
+    else:
+        raise ValueError('Unknown benchmark target: %s' % target)
+
+
+def run(target, newsletter, segment, engine='sync'):
+    """ Submit a new campaign to the seeded profiles and measure it. """
+    from ..models import Campaign
+
+    campaign = Campaign(
+        emailmsg=newsletter, title='Benchmark %s' % target,
+        slug='benchmark-%s-%s-%d' % (
+            target, engine, Campaign.objects.count()
+        ),
+        publish_date=now() - datetime.timedelta(seconds=1)
+    )
+    campaign.save()
+    campaign.segments.add(segment)
+
+    with target_settings(target) as mode, QueryCounter() as queries, \
+            LatencyRecorder() as latency:
+        started = time.perf_counter()
+        if engine == 'async':
+            asyncio.run(campaign.asubmit(mode=mode))
+        else:
+            campaign.submit(mode=mode)
+        seconds = time.perf_counter() - started
+
+    messages = len(latency.latencies)
+    return {
+        'target': target,
+        'engine': engine,
+        'messages': messages,
+        'seconds': seconds,
+        'throughput': messages / seconds if seconds else 0,
+        'p50': latency.percentile(50),
+        'p99': latency.percentile(99),
+        'queries': queries.count,
+        'peak_rss': get_peak_rss(),
+    }
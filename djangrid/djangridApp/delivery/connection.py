@@ -0,0 +1,155 @@
+""" Batched message delivery over a single mail backend connection. """
+
+import logging
+import smtplib
+
+from django.core.mail import get_connection
+from django.utils.translation import gettext
+
+from ..settings import newsletter_settings
+from .ledger import get_message_id
+
+logger = logging.getLogger(__name__)
+
+# Errors after which the connection is reopened and the message retried.
+RECONNECT_ERRORS = (
+    smtplib.SMTPServerDisconnected, ConnectionError, TimeoutError
+)
+
+
+class TrackedBatch(list):
+    """
+    List of messages that remembers how far the backend got iterating over
+    it, so that after an error we know which messages were already handed
+    to the backend and which were not.
+
+    With a rate limiter, a token is taken as each message is handed out,
+    so the limit applies to actual sends rather than whole batches.
+    """
+    position = 0
+
+    def __init__(self, messages, limiter=None):
+        super().__init__(messages)
+        self.limiter = limiter
+        self.acquired = 0
+
+    def __iter__(self):
+        for self.position, message in enumerate(list.__iter__(self)):
+            # Backends may iterate more than once (e.g. to echo messages),
+            # only take a token the first time a message is handed out.
+            if self.limiter is not None and self.position >= self.acquired:
+                self.limiter.acquire()
+                self.acquired = self.position + 1
+            yield message
+
+
+class BatchSender(object):
+    """
+    Pushes messages through `send_messages()` on one backend connection in
+    batches of `batch_size`.
+
+    When the connection drops mid-batch, it is reopened and the batch is
+    resumed from the message that failed. A message that fails again, or
+    fails for any other reason, is logged and skipped.
+
+    An optional `limiter` (see `ratelimit.TokenBucket`) paces the sends,
+    and outcomes are recorded in the `ledger` (see `ledger.DeliveryLedger`)
+    when given.
+    """
+
+    def __init__(self, connection=None, batch_size=None, limiter=None,
+                 ledger=None):
+        if connection is None:
+            connection = get_connection(fail_silently=False)
+        if batch_size is None:
+            batch_size = newsletter_settings.SEND_BATCH_SIZE
+
+        self.connection = connection
+        self.batch_size = max(int(batch_size), 1)
+        self.limiter = limiter
+        self.ledger = ledger
+        self.sent = 0
+        self.failed = 0
+        self._pending = []
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *exc_info):
+        try:
+            if exc_info[0] is None:
+                self.flush()
+        finally:
+            self.close()
+
+    def open(self):
+        self.connection.open()
+
+    def close(self):
+        try:
+            self.connection.close()
+        except Exception:
+            logger.debug('Error closing mail connection.', exc_info=True)
+
+    def reconnect(self):
+        logger.info(gettext('Mail connection lost, reconnecting.'))
+        self.close()
+        self.open()
+
+    def add(self, message, recipient):
+        """ Queue a message, sending the batch once it is full. """
+        self._pending.append((message, recipient))
+
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """ Send all queued messages. """
+        pending, self._pending = self._pending, []
+        reconnected = False
+
+        while pending:
+            batch = TrackedBatch(
+                (message for message, recipient in pending), self.limiter
+            )
+            try:
+                self.connection.send_messages(batch)
+            except Exception as e:
+                failed_at = batch.position
+                self.on_sent(pending[:failed_at])
+
+                if isinstance(e, RECONNECT_ERRORS) and not reconnected:
+                    reconnected = True
+                    self.reconnect()
+                    pending = pending[failed_at:]
+                    continue
+
+                self.on_failed(pending[failed_at], e)
+                pending = pending[failed_at + 1:]
+                reconnected = False
+            else:
+                self.on_sent(pending)
+                break
+
+    def on_sent(self, sent):
+        self.sent += len(sent)
+        if self.limiter is not None and sent:
+            self.limiter.on_success(len(sent))
+        if self.ledger is not None:
+            for message, recipient in sent:
+                self.ledger.record_sent([recipient], get_message_id(message))
+
+    def on_failed(self, item, error):
+        message, recipient = item
+        self.failed += 1
+        if self.limiter is not None:
+            self.limiter.on_error(error)
+        if self.ledger is not None:
+            self.ledger.record_failed(recipient, error)
+        logger.error(
+            gettext('Message %(recipients)s failed '
+                    'with error: %(error)s'),
+            {'recipients': recipient,
+             'error': error}
+        )
@@ -0,0 +1,164 @@
+""" A resident process submitting campaigns as they become due. """
+
+import asyncio
+import datetime
+import heapq
+import logging
+import threading
+import time
+
+from django.db import close_old_connections, connection
+from django.utils.timezone import now
+from django.utils.translation import gettext
+
+from ..settings import newsletter_settings
+from .ratelimit import get_rate_limiter
+
+logger = logging.getLogger(__name__)
+
+
+class DeliveryDaemon(object):
+    """
+    Submits the campaign queue within moments of each campaign's
+    publication date, instead of on a cron schedule.
+
+    Upcoming publication dates, and the next passes of campaigns with a
+    send window, are kept in a heap and the daemon sleeps
+    until the earliest one. Every `poll_interval` seconds it picks up new
+    and changed campaigns by their indexed `modified` timestamp, and checks
+    whether anything else became due, e.g. a campaign whose worker died
+    and whose lease expired.
+
+    Each submission runs in a thread of its own, so campaigns becoming due
+    while others are being sent start right away instead of waiting for
+    those to finish. The campaigns are claimed, so no two submissions send
+    the same one; threaded single-process submissions share one send rate.
+    """
+
+    def __init__(self, workers=1, engine='sync', poll_interval=None):
+        if poll_interval is None:
+            poll_interval = newsletter_settings.DAEMON_POLL_INTERVAL
+
+        self.workers = workers
+        self.engine = engine
+        self.poll_interval = poll_interval
+        # (publish_date, pk) entries; stale ones are skipped when popped.
+        self.heap = []
+        self.schedule = {}
+        self.last_poll = None
+        self.limiter = get_rate_limiter()
+        self.submissions = set()
+        self._stop = threading.Event()
+
+    def stop(self):
+        """
+        Stop after the submissions in progress; safe from signal handlers.
+        """
+        self._stop.set()
+
+    def poll(self):
+        """
+        Add new and rescheduled campaigns to the heap. Returns whether some
+        campaign is due already.
+        """
+        from ..models import Campaign
+
+        polled = now()
+        changed = Campaign.objects.filter(prepared=True, sent=False)
+        if self.last_poll is not None:
+            # Overlap polls, for saves committed just after the last one.
+            changed = changed.filter(modified__gte=self.last_poll - (
+                datetime.timedelta(seconds=self.poll_interval)
+            ))
+
+        for pk, publish_date, resume_at in changed.values_list(
+                'pk', 'publish_date', 'resume_at'):
+            if publish_date is None:
+                continue
+            if resume_at is not None:
+                # The next pass of a campaign with a send window.
+                publish_date = max(publish_date, resume_at)
+            if self.schedule.get(pk) != publish_date:
+                self.schedule[pk] = publish_date
+                heapq.heappush(self.heap, (publish_date, pk))
+
+        self.last_poll = polled
+        return Campaign.get_queue().exists()
+
+    def pop_due(self):
+        """ Drop the due entries from the heap; returns whether any was. """
+        due = False
+        timestamp = now()
+        while self.heap and self.heap[0][0] <= timestamp:
+            publish_date, pk = heapq.heappop(self.heap)
+            if self.schedule.get(pk) == publish_date:
+                del self.schedule[pk]
+                due = True
+        return due
+
+    def get_timeout(self, next_poll):
+        """ Seconds to sleep until the next publication date or poll. """
+        timeout = next_poll - time.monotonic()
+        if self.heap:
+            timeout = min(
+                timeout, (self.heap[0][0] - now()).total_seconds()
+            )
+        return max(timeout, 0)
+
+    def submit(self):
+        """ Submit the due campaigns from a new thread. """
+        self.submissions = {
+            thread for thread in self.submissions if thread.is_alive()
+        }
+        thread = threading.Thread(
+            target=self._submit, name='delivery-submission'
+        )
+        self.submissions.add(thread)
+        thread.start()
+
+    def _submit(self):
+        from ..models import Campaign
+
+        try:
+            if self.engine == 'async' and self.workers <= 1:
+                asyncio.run(Campaign.asubmit_queue())
+            else:
+                Campaign.submit_queue(
+                    workers=self.workers, engine=self.engine,
+                    limiter=self.limiter
+                )
+        except Exception:
+            logger.exception(gettext('Error submitting the campaign queue.'))
+        finally:
+            # The thread has its own database connection.
+            connection.close()
+
+    def run(self):
+        logger.info(
+            gettext('Delivery daemon started, polling every %s seconds.'),
+            self.poll_interval
+        )
+        next_poll = time.monotonic()
+
+        while not self._stop.is_set():
+            # Long-running: do not hold on to broken or expired connections.
+            close_old_connections()
+
+            due = False
+            if time.monotonic() >= next_poll:
+                try:
+                    due = self.poll()
+                except Exception:
+                    logger.exception(gettext('Error polling campaigns.'))
+                next_poll = time.monotonic() + self.poll_interval
+
+            if self.pop_due() or due:
+                self.submit()
+                continue
+
+            self._stop.wait(self.get_timeout(next_poll))
+
+        for thread in self.submissions:
+            thread.join()
+        close_old_connections()
+        logger.info(gettext('Delivery daemon stopped.'))
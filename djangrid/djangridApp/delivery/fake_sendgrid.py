@@ -0,0 +1,118 @@
+"""
+A local stand-in for the SendGrid v3 mail send endpoint, for exercising
+the delivery code without hitting the live API. Point
+NEWSLETTER_SENDGRID_API_HOST at it, e.g. ``http://127.0.0.1:8025``.
+"""
+
+import json
+import logging
+import math
+import threading
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+
+class FakeSendGridHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+
+        if self.path.rstrip('/') != '/v3/mail/send':
+            self.respond(404, {'errors': [{'message': 'Not found'}]})
+            return
+
+        try:
+            data = json.loads(body.decode('utf-8'))
+        except ValueError:
+            self.respond(400, {'errors': [{'message': 'Invalid JSON'}]})
+            return
+
+        wait = self.server.admit(len(data.get('personalizations', [])))
+        if wait:
+            self.respond(
+                429, {'errors': [{'message': 'Too many requests'}]},
+                headers={'Retry-After': str(math.ceil(wait))}
+            )
+            return
+
+        self.server.record(data)
+        self.respond(202, headers={'X-Message-Id': uuid.uuid4().hex})
+
+    def respond(self, status, data=None, headers=None):
+        body = json.dumps(data).encode('utf-8') if data is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        if data is not None:
+            self.send_header('Content-Type', 'application/json')
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class FakeSendGridServer(ThreadingHTTPServer):
+    """
+    Accepts v3 mail send requests and records them. Each personalization
+    counts as one delivered message.
+
+    With a `rate_limit`, requests for more messages per second than that
+    (allowing bursts of `burst`) are refused with a 429 and a Retry-After,
+    as SendGrid does; `throttled` counts them. Without `keep_requests`,
+    only the counts are kept.
+    """
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), rate_limit=None,
+                 burst=None, keep_requests=True):
+        super().__init__(address, FakeSendGridHandler)
+        self.lock = threading.Lock()
+        self.requests = []
+        self.keep_requests = keep_requests
+        self.request_count = 0
+        self.messages = 0
+        self.throttled = 0
+        self.limiter = TokenBucket(rate_limit, burst) if rate_limit else None
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return 'http://%s:%d' % (host, port)
+
+    def admit(self, messages):
+        """ Return 0 to accept `messages`, or the seconds to retry after. """
+        if self.limiter is None:
+            return 0
+        wait = self.limiter.reserve(min(max(messages, 1), self.limiter.burst))
+        if wait:
+            with self.lock:
+                self.throttled += 1
+        return wait
+
+    def record(self, data):
+        with self.lock:
+            if self.keep_requests:
+                self.requests.append(data)
+            self.request_count += 1
+            self.messages += len(data.get('personalizations', []))
+
+    def start(self):
+        """ Serve from a background thread. """
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
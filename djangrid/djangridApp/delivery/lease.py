@@ -0,0 +1,117 @@
+"""
+Leases on campaigns and tasks claimed by a queue worker, kept alive by a
+heartbeat so that the work of a crashed worker can be taken over by another.
+"""
+
+import datetime
+import logging
+import os
+import socket
+import threading
+import uuid
+
+from django.db import connection
+from django.utils.timezone import now
+from django.utils.translation import gettext
+
+from ..settings import newsletter_settings
+
+logger = logging.getLogger(__name__)
+
+
+def get_worker_id():
+    """ A name for this worker, unique across hosts and processes. """
+    return '%s:%d:%s' % (
+        socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8]
+    )
+
+
+def get_lease_expiry(duration=None):
+    if duration is None:
+        duration = newsletter_settings.LEASE_DURATION
+    return now() + datetime.timedelta(seconds=duration)
+
+
+class LeaseKeeper(object):
+    """
+    Renews the leases of the campaigns (or tasks) claimed by `owner` from a
+    background thread, every third of the lease duration, for as long as it
+    is entered. One whose lease was taken over by another worker (after
+    this one stalled for longer than the lease) is reported by `is_lost()`.
+    """
+
+    def __init__(self, campaigns, owner, duration=None):
+        if duration is None:
+            duration = newsletter_settings.LEASE_DURATION
+
+        self.owner = owner
+        self.duration = duration
+        self.model = None
+        self.pks = set()
+        self.lost = set()
+        for campaign in campaigns:
+            self.model = type(campaign)
+            self.pks.add(campaign.pk)
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        if self.pks:
+            self._thread = threading.Thread(
+                target=self._run, name='lease-heartbeat', daemon=True
+            )
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        try:
+            while not self._stop.wait(self.duration / 3):
+                try:
+                    self.renew()
+                except Exception:
+                    logger.exception(gettext('Error renewing leases.'))
+        finally:
+            # The thread has its own database connection.
+            connection.close()
+
+    def release(self, campaign):
+        """ Stop renewing the lease of `campaign` (or task). """
+        with self._lock:
+            self.pks.discard(campaign.pk)
+
+    def is_lost(self, campaign):
+        return campaign.pk in self.lost
+
+    def renew(self):
+        """ Extend the held leases; returns the number renewed. """
+        with self._lock:
+            pks = set(self.pks)
+        if not pks:
+            return 0
+
+        held = self.model.objects.filter(pk__in=pks, claimed_by=self.owner)
+        renewed = held.update(lease_expires=get_lease_expiry(self.duration))
+        if renewed < len(pks):
+            # Leases released by finish_submission() are simply dropped.
+            lost = set(self.model.objects.filter(
+                pk__in=pks
+            ).exclude(claimed_by__in=(self.owner, '')).values_list(
+                'pk', flat=True
+            ))
+            for pk in lost:
+                logger.error(
+                    gettext('Lost the lease on %(model)s %(pk)s to another '
+                            'worker.'),
+                    {'model': self.model._meta.verbose_name, 'pk': pk}
+                )
+            with self._lock:
+                self.pks -= pks - set(held.values_list('pk', flat=True))
+                self.lost |= lost
+        return renewed
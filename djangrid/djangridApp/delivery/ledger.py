@@ -0,0 +1,212 @@
+""" Bulk writes to the per-recipient delivery ledger of a campaign. """
+
+import datetime
+import random
+import threading
+
+from django.db.models import Count, F
+from django.utils.timezone import now
+
+from ..settings import newsletter_settings
+from ..signals import message_failed, messages_sent
+from ..utils import chunked
+from .window import WindowSchedule
+
+
+def get_message_id(message):
+    """
+    The provider message id of a sent EmailMessage: the id SendGrid
+    answered with when sent through its backend, otherwise our own
+    Message-ID header.
+    """
+    headers = message.extra_headers
+    return headers.get('message_id') or headers.get('Message-ID')
+
+
+def get_retry_delay(attempts):
+    """
+    Seconds to wait before retrying a delivery that failed `attempts`
+    times: exponential backoff with jitter, so that recipients who failed
+    together are not all retried at the same moment.
+    """
+    delay = min(
+        newsletter_settings.RETRY_BACKOFF * 2 ** (attempts - 1),
+        newsletter_settings.RETRY_BACKOFF_MAX
+    )
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def get_next_attempt(attempts, timestamp):
+    """ When to retry after `attempts` failures, or None to give up. """
+    if attempts >= newsletter_settings.RETRY_MAX_ATTEMPTS:
+        return None
+    return timestamp + datetime.timedelta(seconds=get_retry_delay(attempts))
+
+
+def queue_deliveries(campaign, batch_size=None):
+    """
+    Add a queued ledger row for every subscribed recipient of `campaign`
+    that has none yet, `batch_size` rows per INSERT. With a send window,
+    each row is given its scheduled time in the window. Returns the number
+    of rows added.
+    """
+    from ..models import Delivery
+
+    if batch_size is None:
+        batch_size = newsletter_settings.LEDGER_BATCH_SIZE
+
+    profiles = campaign.recipients.filter(unsubscribed=False).exclude(
+        _id__in=campaign.deliveries.values('profile')
+    )
+
+    schedule = None
+    if campaign.send_window:
+        schedule = WindowSchedule(campaign, dict(
+            profiles.values_list('time_zone').annotate(
+                count=Count('_id')
+            ).order_by()
+        ))
+
+    rows = profiles.values_list('_id', 'time_zone').order_by(
+        'time_zone', '_id'
+    ).iterator(chunk_size=batch_size)
+
+    queued = 0
+    for chunk in chunked(rows, batch_size):
+        Delivery.objects.bulk_create([
+            Delivery(
+                campaign=campaign, profile_id=pk,
+                scheduled=schedule and schedule.next(time_zone)
+            )
+            for pk, time_zone in chunk
+        ], ignore_conflicts=True)
+        queued += len(chunk)
+    return queued
+
+
+class DeliveryLedger(object):
+    """
+    Collects delivery outcomes for a campaign and writes them to its ledger
+    rows in bulk once `batch_size` are pending, and when closed. Senders in
+    a pool may share one ledger.
+
+    With `autoflush` off nothing is written until `flush()` is called, for
+    callers that must not touch the database from where outcomes arrive
+    (e.g. an event loop).
+    """
+
+    def __init__(self, campaign, batch_size=None, autoflush=True):
+        if batch_size is None:
+            batch_size = newsletter_settings.LEDGER_BATCH_SIZE
+
+        self.campaign = campaign
+        self.batch_size = max(int(batch_size), 1)
+        self.autoflush = autoflush
+        self._sent = []
+        self._failed = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        # Record what did go out, even when the submission failed.
+        self.flush()
+
+    @property
+    def pending(self):
+        return len(self._sent) + len(self._failed)
+
+    def is_full(self):
+        return self.pending >= self.batch_size
+
+    def record_sent(self, recipients, message_id=None):
+        """ Record `recipients` as sent with one provider message id. """
+        with self._lock:
+            self._sent.extend(
+                (recipient.pk, message_id) for recipient in recipients
+            )
+        messages_sent.send(
+            sender=self.campaign, recipients=recipients,
+            message_id=message_id
+        )
+        self._autoflush()
+
+    def record_failed(self, recipient, error=None):
+        with self._lock:
+            self._failed.append((recipient.pk, str(error or '')))
+        message_failed.send(
+            sender=self.campaign, recipient=recipient, error=error
+        )
+        self._autoflush()
+
+    def _autoflush(self):
+        if self.autoflush and self.is_full():
+            self.flush()
+
+    def flush(self):
+        """ Write all pending outcomes. """
+        from ..models import Delivery
+
+        with self._lock:
+            sent, self._sent = self._sent, []
+            failed, self._failed = self._failed, []
+
+        timestamp = now()
+        deliveries = Delivery.objects.filter(campaign=self.campaign)
+
+        if failed:
+            self.write_failed(deliveries, dict(failed), timestamp)
+        if sent:
+            self.write_sent(deliveries, dict(sent), timestamp)
+        if sent or failed:
+            self.campaign.update_progress(len(sent), len(failed), timestamp)
+
+    def write_sent(self, deliveries, message_ids, timestamp):
+        from ..models import Delivery
+
+        values = {
+            'status': Delivery.SENT,
+            'updated': timestamp,
+            'attempts': F('attempts') + 1,
+            'next_attempt': None,
+            'error': '',
+        }
+        if len(set(message_ids.values())) == 1:
+            # One request for all of them, e.g. a personalizations batch.
+            deliveries.filter(profile__in=message_ids).update(
+                message_id=next(iter(message_ids.values())), **values
+            )
+            return
+
+        rows = list(
+            deliveries.filter(profile__in=message_ids).only('profile')
+        )
+        for row in rows:
+            for field, value in values.items():
+                setattr(row, field, value)
+            row.message_id = message_ids[row.profile_id]
+        Delivery.objects.bulk_update(
+            rows, list(values) + ['message_id'], batch_size=self.batch_size
+        )
+
+    def write_failed(self, deliveries, errors, timestamp):
+        """
+        Mark deliveries failed and schedule their retry, unless they ran
+        out of attempts.
+        """
+        from ..models import Delivery
+
+        rows = list(
+            deliveries.filter(profile__in=errors).only('profile', 'attempts')
+        )
+        for row in rows:
+            row.status = Delivery.FAILED
+            row.updated = timestamp
+            row.attempts += 1
+            row.next_attempt = get_next_attempt(row.attempts, timestamp)
+            row.error = errors[row.profile_id]
+        Delivery.objects.bulk_update(
+            rows, ['status', 'updated', 'attempts', 'next_attempt', 'error'],
+            batch_size=self.batch_size
+        )
@@ -0,0 +1,110 @@
+"""
+Campaign-level MIME skeleton: the headers and boundaries shared by every
+message of a submission, prepared once and patched into each message.
+"""
+
+import random
+import sys
+from email.utils import formatdate
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives
+from django.core.mail.message import (
+    SafeMIMEText, forbid_multi_line_headers, make_msgid
+)
+from django.core.mail.utils import DNS_NAME
+from django.utils.encoding import force_str
+
+
+def make_boundary():
+    """ A random MIME boundary, as the email package makes them. """
+    return '=' * 15 + '%019d' % random.randrange(sys.maxsize) + '=='
+
+
+class MessageSkeleton(object):
+    """
+    The parts of a campaign's messages that do not depend on the recipient,
+    built once per submission: the encoded Subject and From headers and the
+    multipart boundaries.
+
+    Without preset boundaries, generating each message would scan all of it,
+    attachments included, for a boundary that does not occur in it. The
+    attachments themselves are encoded once by `AttachmentCache`, and are
+    base64, which cannot contain a boundary line.
+    """
+
+    def __init__(self, subject, from_email, encoding=None):
+        self.subject = subject
+        self.from_email = from_email
+        self.encoding = encoding or settings.DEFAULT_CHARSET
+        self.headers = [
+            forbid_multi_line_headers('Subject', subject, self.encoding),
+            forbid_multi_line_headers('From', from_email, self.encoding),
+        ]
+        # One boundary per multipart level (mixed and alternative).
+        self.boundaries = [make_boundary(), make_boundary()]
+
+    def set_headers(self, msg):
+        for name, value in self.headers:
+            msg.set_raw(name, value)
+
+    def set_boundaries(self, msg, texts):
+        """
+        Set the preset boundaries on the multipart parts of `msg`, unless
+        one of the personalized `texts` happens to contain them, in which
+        case the generator picks its own.
+        """
+        if any(boundary in text for boundary in self.boundaries
+               for text in texts):
+            return
+        boundaries = iter(self.boundaries)
+        for part in msg.walk():
+            if part.is_multipart():
+                part.set_boundary(next(boundaries))
+
+
+class SkeletonMessage(EmailMultiAlternatives):
+    """
+    An EmailMultiAlternatives that builds its MIME message around a
+    `MessageSkeleton`: only the To header and the body parts are encoded
+    per message. The result is the same as Django's apart from the shared
+    boundaries.
+
+    The message keeps all the usual attributes, so backends that do not
+    call `message()` (e.g. the SendGrid backend) send it as before.
+    """
+
+    def __init__(self, *args, skeleton, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.skeleton = skeleton
+
+    def message(self):
+        skeleton = self.skeleton
+        encoding = self.encoding or settings.DEFAULT_CHARSET
+        if (self.subject != skeleton.subject or
+                self.from_email != skeleton.from_email or
+                encoding != skeleton.encoding or self.cc or self.reply_to or
+                'From' in self.extra_headers):
+            # Not what the skeleton was made for.
+            return super().message()
+
+        msg = SafeMIMEText(self.body, self.content_subtype, encoding)
+        msg = self._create_message(msg)
+        skeleton.set_headers(msg)
+        self._set_list_header_if_not_empty(msg, 'To', self.to)
+
+        header_names = [key.lower() for key in self.extra_headers]
+        if 'date' not in header_names:
+            msg['Date'] = formatdate(localtime=settings.EMAIL_USE_LOCALTIME)
+        if 'message-id' not in header_names:
+            msg['Message-ID'] = make_msgid(domain=DNS_NAME)
+        for name, value in self.extra_headers.items():
+            if name.lower() != 'from':
+                msg[name] = value
+
+        if msg.is_multipart():
+            texts = [self.body] + [
+                force_str(content) for content, mimetype in self.alternatives
+            ]
+            skeleton.set_boundaries(msg, texts)
+        return msg
@@ -0,0 +1,129 @@
+""" Concurrent delivery through a pool of sender threads. """
+
+import logging
+import queue
+import threading
+
+from django.db import connections
+
+from ..settings import newsletter_settings
+from .connection import BatchSender
+
+logger = logging.getLogger(__name__)
+
+# Put on the queue once per worker to make it flush and stop.
+STOP = object()
+# Put on the queue once per worker to make it flush its batch.
+FLUSH = object()
+
+
+class ThreadPoolSender(object):
+    """
+    Fans queued items out to `workers` threads, each with a sender of its
+    own from `sender_factory` (e.g. a `BatchSender` with its own backend
+    connection). Senders typically share one rate limiter, so the pool as a
+    whole sends at the configured rate.
+
+    Items are handed over through a bounded queue, so the producer blocks
+    rather than rendering far ahead of the senders.
+    """
+
+    def __init__(self, sender_factory, workers, queue_size=None):
+        self.sender_factory = sender_factory
+        self.workers = max(int(workers), 1)
+        if queue_size is None:
+            queue_size = self.workers * newsletter_settings.SEND_BATCH_SIZE * 2
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.senders = []
+        self.error = None
+        self._threads = []
+        self._lock = threading.Lock()
+
+    @property
+    def sent(self):
+        return sum(sender.sent for sender in self.senders)
+
+    @property
+    def failed(self):
+        return sum(sender.failed for sender in self.senders)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+        if exc_info[0] is None and self.error is not None:
+            raise self.error
+
+    def start(self):
+        for i in range(self.workers):
+            sender = self.sender_factory()
+            self.senders.append(sender)
+            thread = threading.Thread(
+                target=self.run, args=(sender,),
+                name='newsletter-sender-%d' % i, daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        for thread in self._threads:
+            self.queue.put(STOP)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def add(self, item, recipient):
+        if self.error is not None:
+            raise self.error
+        self.queue.put((item, recipient))
+
+    def flush(self):
+        """
+        Ask the workers to send their partial batches, e.g. before the
+        producer pauses. Workers always flush when stopped.
+        """
+        for thread in self._threads:
+            self.queue.put(FLUSH)
+
+    def run(self, sender):
+        try:
+            with sender:
+                while True:
+                    item = self.queue.get()
+                    if item is STOP:
+                        break
+                    if item is FLUSH:
+                        sender.flush()
+                        continue
+                    sender.add(*item)
+        except Exception as e:
+            logger.exception('Sender thread failed.')
+            with self._lock:
+                if self.error is None:
+                    self.error = e
+            # Keep draining so the producer never blocks on a full queue.
+            while self.queue.get() is not STOP:
+                pass
+        finally:
+            # Database connections are per thread, close this one's.
+            connections.close_all()
+
+
+def make_sender(limiter=None, workers=None, sender_factory=None,
+                ledger=None):
+    """
+    Return a sender for a submission: a single `BatchSender`, or a
+    `ThreadPoolSender` when NEWSLETTER_SEND_WORKERS (or `workers`) is more
+    than one.
+    """
+    if workers is None:
+        workers = newsletter_settings.SEND_WORKERS
+    if sender_factory is None:
+        def sender_factory():
+            return BatchSender(limiter=limiter, ledger=ledger)
+
+    if workers > 1:
+        return ThreadPoolSender(sender_factory, workers)
+    return sender_factory()
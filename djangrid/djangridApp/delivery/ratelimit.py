@@ -0,0 +1,235 @@
+""" Send rate limiting shared between delivery workers. """
+
+import asyncio
+import logging
+import smtplib
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+from django.conf import settings
+from django.utils.timezone import now
+from django.utils.translation import gettext
+
+from ..settings import newsletter_settings
+
+logger = logging.getLogger(__name__)
+
+# HTTP statuses telling us to slow down: too many requests, and the
+# provider being overloaded or unavailable.
+THROTTLE_STATUSES = (429, 500, 502, 503, 504)
+
+
+def parse_retry_after(value):
+    """ Seconds to wait from a Retry-After header, or None. """
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max((parsedate_to_datetime(value) - now()).total_seconds(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def get_throttle(error):
+    """
+    Tell whether a send error means the provider is throttling us: an HTTP
+    429 or 5xx answer from the SendGrid API, or an SMTP 4xx (transient)
+    reply. Returns a (throttled, retry_after) tuple, `retry_after` being
+    the seconds the provider asked us to wait, if it did.
+    """
+    status = getattr(error, 'status_code', None) or getattr(error, 'status', None)
+    if isinstance(status, int):
+        if status not in THROTTLE_STATUSES:
+            return False, None
+        headers = getattr(error, 'headers', None) or {}
+        return True, parse_retry_after(
+            headers.get('Retry-After') or headers.get('retry-after')
+        )
+
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500, None
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return any(
+            400 <= code < 500 for code, message in error.recipients.values()
+        ), None
+    return False, None
+
+
+class TokenBucket(object):
+    """
+    Thread-safe token bucket: tokens refill at `rate` per second up to
+    `burst`, and every message sent takes one.
+    """
+
+    def __init__(self, rate, burst=None, clock=time.monotonic,
+                 sleep=time.sleep):
+        assert rate > 0, 'Rate must be positive.'
+        self.rate = float(rate)
+        self.burst = max(float(burst or rate), 1.0)
+        self.tokens = self.burst
+        self._clock = clock
+        self._sleep = sleep
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = max(now - self._updated, 0)
+        self.tokens = min(self.tokens + elapsed * self.rate, self.burst)
+        self._updated = now
+
+    def reserve(self, tokens):
+        """
+        Take `tokens` if they are available and return 0, otherwise take
+        nothing and return the seconds to wait before trying again.
+        `tokens` must not exceed the burst size.
+        """
+        with self._lock:
+            self._refill(self._clock())
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return 0
+            return (tokens - self.tokens) / self.rate
+
+    def chunks(self, tokens):
+        """ Split a request into burst-sized chunks. """
+        while tokens > 0:
+            chunk = min(tokens, self.burst)
+            yield chunk
+            tokens -= chunk
+
+    def acquire(self, tokens=1):
+        """
+        Block until `tokens` are available and take them. Requests larger
+        than the burst size are served in burst-sized chunks.
+        """
+        for chunk in self.chunks(tokens):
+            wait = self.reserve(chunk)
+            while wait:
+                self._sleep(wait)
+                wait = self.reserve(chunk)
+
+    async def aacquire(self, tokens=1):
+        """ Like `acquire()`, but waits without blocking the event loop. """
+        for chunk in self.chunks(tokens):
+            wait = self.reserve(chunk)
+            while wait:
+                await asyncio.sleep(wait)
+                wait = self.reserve(chunk)
+
+    def on_success(self, count=1):
+        """ Called by senders after `count` messages were accepted. """
+
+    def on_error(self, error):
+        """ Called by senders when a send failed with `error`. """
+
+
+class AdaptiveTokenBucket(TokenBucket):
+    """
+    Token bucket whose rate follows the provider's feedback (AIMD): it
+    grows by `increase` messages per second for every second's worth of
+    accepted messages, up to `max_rate`, and is multiplied by `decrease`,
+    down to `min_rate`, when the provider throttles us. A Retry-After
+    from the provider pauses sending for that long.
+
+    Throttling errors typically arrive in bursts from messages that were
+    already in flight, so the rate is lowered at most once per `cooldown`
+    seconds.
+    """
+
+    def __init__(self, rate, burst=None, min_rate=1, max_rate=None,
+                 increase=1, decrease=0.5, cooldown=1.0,
+                 clock=time.monotonic, sleep=time.sleep):
+        super().__init__(rate, burst, clock, sleep)
+        self.min_rate = float(min_rate)
+        self.max_rate = float(max_rate) if max_rate else None
+        self.increase = float(increase)
+        self.decrease = float(decrease)
+        self.cooldown = cooldown
+        self.throttled = 0
+        self._paused_until = None
+        self._decreased = None
+
+    def reserve(self, tokens):
+        with self._lock:
+            if self._paused_until is not None:
+                wait = self._paused_until - self._clock()
+                if wait > 0:
+                    return wait
+                self._paused_until = None
+                self._updated = self._clock()
+        return super().reserve(tokens)
+
+    def set_rate(self, rate):
+        with self._lock:
+            self._refill(self._clock())
+            if self.max_rate is not None:
+                rate = min(rate, self.max_rate)
+            self.rate = max(rate, self.min_rate)
+
+    def on_success(self, count=1):
+        self.set_rate(self.rate + self.increase * count / self.rate)
+
+    def on_error(self, error):
+        throttled, retry_after = get_throttle(error)
+        if not throttled:
+            return
+
+        with self._lock:
+            current = self._clock()
+            self.throttled += 1
+            if retry_after:
+                self._paused_until = max(
+                    self._paused_until or current, current + retry_after
+                )
+                self.tokens = 0
+            if self._decreased is not None and \
+                    current - self._decreased < self.cooldown:
+                return
+            self._decreased = current
+
+        self.set_rate(self.rate * self.decrease)
+        logger.info(
+            gettext('Throttled by the provider, send rate lowered to '
+                    '%(rate).1f/s.'),
+            {'rate': self.rate}
+        )
+
+
+def get_rate_limiter(share=1):
+    """
+    Return a token bucket for the NEWSLETTER_SEND_RATE and
+    NEWSLETTER_SEND_BURST settings, or None when sending is unlimited.
+    Processes sending the same campaign each get a 1/`share` part of it.
+
+    When no rate is set, the rate implied by the legacy
+    NEWSLETTER_EMAIL_DELAY setting is used.
+
+    With NEWSLETTER_ADAPTIVE_RATE, an `AdaptiveTokenBucket` starts at that
+    rate (or NEWSLETTER_SEND_RATE_MIN) and adapts it between
+    NEWSLETTER_SEND_RATE_MIN and NEWSLETTER_SEND_RATE_MAX.
+    """
+    rate = newsletter_settings.SEND_RATE
+    if rate is None:
+        delay = getattr(settings, 'NEWSLETTER_EMAIL_DELAY', None)
+        if delay:
+            rate = 1.0 / delay
+
+    if newsletter_settings.ADAPTIVE_RATE:
+        min_rate = newsletter_settings.SEND_RATE_MIN
+        max_rate = newsletter_settings.SEND_RATE_MAX
+        rate = rate or min_rate
+        burst = newsletter_settings.SEND_BURST or rate
+        return AdaptiveTokenBucket(
+            rate / share, burst / share, min_rate=min_rate / share,
+            max_rate=max_rate and max_rate / share,
+            increase=newsletter_settings.SEND_RATE_INCREASE / share
+        )
+
+    if not rate:
+        return None
+    burst = newsletter_settings.SEND_BURST or rate
+    return TokenBucket(rate / share, burst / share)
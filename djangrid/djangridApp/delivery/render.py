@@ -0,0 +1,223 @@
+""" Per-campaign rendering of newsletter messages. """
+
+import functools
+import itertools
+import logging
+import time
+
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.template import Context, engines
+from django.template.base import TextNode, VariableNode, render_value_in_context
+from django.utils.translation import gettext
+
+from ..settings import newsletter_settings
+from ..signals import message_rendered
+from ..tokens import make_token
+from .attachments import AttachmentCache
+from .mime import MessageSkeleton
+from .sendgrid import SUBSTITUTION_TAGS, get_substitutions
+
+logger = logging.getLogger(__name__)
+
+
+class SimpleTemplate(object):
+    """
+    A template of only text and plain `{{ variable }}` nodes, pre-split into
+    static fragments and variable slots so that rendering it is a string
+    join. The output is the same as the Django template it was compiled
+    from: values are localized and autoescaped the same way, and missing
+    variables render as an empty string.
+    """
+
+    def __init__(self, fragments, names, autoescape=True):
+        assert len(fragments) == len(names) + 1
+        self.fragments = fragments
+        self.names = names
+        self.context = Context(autoescape=autoescape)
+
+    @classmethod
+    def compile(cls, template):
+        """
+        Return a SimpleTemplate for a template from the Django engine, or
+        None when it uses tags, filters, attribute lookups or anything else
+        that needs the template engine.
+        """
+        template = getattr(template, 'template', template)
+        engine = template.engine
+        if engine.string_if_invalid:
+            return None
+
+        fragments = ['']
+        names = []
+        for node in template.nodelist:
+            if type(node) is TextNode:
+                fragments[-1] += node.s
+            elif type(node) is VariableNode:
+                expression = node.filter_expression
+                var = expression.var
+                if (expression.filters or not hasattr(var, 'lookups') or
+                        var.lookups is None or len(var.lookups) != 1 or
+                        var.translate):
+                    return None
+                names.append(var.lookups[0])
+                fragments.append('')
+            else:
+                return None
+
+        return cls(fragments, names, engine.autoescape)
+
+    def render(self, context):
+        values = [
+            render_value_in_context(context.get(name, ''), self.context)
+            for name in self.names
+        ]
+        return ''.join(
+            itertools.chain.from_iterable(zip(self.fragments, values))
+        ) + self.fragments[-1]
+
+
+class RenderPlan(object):
+    """
+    Everything needed to render a campaign message that does not depend on
+    the recipient: the compiled templates, the static part of the template
+    context and the unsubscribe URL prefix. Unsubscribe URLs carry a signed
+    token for the recipient (see `tokens`) rather than their address.
+
+    A plan is built once per submission so that the newsletter body is only
+    parsed, and the attachments only read and encoded, once however many
+    recipients the campaign has. Call `close()` when the submission is done.
+
+    The uploaded newsletter body only depends on the recipient's first
+    name, so its renders are kept in an LRU cache of
+    NEWSLETTER_RENDER_CACHE_SIZE entries; see `cache_info()`. Bodies with
+    nothing but text and plain variables skip the template engine
+    altogether, see `SimpleTemplate`.
+    """
+
+    def __init__(self, campaign, abs_uri):
+        self.campaign = campaign
+        self.subject = campaign.emailmsg.subject.strip()
+        self.contents = campaign.emailmsg.contents.read().decode('utf-8')
+        self.sender = campaign.get_sender()
+
+        self.body_template = engines['django'].from_string(self.contents)
+        self.simple_body_template = SimpleTemplate.compile(self.body_template)
+        (self.subject_template, self.text_template, self.html_template) = \
+            campaign.get_templates('message')
+
+        self.base_context = {
+            'site': Site.objects.get_current(),
+            'campaign': campaign,
+            'subject': self.subject,
+            'message': campaign.emailmsg,
+            'contents': self.contents,
+            'date': campaign.publish_date,
+            'STATIC_URL': settings.STATIC_URL,
+            'MEDIA_URL': settings.MEDIA_URL,
+        }
+        self.unsub_prefix = '%s?token=' % abs_uri
+        self.attachments = AttachmentCache(campaign.emailmsg.attachments.all())
+        self.skeleton = MessageSkeleton(self.subject, self.sender)
+        self._render_template = functools.lru_cache(
+            maxsize=newsletter_settings.RENDER_CACHE_SIZE
+        )(self._render_template)
+
+    def close(self):
+        info = self.cache_info()
+        logger.debug(
+            gettext('Render cache for %(campaign)s: %(hits)d hits, '
+                    '%(misses)d misses.'),
+            {'campaign': self.campaign, 'hits': info.hits,
+             'misses': info.misses}
+        )
+        self.attachments.close()
+
+    def cache_info(self):
+        """ Hit and miss counters of the body render cache. """
+        return self._render_template.cache_info()
+
+    def get_unsubscribe_url(self, recipient):
+        return self.unsub_prefix + make_token(recipient.pk, 'unsubscribe')
+
+    def get_context(self, recipient, first_name, unsub_url):
+        """ Template context for the text and library HTML templates. """
+        context = self.base_context.copy()
+        context['recipient'] = recipient
+        context['unsub_url'] = unsub_url
+        context['first_name'] = first_name
+        return context
+
+    def render_body(self, first_name, unsub_url):
+        """ Render the uploaded newsletter HTML with the unsubscribe footer. """
+        html_body = self._render_template(
+            (('first_name', first_name),)
+        )
+        return html_body + (
+            '<br><br><br><small><a href="{}">Unsubscribe</a><small>'
+        ).format(unsub_url)
+
+    def _render_template(self, context):
+        """
+        Render the body for a personalization context given as a tuple of
+        items, which is what the render cache is keyed on.
+        """
+        if self.simple_body_template is not None:
+            return self.simple_body_template.render(dict(context))
+        return self.body_template.render(context=dict(context), request=None)
+
+    def render(self, recipient):
+        """
+        Return a (plaintext, html_content) tuple for a recipient, either of
+        which may be None when the campaign does not send that version.
+        """
+        started = time.perf_counter()
+        rendered = self._render(
+            recipient, recipient.first_name,
+            self.get_unsubscribe_url(recipient)
+        )
+        message_rendered.send(
+            sender=self.campaign, recipient=recipient,
+            duration=time.perf_counter() - started
+        )
+        return rendered
+
+    def render_tagged(self):
+        """
+        Render the (plaintext, html_content) tuple once for all recipients,
+        with SendGrid substitution tags in place of the first name and the
+        unsubscribe URL. Templates cannot use other recipient fields here.
+        """
+        return self._render(
+            None, SUBSTITUTION_TAGS['first_name'],
+            SUBSTITUTION_TAGS['unsub_url']
+        )
+
+    def get_substitutions(self, recipient):
+        started = time.perf_counter()
+        substitutions = get_substitutions(
+            recipient.first_name, self.get_unsubscribe_url(recipient)
+        )
+        message_rendered.send(
+            sender=self.campaign, recipient=recipient,
+            duration=time.perf_counter() - started
+        )
+        return substitutions
+
+    def _render(self, recipient, first_name, unsub_url):
+        campaign = self.campaign
+        plaintext = html_content = None
+
+        if campaign.send_plain:
+            context = self.get_context(recipient, first_name, unsub_url)
+            plaintext = self.text_template.render(context)
+
+            if campaign.send_html:
+                if campaign.use_template:
+                    html_content = self.html_template.render(context)
+                else:
+                    html_content = self.render_body(first_name, unsub_url)
+        else:
+            html_content = self.render_body(first_name, unsub_url)
+
+        return plaintext, html_content
@@ -0,0 +1,158 @@
+""" Fair interleaving of several campaigns under one send rate. """
+
+import contextlib
+import heapq
+import logging
+
+from django.utils.translation import gettext
+
+from .ledger import DeliveryLedger
+
+logger = logging.getLogger(__name__)
+
+
+class CampaignStream(object):
+    """
+    A campaign being submitted by a `FairScheduler`: its render plan,
+    recipient iterator, delivery ledger and sender, and its send window if
+    it has one.
+    """
+
+    def __init__(self, campaign, mode, limiter=None):
+        self.campaign = campaign
+        self.mode = mode
+        self.weight = max(campaign.priority, 1)
+        self.sent = self.failed = 0
+        self.window = campaign.get_send_window()
+        self._next = None
+        self._stack = contextlib.ExitStack()
+
+        recipients, abs_uri = campaign.prepare_submission()
+        try:
+            self.plan = campaign.get_render_plan(abs_uri)
+            self._stack.callback(self.plan.close)
+            self.recipients = campaign.stream_recipients(recipients)
+            if self.window is not None:
+                self.recipients = self.window.track(self.recipients)
+            self.ledger = self._stack.enter_context(DeliveryLedger(campaign))
+            self.sender = self._stack.enter_context(
+                campaign.open_sender(self.plan, mode, limiter, self.ledger)
+            )
+        except BaseException:
+            self._stack.close()
+            campaign.finish_submission()
+            raise
+
+    def has_next(self):
+        """ Whether a recipient is left to send to in this pass. """
+        if self._next is None:
+            self._next = next(self.recipients, None)
+        return self._next is not None
+
+    def send_next(self):
+        """ Queue the next recipient, as found by `has_next()`. """
+        recipient, self._next = self._next, None
+        self.campaign.add_recipient(
+            recipient, self.plan, self.mode, self.sender
+        )
+
+    def close(self, completed):
+        """
+        Flush the sender and ledger. The campaign is marked sent when all
+        recipients were `completed`.
+        """
+        campaign = self.campaign
+        try:
+            self._stack.close()
+            self.sent, self.failed = self.sender.sent, self.sender.failed
+            if completed:
+                campaign.sent = True
+        finally:
+            campaign.finish_submission()
+
+        if self.window is not None:
+            self.window.report()
+
+        logger.info(
+            gettext('Submitted %(campaign)s: %(sent)d sent, %(failed)d '
+                    'failed'),
+            {'campaign': campaign, 'sent': self.sent, 'failed': self.failed}
+        )
+
+
+class FairScheduler(object):
+    """
+    Submits several campaigns at once, interleaving their messages by
+    weighted fair queuing, with all senders sharing one rate limiter.
+
+    Every message advances its campaign's virtual time by 1/priority and
+    the next message always comes from the campaign that is furthest
+    behind. So a small campaign is done after a few rounds instead of
+    waiting for a large one to finish, and large campaigns progress at
+    shares of the rate proportional to their priorities.
+
+    A campaign with a send window is done once the recipients due so far
+    were sent to; its next pass is submitted when more are due.
+
+    With a `LeaseKeeper` for claimed campaigns, a campaign whose lease was
+    lost to another worker is dropped, and the lease of a finished one is
+    released.
+    """
+
+    def __init__(self, campaigns, mode, limiter=None, leases=None):
+        self.campaigns = list(campaigns)
+        self.mode = mode
+        self.limiter = limiter
+        self.leases = leases
+
+    def close(self, stream, completed):
+        if self.leases is not None:
+            self.leases.release(stream.campaign)
+        stream.close(completed)
+
+    def run(self):
+        heap = []
+        for index, campaign in enumerate(self.campaigns):
+            try:
+                stream = CampaignStream(campaign, self.mode, self.limiter)
+            except Exception:
+                logger.exception(
+                    gettext('Error starting submission of %s.'), campaign
+                )
+                continue
+            heap.append((0.0, index, stream))
+
+        leases = self.leases
+        heapq.heapify(heap)
+
+        try:
+            while heap:
+                vtime, index, stream = heap[0]
+                if leases is not None and leases.is_lost(stream.campaign):
+                    heapq.heappop(heap)
+                    self.close(stream, completed=False)
+                    continue
+
+                try:
+                    pending = stream.has_next()
+                    if pending:
+                        stream.send_next()
+                except Exception:
+                    logger.exception(
+                        gettext('Error submitting %s.'), stream.campaign
+                    )
+                    heapq.heappop(heap)
+                    self.close(stream, completed=False)
+                    continue
+
+                if pending:
+                    heapq.heapreplace(
+                        heap, (vtime + 1.0 / stream.weight, index, stream)
+                    )
+                else:
+                    heapq.heappop(heap)
+                    self.close(stream, completed=True)
+        finally:
+            # Interrupted: flush what was queued and release the rest.
+            for vtime, index, stream in heap:
+                self.close(stream, completed=False)
@@ -0,0 +1,188 @@
+"""
+SendGrid personalizations delivery: one v3 Mail request carries up to 1000
+recipients, each with their own substitutions.
+"""
+
+import logging
+
+from django.conf import settings
+from django.utils.html import escape
+from django.utils.translation import gettext
+from sendgrid import SendGridAPIClient
+from sendgrid.helpers.mail import (
+    Attachment, Disposition, FileContent, FileName, FileType, Mail
+)
+
+from ..settings import newsletter_settings
+
+logger = logging.getLogger(__name__)
+
+# SendGrid rejects requests with more personalizations than this.
+MAX_PERSONALIZATIONS = 1000
+
+# Substitution tags rendered into the shared body in place of the
+# recipient-specific values.
+SUBSTITUTION_TAGS = {
+    'first_name': '-first_name-',
+    'unsub_url': '-unsub_url-',
+}
+
+
+def get_client():
+    return SendGridAPIClient(
+        api_key=settings.SENDGRID_API_KEY,
+        host=newsletter_settings.SENDGRID_API_HOST
+    )
+
+
+def get_substitutions(first_name, unsub_url):
+    """
+    Substitution values for a recipient. They are escaped here since
+    SendGrid inserts them verbatim, where the template engine would have
+    autoescaped them.
+    """
+    return {
+        SUBSTITUTION_TAGS['first_name']: escape(first_name or ''),
+        SUBSTITUTION_TAGS['unsub_url']: escape(unsub_url),
+    }
+
+
+def make_personalization(email, name, substitutions=None):
+    to = {'email': email}
+    if name:
+        to['name'] = name
+    personalization = {'to': [to]}
+    if substitutions:
+        personalization['substitutions'] = substitutions
+    return personalization
+
+
+def make_base_body(from_email, subject, plaintext=None, html_content=None,
+                   attachments=()):
+    """
+    Return the v3 Mail request body shared by all recipients, without
+    personalizations.
+    """
+    mail = Mail(
+        from_email=from_email,
+        subject=subject,
+        plain_text_content=plaintext,
+        html_content=html_content,
+    )
+    for part in attachments:
+        mail.add_attachment(make_attachment(part))
+    return mail.get()
+
+
+def make_content(plaintext=None, html_content=None):
+    """ The `content` of a request body; SendGrid wants text/plain first. """
+    content = []
+    if plaintext is not None:
+        content.append({'type': 'text/plain', 'value': plaintext})
+    if html_content is not None:
+        content.append({'type': 'text/html', 'value': html_content})
+    return content
+
+
+def make_attachment(part):
+    """ Convert a cached MIME part into a SendGrid attachment. """
+    return Attachment(
+        FileContent(part.get_payload().replace('\n', '')),
+        FileName(part.get_filename()),
+        FileType(part.get_content_type()),
+        Disposition('attachment')
+    )
+
+
+class PersonalizationSender(object):
+    """
+    Groups recipients into personalization batches and sends each batch as
+    a single v3 Mail request built around a body rendered once with
+    substitution tags.
+
+    Mirrors the `add()`/`flush()` interface of `BatchSender`, with a
+    personalization dict taking the place of the message.
+    """
+
+    def __init__(self, from_email, subject, plaintext=None, html_content=None,
+                 attachments=(), client=None, batch_size=None, limiter=None,
+                 ledger=None):
+        if client is None:
+            client = get_client()
+        if batch_size is None:
+            batch_size = newsletter_settings.PERSONALIZATIONS_PER_REQUEST
+
+        self.client = client
+        self.batch_size = min(max(int(batch_size), 1), MAX_PERSONALIZATIONS)
+        self.limiter = limiter
+        self.ledger = ledger
+        self.sent = 0
+        self.failed = 0
+        self._pending = []
+
+        self.base_body = make_base_body(
+            from_email, subject, plaintext, html_content, attachments
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if exc_info[0] is None:
+            self.flush()
+
+    def add(self, personalization, recipient):
+        """ Queue a personalization, sending the batch once it is full. """
+        self._pending.append((personalization, recipient))
+
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """ Send all queued personalizations in one request. """
+        pending, self._pending = self._pending, []
+        if not pending:
+            return
+
+        body = dict(self.base_body)
+        body['personalizations'] = [p for p, recipient in pending]
+
+        if self.limiter is not None:
+            self.limiter.acquire(len(pending))
+
+        try:
+            response = self.client.client.mail.send.post(request_body=body)
+        except Exception as e:
+            if self.limiter is not None:
+                self.limiter.on_error(e)
+            for item in pending:
+                self.on_failed(item, e)
+        else:
+            self.on_sent(pending, response)
+
+    def on_sent(self, sent, response):
+        message_id = response.headers.get('X-Message-Id')
+        self.sent += len(sent)
+        if self.limiter is not None:
+            self.limiter.on_success(len(sent))
+        if self.ledger is not None:
+            self.ledger.record_sent(
+                [recipient for p, recipient in sent], message_id
+            )
+        logger.debug(
+            gettext('Submitted %(count)d personalizations, '
+                    'message id %(message_id)s.'),
+            {'count': len(sent), 'message_id': message_id}
+        )
+
+    def on_failed(self, item, error):
+        personalization, recipient = item
+        self.failed += 1
+        if self.ledger is not None:
+            self.ledger.record_failed(recipient, error)
+        logger.error(
+            gettext('Message %(recipients)s failed '
+                    'with error: %(error)s'),
+            {'recipients': recipient,
+             'error': getattr(error, 'body', None) or error}
+        )
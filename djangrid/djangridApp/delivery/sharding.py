@@ -0,0 +1,178 @@
+""" Delivery of one campaign sharded across worker processes. """
+
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django.db import connections
+from django.db.models.functions import Mod
+from django.utils.module_loading import import_string
+from django.utils.translation import gettext
+
+logger = logging.getLogger(__name__)
+
+
+def get_shard(recipients, index, count):
+    """ The recipients whose id modulo `count` is `index`. """
+    return recipients.annotate(shard=Mod('_id', count)).filter(shard=index)
+
+
+def get_mp_context():
+    """
+    The multiprocessing context worker processes are started from. Forking
+    a process with threads running, such as a metrics server or a lease
+    keeper, may leave locks held in the child forever, so workers are
+    started from a fork server where available, otherwise spawned. Either
+    way the modules their targets are unpickled from must be importable
+    before Django is set up.
+    """
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
+
+def get_database_names():
+    """ The database name of every connection, to pass to `setup_worker`. """
+    return {
+        alias: connections[alias].settings_dict['NAME']
+        for alias in connections
+    }
+
+
+def setup_worker(databases=None):
+    """
+    Worker process initializer. Workers import the settings afresh, so
+    `databases`, as returned by `get_database_names()`, points them at the
+    same databases as their parent, e.g. a test database.
+    """
+    import django
+    from django.apps import apps
+
+    if not apps.ready:
+        django.setup()
+    for alias, name in (databases or {}).items():
+        connections[alias].settings_dict['NAME'] = name
+    # Never share the parent's database connections.
+    connections.close_all()
+
+
+def bootstrap(target, databases, *args):
+    """
+    Worker process target: set up Django, then call `target`, given as a
+    dotted path since its module may only be imported once Django is.
+    """
+    setup_worker(databases)
+    import_string(target)(*args)
+
+
+def deliver_shard(campaign_id, index, count, abs_uri, mode, engine,
+                  collect_metrics=False):
+    """
+    Render and send one shard of a campaign. Runs in a worker process and
+    returns a (sent, failed, metrics) tuple, where metrics are the
+    `CampaignMetrics` of the shard when `collect_metrics` is set.
+    """
+    from ..metrics import metrics
+    from ..models import Campaign
+    from .ratelimit import get_rate_limiter
+
+    if collect_metrics:
+        metrics.connect()
+        # Only report this shard, not what the process sent before.
+        metrics.clear()
+
+    campaign = Campaign.objects.get(pk=campaign_id)
+    recipients = get_shard(campaign.get_recipient_queryset(), index, count)
+    plan = campaign.get_render_plan(abs_uri)
+    limiter = get_rate_limiter(share=count)
+
+    try:
+        if engine == 'async':
+            sent, failed = asyncio.run(
+                campaign.adeliver(recipients, plan, mode, limiter)
+            )
+        else:
+            sent, failed = campaign.deliver(recipients, plan, mode, limiter)
+    finally:
+        plan.close()
+        connections.close_all()
+
+    shard_metrics = None
+    if collect_metrics:
+        shard_metrics = metrics.campaigns.get(campaign.slug)
+    return sent, failed, shard_metrics
+
+
+def submit_sharded(campaign, workers, request=None, mode=None, engine='sync'):
+    """
+    Submit a campaign with its recipients sharded by id across `workers`
+    processes. Each worker renders and sends its own shard; the campaign is
+    only marked as sent when every shard completed.
+
+    When this process collects delivery metrics, so do the workers, and
+    the metrics of every shard are added to those of this process.
+
+    Returns a (sent, failed) tuple of message counts over all shards.
+    """
+    from ..metrics import metrics
+    from ..models import get_delivery_mode
+
+    mode = get_delivery_mode(mode)
+    recipients, abs_uri = campaign.prepare_submission(request)
+    sent = failed = 0
+    errors = 0
+
+    try:
+        # Close the connections used so far before starting the workers.
+        connections.close_all()
+
+        executor = ProcessPoolExecutor(
+            max_workers=workers, mp_context=get_mp_context(),
+            initializer=setup_worker, initargs=(get_database_names(),)
+        )
+        with executor:
+            futures = {
+                executor.submit(
+                    deliver_shard, campaign.pk, index, workers, abs_uri,
+                    mode, engine, metrics.connected
+                ): index
+                for index in range(workers)
+            }
+            for future in as_completed(futures):
+                index = futures[future]
+                try:
+                    shard_sent, shard_failed, shard_metrics = \
+                        future.result()
+                except Exception as e:
+                    errors += 1
+                    logger.error(
+                        gettext('Shard %(shard)d of %(campaign)s failed '
+                                'with error: %(error)s'),
+                        {'shard': index, 'campaign': campaign, 'error': e}
+                    )
+                else:
+                    sent += shard_sent
+                    failed += shard_failed
+                    if shard_metrics is not None:
+                        metrics.merge(campaign.slug, shard_metrics)
+                    logger.info(
+                        gettext('Shard %(shard)d of %(campaign)s done: '
+                                '%(sent)d sent, %(failed)d failed'),
+                        {'shard': index, 'campaign': campaign,
+                         'sent': shard_sent, 'failed': shard_failed}
+                    )
+
+        if not errors:
+            campaign.sent = True
+
+    finally:
+        campaign.finish_submission()
+
+    logger.info(
+        gettext('Submitted %(campaign)s from %(workers)d workers: '
+                '%(sent)d sent, %(failed)d failed, %(errors)d shards failed'),
+        {'campaign': campaign, 'workers': workers, 'sent': sent,
+         'failed': failed, 'errors': errors}
+    )
+    return sent, failed
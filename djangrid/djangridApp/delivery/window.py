@@ -0,0 +1,146 @@
+"""
+Send windows: spreading a campaign's deliveries evenly over a period after
+its publication date, optionally in each recipient's local time.
+
+Each delivery is given its scheduled time when it is queued. A campaign is
+then submitted in passes, at most every NEWSLETTER_WINDOW_INTERVAL seconds,
+each sending to the recipients due by then (see Campaign.get_next_pass()),
+so no process sleeps through the window.
+"""
+
+import logging
+import time
+import zoneinfo
+
+from django.utils.timezone import is_naive, localtime, make_aware, now
+from django.utils.translation import gettext
+
+from ..settings import newsletter_settings
+
+logger = logging.getLogger(__name__)
+
+# Seconds between progress reports during a submission pass, and how far
+# behind its schedule a submission may fall, besides the interval between
+# passes, while still on schedule.
+REPORT_INTERVAL = 60
+TOLERANCE = 5
+
+
+def get_time_zone(name):
+    """ The time zone called `name`, or None when it is empty or unknown. """
+    if not name:
+        return None
+    try:
+        return zoneinfo.ZoneInfo(name)
+    except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+        return None
+
+
+def get_window_start(publish_date, time_zone=None):
+    """
+    When the send window starts for recipients in `time_zone`: at the
+    publication date's wall clock time there, or at the publication date
+    itself without a time zone.
+    """
+    if time_zone is None:
+        return publish_date
+    wall_clock = localtime(publish_date).replace(tzinfo=None)
+    return make_aware(wall_clock, time_zone)
+
+
+class WindowSchedule(object):
+    """
+    Scheduled delivery times for the recipients of a campaign, evenly
+    spaced over its send window. `counts` maps the time zone names of the
+    recipients (None for unknown) to how many there are; each time zone
+    gets its own window when sending in local time. Windows that started
+    already are moved to start now.
+    """
+
+    def __init__(self, campaign, counts, timestamp=None):
+        if timestamp is None:
+            timestamp = now()
+
+        self.window = campaign.send_window
+        self.slots = {}
+        for name, count in counts.items():
+            time_zone = get_time_zone(name) if campaign.local_time else None
+            start = get_window_start(campaign.publish_date, time_zone)
+            if start < timestamp:
+                start = timestamp
+            self.slots[name] = [start, max(count, 1), 0]
+
+    def next(self, time_zone=None):
+        """ The scheduled time for the next recipient in `time_zone`. """
+        slot = self.slots[time_zone]
+        start, count, index = slot
+        slot[2] += 1
+        return start + self.window * index / count
+
+
+class SendWindow(object):
+    """
+    Tracks a submission pass against the scheduled times of its
+    recipients, which are expected in scheduled order with a `scheduled`
+    attribute, and reports whether it keeps up with that schedule.
+    Recipients without a scheduled time are due right away.
+    """
+
+    def __init__(self, campaign):
+        self.campaign = campaign
+        self.count = 0
+        self.lag = 0.0
+        self.max_lag = 0.0
+        self._reported = time.monotonic()
+
+    @property
+    def on_schedule(self):
+        return self.lag <= (
+            TOLERANCE + newsletter_settings.WINDOW_INTERVAL
+        )
+
+    def delay(self, recipient):
+        """ Seconds until `recipient` is due, negative when overdue. """
+        scheduled = getattr(recipient, 'scheduled', None)
+        if scheduled is None:
+            return 0
+        if is_naive(scheduled):
+            # Databases without time zone support return naive values.
+            scheduled = make_aware(scheduled)
+        return (scheduled - now()).total_seconds()
+
+    def record(self, delay):
+        """ Account for a recipient sent `delay` seconds early or late. """
+        self.count += 1
+        self.lag = max(-delay, 0)
+        self.max_lag = max(self.max_lag, self.lag)
+        if time.monotonic() - self._reported >= REPORT_INTERVAL:
+            self.report()
+
+    def track(self, recipients):
+        """
+        Yield those of `recipients` that are due, stopping at the first one
+        that is not; it is left for a later pass.
+        """
+        for recipient in recipients:
+            delay = self.delay(recipient)
+            if delay > 0:
+                return
+            self.record(delay)
+            yield recipient
+
+    def report(self):
+        self._reported = time.monotonic()
+        if self.on_schedule:
+            logger.info(
+                gettext('%(campaign)s: %(count)d recipients sent, on '
+                        'schedule.'),
+                {'campaign': self.campaign, 'count': self.count}
+            )
+        else:
+            logger.warning(
+                gettext('%(campaign)s: %(count)d recipients sent, '
+                        '%(lag).0f seconds behind schedule.'),
+                {'campaign': self.campaign, 'count': self.count,
+                 'lag': self.lag}
+            )
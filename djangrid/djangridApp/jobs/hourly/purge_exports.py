@@ -0,0 +1,10 @@
+from django_extensions.management.jobs import HourlyJob
+
+from ...tasks import purge_exports
+
+
+class Job(HourlyJob):
+    help = "Delete expired CSV exports."
+
+    def execute(self):
+        purge_exports()
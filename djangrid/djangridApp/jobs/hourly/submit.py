@@ -9,7 +9,7 @@ class Job(HourlyJob):
 
     def execute(self):
         warnings.warn(
-            "The django-extensions cron job is deprecated in favor of the"
-            "submit_newsletter management command.", DeprecationWarning)
+            "The django-extensions cron job is deprecated in favor of the "
+            "delivery_daemon management command.", DeprecationWarning)
 
-        call_command('submit_newsletter')
+        call_command('submit_campaign')
@@ -0,0 +1,89 @@
+"""
+command to compare the template engine with the simple variable renderer
+"""
+import timeit
+
+from django.core.management.base import BaseCommand, CommandError
+from django.template import engines
+from django.utils.translation import gettext as _
+
+from ...delivery.render import SimpleTemplate
+from ...models import Newsletter
+
+SAMPLE_BODY = (
+    '<html><body><h1>Hello {{ first_name }},</h1>'
+    + '<p>This month in the newsletter: news, offers &amp; more.</p>' * 40
+    + '<p>See you soon, {{ first_name }}!</p></body></html>'
+)
+
+
+class Command(BaseCommand):
+    help = _("Benchmark rendering newsletter bodies with and without the "
+             "template engine.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--newsletter', metavar='SLUG',
+            help=_('Render this newsletter instead of a built-in sample.')
+        )
+        parser.add_argument(
+            '--renders', type=int, default=10000,
+            help=_('Renders per run, each for a different first name.')
+        )
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        if options['newsletter']:
+            try:
+                newsletter = Newsletter.objects.get(slug=options['newsletter'])
+            except Newsletter.DoesNotExist:
+                raise CommandError(
+                    _('Newsletter "%s" does not exist.') % options['newsletter']
+                )
+            source = newsletter.contents.read().decode('utf-8')
+        else:
+            source = SAMPLE_BODY
+
+        template = engines['django'].from_string(source)
+        simple = SimpleTemplate.compile(template)
+        if simple is None:
+            raise CommandError(
+                _('The body uses template tags or filters, so it is always '
+                  'rendered by the template engine.')
+            )
+
+        contexts = [
+            {'first_name': 'Name%d <&>' % i} for i in range(options['renders'])
+        ]
+        for context in contexts:
+            if template.render(context) != simple.render(context):
+                raise CommandError(
+                    _('Output differs for %s.') % context['first_name']
+                )
+
+        def run_engine():
+            for context in contexts:
+                template.render(context)
+
+        def run_simple():
+            for context in contexts:
+                simple.render(context)
+
+        engine_time = min(timeit.repeat(
+            run_engine, number=1, repeat=options['repeat']
+        ))
+        simple_time = min(timeit.repeat(
+            run_simple, number=1, repeat=options['repeat']
+        ))
+
+        for name, seconds in (('engine', engine_time), ('simple', simple_time)):
+            self.stdout.write(
+                _('%(name)s: %(renders)d renders in %(seconds).3fs '
+                  '(%(rate).0f/s)') % {
+                    'name': name, 'renders': len(contexts),
+                    'seconds': seconds, 'rate': len(contexts) / seconds
+                }
+            )
+        self.stdout.write(
+            _('Identical output, %.1fx faster.') % (engine_time / simple_time)
+        )
@@ -0,0 +1,131 @@
+"""
+command to benchmark campaign submission offline
+"""
+import json
+import os
+import tempfile
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils.translation import gettext as _
+
+from ...delivery.benchmark import TARGETS, run, seed
+
+
+def format_ms(seconds):
+    return '-' if seconds is None else '%.1f' % (seconds * 1000)
+
+
+def format_mb(size):
+    return '-' if size is None else '%.0f' % (size / 2 ** 20)
+
+
+class Command(BaseCommand):
+    help = _("Benchmark submitting a campaign to synthetic profiles, "
+             "against local mail backends and a fake SendGrid API. Runs in "
+             "a test database, which is destroyed afterwards.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--profiles', type=int, default=2000,
+            help=_('Synthetic profiles to send to.')
+        )
+        parser.add_argument(
+            '--target', action='append', choices=TARGETS,
+            help=_('Where to send; may be repeated. Defaults to all.')
+        )
+        parser.add_argument(
+            '--engine', choices=('sync', 'async'), default='sync',
+            help=_('Deliver with the threaded sender or the asyncio engine.')
+        )
+        parser.add_argument(
+            '--repeat', type=int, default=3,
+            help=_('Submissions per target; the fastest is reported.')
+        )
+        parser.add_argument(
+            '--save', metavar='FILE',
+            help=_('Write the results to FILE as JSON, for use as a '
+                   'baseline.')
+        )
+        parser.add_argument(
+            '--compare', metavar='FILE',
+            help=_('Compare the results with a baseline saved earlier.')
+        )
+
+    def handle(self, *args, **options):
+        baseline = {}
+        if options['compare']:
+            try:
+                with open(options['compare']) as f:
+                    baseline = {
+                        (result['target'], result['engine']): result
+                        for result in json.load(f)
+                    }
+            except (OSError, ValueError) as e:
+                raise CommandError(
+                    _('Cannot read baseline %(file)s: %(error)s') % {
+                        'file': options['compare'], 'error': e
+                    }
+                )
+
+        if connection.vendor == 'sqlite':
+            # Sender threads cannot share an in-memory database.
+            tmp_dir = tempfile.TemporaryDirectory()
+            connection.settings_dict['TEST']['NAME'] = os.path.join(
+                tmp_dir.name, 'benchmark.sqlite3'
+            )
+        else:
+            tmp_dir = None
+
+        old_name = connection.creation.create_test_db(verbosity=0)
+        try:
+            newsletter, segment = seed(options['profiles'])
+            results = []
+            for target in options['target'] or TARGETS:
+                runs = [
+                    run(target, newsletter, segment, options['engine'])
+                    for i in range(max(options['repeat'], 1))
+                ]
+                result = max(runs, key=lambda result: result['throughput'])
+                results.append(result)
+                self.report(result, baseline.get((target, result['engine'])))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            if tmp_dir is not None:
+                tmp_dir.cleanup()
+
+        if options['save']:
+            with open(options['save'], 'w') as f:
+                json.dump(results, f, indent=2)
+
+    def report(self, result, baseline=None):
+        self.stdout.write(
+            _('%(target)s/%(engine)s: %(messages)d messages in '
+              '%(seconds).2fs, %(throughput).0f/s, latency p50 %(p50)s ms '
+              'p99 %(p99)s ms, %(queries)d queries, peak RSS %(rss)s MB') % {
+                'target': result['target'], 'engine': result['engine'],
+                'messages': result['messages'], 'seconds': result['seconds'],
+                'throughput': result['throughput'],
+                'p50': format_ms(result['p50']),
+                'p99': format_ms(result['p99']),
+                'queries': result['queries'],
+                'rss': format_mb(result['peak_rss']),
+            }
+        )
+        if baseline is None or not baseline['throughput']:
+            return
+
+        self.stdout.write(
+            _('  vs baseline: throughput %(throughput)+.1f%%, queries '
+              '%(queries)+d, p99 %(p99)s') % {
+                'throughput': 100 * (
+                    result['throughput'] / baseline['throughput'] - 1
+                ),
+                'queries': result['queries'] - baseline['queries'],
+                'p99': (
+                    '%+.1f ms' % ((result['p99'] - baseline['p99']) * 1000)
+                    if result['p99'] is not None and
+                    baseline['p99'] is not None else '-'
+                ),
+            }
+        )
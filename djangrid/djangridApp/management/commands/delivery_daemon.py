@@ -0,0 +1,67 @@
+"""
+command to send campaigns as they become due, from a resident process
+"""
+import logging
+import signal
+
+from django.core.management.base import BaseCommand
+from django.utils.translation import gettext as _
+
+from ...delivery.daemon import DeliveryDaemon
+from ...metrics import metrics, serve_metrics
+from ...settings import newsletter_settings
+
+
+class Command(BaseCommand):
+    help = _("Stay resident and submit campaigns at their publication "
+             "date.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--engine', choices=('sync', 'async'), default='sync',
+            help=_('Deliver with the threaded sender or the asyncio engine.')
+        )
+        parser.add_argument(
+            '--workers', type=int, default=1,
+            help=_('Shard each campaign across this many processes.')
+        )
+        parser.add_argument(
+            '--poll-interval', type=float,
+            default=newsletter_settings.DAEMON_POLL_INTERVAL,
+            help=_('Seconds between looking for new and changed campaigns.')
+        )
+        parser.add_argument(
+            '--metrics-port', type=int,
+            help=_('Serve delivery metrics over HTTP on this port.')
+        )
+
+    def handle(self, *args, **options):
+        # Setup logging based on verbosity: 1 -> INFO, >1 -> DEBUG
+        verbosity = int(options['verbosity'])
+        logger = logging.getLogger('campaign')
+        if verbosity == 0:
+            logger.setLevel(logging.WARN)
+        elif verbosity == 1:  # default
+            logger.setLevel(logging.INFO)
+        elif verbosity > 1:
+            logger.setLevel(logging.DEBUG)
+        if verbosity > 2:
+            logger = logging.getLogger()
+            logger.setLevel(logging.DEBUG)
+
+        if newsletter_settings.METRICS or options['metrics_port']:
+            metrics.connect()
+        if options['metrics_port']:
+            serve_metrics(options['metrics_port'])
+
+        daemon = DeliveryDaemon(
+            workers=options['workers'], engine=options['engine'],
+            poll_interval=options['poll_interval']
+        )
+        # Finish the submission in progress before exiting.
+        signal.signal(signal.SIGTERM, lambda signum, frame: daemon.stop())
+
+        try:
+            daemon.run()
+        except KeyboardInterrupt:
+            pass
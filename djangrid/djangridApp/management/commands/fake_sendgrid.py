@@ -0,0 +1,43 @@
+"""
+command to run a local fake of the SendGrid mail send API
+"""
+from django.core.management.base import BaseCommand
+from django.utils.translation import gettext as _
+
+from ...delivery.fake_sendgrid import FakeSendGridServer
+
+
+class Command(BaseCommand):
+    help = _("Run a local fake of the SendGrid v3 mail send endpoint.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8025)
+        parser.add_argument(
+            '--rate-limit', type=float,
+            help=_('Answer 429 beyond this many messages per second.')
+        )
+        parser.add_argument('--burst', type=float)
+
+    def handle(self, *args, **options):
+        server = FakeSendGridServer(
+            (options['host'], options['port']),
+            rate_limit=options['rate_limit'], burst=options['burst']
+        )
+        self.stdout.write(
+            _('Fake SendGrid API listening on %s') % server.url
+        )
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.stdout.write(
+                _('Received %(requests)d requests for %(messages)d messages, '
+                  'throttled %(throttled)d.') % {
+                    'requests': server.request_count,
+                    'messages': server.messages,
+                    'throttled': server.throttled
+                }
+            )
@@ -0,0 +1,61 @@
+"""
+command to retry failed deliveries
+"""
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils.translation import gettext as _
+
+from ...metrics import metrics, serve_metrics
+from ...models import Campaign
+from ...settings import newsletter_settings
+
+
+class Command(BaseCommand):
+    help = _("Retry failed deliveries that are due, as they become due.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once', action='store_true',
+            help=_('Retry what is due now and exit.')
+        )
+        parser.add_argument(
+            '--interval', type=float,
+            default=newsletter_settings.RETRY_INTERVAL,
+            help=_('Seconds between looking for due retries.')
+        )
+        parser.add_argument(
+            '--metrics-port', type=int,
+            help=_('Serve delivery metrics over HTTP on this port.')
+        )
+
+    def handle(self, *args, **options):
+        # Setup logging based on verbosity: 1 -> INFO, >1 -> DEBUG
+        verbosity = int(options['verbosity'])
+        logger = logging.getLogger('campaign')
+        if verbosity == 0:
+            logger.setLevel(logging.WARN)
+        elif verbosity == 1:  # default
+            logger.setLevel(logging.INFO)
+        elif verbosity > 1:
+            logger.setLevel(logging.DEBUG)
+        if verbosity > 2:
+            logger = logging.getLogger()
+            logger.setLevel(logging.DEBUG)
+
+        logger.info(_('Retrying failed deliveries'))
+
+        if newsletter_settings.METRICS or options['metrics_port']:
+            metrics.connect()
+        if options['metrics_port']:
+            serve_metrics(options['metrics_port'])
+
+        try:
+            while True:
+                Campaign.retry_queue()
+                if options['once']:
+                    break
+                time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,84 @@
+"""
+command to run the background tasks of djangridApp, such as campaign
+submissions, imports and exports
+"""
+import logging
+import signal
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.translation import gettext as _
+
+from ...metrics import metrics, serve_metrics
+from ...settings import newsletter_settings
+from ...worker import TaskWorker, start_workers
+
+
+class Command(BaseCommand):
+    help = _("Stay resident and run queued background tasks.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--processes', type=int,
+            default=newsletter_settings.WORKER_PROCESSES,
+            help=_('Run tasks in this many worker processes.')
+        )
+        parser.add_argument(
+            '--threads', type=int,
+            default=newsletter_settings.WORKER_THREADS,
+            help=_('Run this many tasks at once in each process.')
+        )
+        parser.add_argument(
+            '--poll-interval', type=float,
+            default=newsletter_settings.TASK_POLL_INTERVAL,
+            help=_('Seconds between looking for due tasks while idle.')
+        )
+        parser.add_argument(
+            '--metrics-port', type=int,
+            help=_('Serve delivery metrics over HTTP on this port; only '
+                   'with a single process.')
+        )
+
+    def handle(self, *args, **options):
+        # Setup logging based on verbosity: 1 -> INFO, >1 -> DEBUG
+        verbosity = int(options['verbosity'])
+        logger = logging.getLogger('djangridApp')
+        if verbosity == 0:
+            logger.setLevel(logging.WARN)
+        elif verbosity == 1:  # default
+            logger.setLevel(logging.INFO)
+        elif verbosity > 1:
+            logger.setLevel(logging.DEBUG)
+        if verbosity > 2:
+            logger = logging.getLogger()
+            logger.setLevel(logging.DEBUG)
+
+        if options['metrics_port'] and options['processes'] > 1:
+            raise CommandError(
+                _('--metrics-port requires a single worker process.')
+            )
+        if newsletter_settings.METRICS or options['metrics_port']:
+            metrics.connect()
+        if options['metrics_port']:
+            serve_metrics(options['metrics_port'])
+
+        if options['processes'] <= 1:
+            worker = TaskWorker(options['threads'], options['poll_interval'])
+            # Finish the tasks in progress before exiting.
+            signal.signal(signal.SIGTERM, lambda signum, frame: worker.stop())
+            try:
+                worker.run()
+            except KeyboardInterrupt:
+                worker.stop()
+            return
+
+        stop, workers = start_workers(
+            options['processes'], options['threads'], options['poll_interval']
+        )
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+        try:
+            for worker in workers:
+                worker.join()
+        except KeyboardInterrupt:
+            stop.set()
+            for worker in workers:
+                worker.join()
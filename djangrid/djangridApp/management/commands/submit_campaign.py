@@ -1,17 +1,40 @@
 """
 command to send campaigns
 """
+import asyncio
 import logging
+import time
 
 from django.core.management.base import BaseCommand
 from django.utils.translation import gettext as _
 
+from ...metrics import metrics, serve_metrics
 from ...models import Campaign
+from ...settings import newsletter_settings
 
 
 class Command(BaseCommand):
     help = _("Submit pending messages.")
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--engine', choices=('sync', 'async'), default='sync',
+            help=_('Deliver with the threaded sender or the asyncio engine.')
+        )
+        parser.add_argument(
+            '--workers', type=int, default=1,
+            help=_('Shard each campaign across this many processes.')
+        )
+        parser.add_argument(
+            '--stats', action='store_true',
+            help=_('Print delivery statistics per campaign when done.')
+        )
+        parser.add_argument(
+            '--metrics-port', type=int,
+            help=_('Serve delivery metrics over HTTP on this port while '
+                   'sending.')
+        )
+
     def handle(self, *args, **options):
         # Setup logging based on verbosity: 1 -> INFO, >1 -> DEBUG
         verbosity = int(options['verbosity'])
@@ -28,5 +51,43 @@ class Command(BaseCommand):
 
         logger.info(_('Submitting queued campaigns'))
 
+        if newsletter_settings.METRICS or options['stats'] \
+                or options['metrics_port']:
+            metrics.connect()
+        if options['metrics_port']:
+            serve_metrics(options['metrics_port'])
+
         # Call submission
-        Campaign.submit_queue()
+        if options['workers'] > 1:
+            Campaign.submit_queue(
+                workers=options['workers'], engine=options['engine']
+            )
+        elif options['engine'] == 'async':
+            asyncio.run(Campaign.asubmit_queue())
+        else:
+            Campaign.submit_queue()
+
+        if options['stats']:
+            self.write_stats()
+
+    def write_stats(self):
+        for label, stats in sorted(metrics.campaigns.items()):
+            render = stats.render_seconds.mean
+            latency = stats.send_latency.mean
+            self.stdout.write(
+                _('%(campaign)s: %(rendered)d rendered, %(sent)d sent, '
+                  '%(failed)d failed; mean render %(render)s ms, mean send '
+                  'latency %(latency)s ms; %(rate).1f messages/s') % {
+                    'campaign': label, 'rendered': stats.rendered,
+                    'sent': stats.sent, 'failed': stats.failed,
+                    'render': '-' if render is None else '%.2f' % (
+                        render * 1000
+                    ),
+                    'latency': '-' if latency is None else '%.1f' % (
+                        latency * 1000
+                    ),
+                    'rate': stats.sent / max(
+                        time.monotonic() - stats.started, 1e-6
+                    ),
+                }
+            )
@@ -0,0 +1,320 @@
+"""
+In-process delivery metrics per campaign, fed by the delivery signals and
+exposed in the Prometheus text format.
+"""
+
+import bisect
+import collections
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .signals import (
+    message_failed, message_queued, message_rendered, messages_sent,
+    submission_finished
+)
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Histogram bucket upper bounds, in seconds.
+RENDER_BUCKETS = (
+    .0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25
+)
+LATENCY_BUCKETS = (
+    .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60
+)
+
+# Seconds over which the current send rate is averaged.
+RATE_WINDOW = 10
+
+# Seconds the metrics of a finished campaign are kept for, to be scraped.
+FINISHED_RETENTION = 15 * 60
+
+
+def escape_label(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace(
+        '\n', r'\n'
+    )
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else None
+
+    def samples(self):
+        """ (le, cumulative count) pairs, ending with +Inf. """
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += count
+            yield bound, cumulative
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.sum += other.sum
+        self.count += other.count
+
+
+class CampaignMetrics(object):
+    """ Counters, histograms and gauges for one campaign. """
+
+    def __init__(self):
+        self.rendered = 0
+        self.queued = 0
+        self.sent = 0
+        self.failed = 0
+        self.render_seconds = Histogram(RENDER_BUCKETS)
+        self.send_latency = Histogram(LATENCY_BUCKETS)
+        self.started = time.monotonic()
+        # When its last submission was over, unless it is being sent.
+        self.finished = None
+        self.lock = threading.Lock()
+        # When the messages in flight were queued, by recipient id.
+        self._in_flight = {}
+        # (timestamp, messages) of recent sends, for the current rate.
+        self._recent = collections.deque()
+
+    def __getstate__(self):
+        # Sent back from the worker processes of a sharded submission.
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    @property
+    def queue_depth(self):
+        """ Messages queued for sending that were not sent or failed yet. """
+        return len(self._in_flight)
+
+    def get_rate(self, timestamp=None):
+        """ Messages sent per second over the last RATE_WINDOW seconds. """
+        if timestamp is None:
+            timestamp = time.monotonic()
+        with self.lock:
+            while self._recent and self._recent[0][0] < timestamp - RATE_WINDOW:
+                self._recent.popleft()
+            sent = sum(count for at, count in self._recent)
+        return sent / min(RATE_WINDOW, max(timestamp - self.started, 1))
+
+    def on_rendered(self, duration):
+        with self.lock:
+            self.rendered += 1
+            self.render_seconds.observe(duration)
+
+    def on_queued(self, recipient):
+        with self.lock:
+            self.queued += 1
+            self._in_flight[recipient.pk] = time.monotonic()
+
+    def on_sent(self, recipients):
+        timestamp = time.monotonic()
+        with self.lock:
+            for recipient in recipients:
+                queued = self._in_flight.pop(recipient.pk, None)
+                if queued is not None:
+                    self.send_latency.observe(timestamp - queued)
+            self.sent += len(recipients)
+            self._recent.append((timestamp, len(recipients)))
+
+    def on_failed(self, recipient):
+        with self.lock:
+            self._in_flight.pop(recipient.pk, None)
+            self.failed += 1
+
+    def on_finished(self):
+        with self.lock:
+            # Messages still in flight will not be reported any more.
+            self._in_flight.clear()
+            self.finished = time.monotonic()
+
+    def merge(self, other):
+        """ Add the metrics of the same campaign from another process. """
+        with self.lock:
+            self.rendered += other.rendered
+            self.queued += other.queued
+            self.sent += other.sent
+            self.failed += other.failed
+            self.render_seconds.merge(other.render_seconds)
+            self.send_latency.merge(other.send_latency)
+            self.started = min(self.started, other.started)
+            self._in_flight.update(other._in_flight)
+            self._recent = collections.deque(
+                sorted(self._recent + other._recent)
+            )
+
+
+class DeliveryMetrics(object):
+    """
+    The metrics of all campaigns delivered by this process, collected
+    while connected to the delivery signals.
+    """
+
+    def __init__(self):
+        self.campaigns = {}
+        self.connected = False
+        self._lock = threading.Lock()
+
+    def get(self, campaign):
+        """ The `CampaignMetrics` of a campaign, by its slug. """
+        label = getattr(campaign, 'slug', campaign)
+        with self._lock:
+            self.prune()
+            if label not in self.campaigns:
+                self.campaigns[label] = CampaignMetrics()
+            campaign_metrics = self.campaigns[label]
+        # Sending again, e.g. the next pass of its send window.
+        campaign_metrics.finished = None
+        return campaign_metrics
+
+    def prune(self, timestamp=None):
+        """
+        Drop the campaigns finished over FINISHED_RETENTION seconds ago;
+        call while holding the lock.
+        """
+        if timestamp is None:
+            timestamp = time.monotonic()
+        for label, campaign_metrics in list(self.campaigns.items()):
+            finished = campaign_metrics.finished
+            if finished is not None \
+                    and finished < timestamp - FINISHED_RETENTION:
+                del self.campaigns[label]
+
+    def merge(self, label, campaign_metrics):
+        """
+        Add the `CampaignMetrics` of a campaign collected by another
+        process, e.g. a worker delivering one of its shards.
+        """
+        with self._lock:
+            if label not in self.campaigns:
+                self.campaigns[label] = campaign_metrics
+                return
+            existing = self.campaigns[label]
+        existing.merge(campaign_metrics)
+
+    def clear(self):
+        with self._lock:
+            self.campaigns.clear()
+
+    def on_rendered(self, sender, duration, **kwargs):
+        self.get(sender).on_rendered(duration)
+
+    def on_queued(self, sender, recipient, **kwargs):
+        self.get(sender).on_queued(recipient)
+
+    def on_sent(self, sender, recipients, **kwargs):
+        self.get(sender).on_sent(recipients)
+
+    def on_failed(self, sender, recipient, **kwargs):
+        self.get(sender).on_failed(recipient)
+
+    def on_finished(self, sender, **kwargs):
+        with self._lock:
+            campaign_metrics = self.campaigns.get(sender.slug)
+        if campaign_metrics is not None:
+            campaign_metrics.on_finished()
+
+    def connect(self):
+        message_rendered.connect(self.on_rendered, dispatch_uid='metrics')
+        message_queued.connect(self.on_queued, dispatch_uid='metrics')
+        messages_sent.connect(self.on_sent, dispatch_uid='metrics')
+        message_failed.connect(self.on_failed, dispatch_uid='metrics')
+        submission_finished.connect(self.on_finished, dispatch_uid='metrics')
+        self.connected = True
+
+    def export(self):
+        """ All metrics in the Prometheus text exposition format. """
+        with self._lock:
+            self.prune()
+            campaigns = sorted(self.campaigns.items())
+
+        lines = []
+
+        def family(name, kind, help_text, values):
+            lines.append('# HELP djangrid_%s %s' % (name, help_text))
+            lines.append('# TYPE djangrid_%s %s' % (name, kind))
+            for label, metrics in campaigns:
+                labels = 'campaign="%s"' % escape_label(label)
+                for suffix, extra, value in values(metrics):
+                    lines.append('djangrid_%s%s{%s%s} %s' % (
+                        name, suffix, labels, extra, value
+                    ))
+
+        def counter(attr):
+            return lambda metrics: [('', '', getattr(metrics, attr))]
+
+        def histogram(attr):
+            def values(metrics):
+                histogram = getattr(metrics, attr)
+                for bound, count in histogram.samples():
+                    yield '_bucket', ',le="%s"' % bound, count
+                yield '_sum', '', histogram.sum
+                yield '_count', '', histogram.count
+            return values
+
+        family('messages_rendered_total', 'counter',
+               'Messages rendered.', counter('rendered'))
+        family('messages_sent_total', 'counter',
+               'Messages accepted by the backend or provider.',
+               counter('sent'))
+        family('messages_failed_total', 'counter',
+               'Messages that failed to send.', counter('failed'))
+        family('render_seconds', 'histogram',
+               'Time spent rendering a message.',
+               histogram('render_seconds'))
+        family('send_latency_seconds', 'histogram',
+               'Time from queueing a message until it was sent.',
+               histogram('send_latency'))
+        family('send_rate', 'gauge',
+               'Messages sent per second, over the last %d seconds.'
+               % RATE_WINDOW,
+               lambda metrics: [('', '', '%.3f' % metrics.get_rate())])
+        family('queue_depth', 'gauge',
+               'Messages queued for sending and not sent or failed yet.',
+               lambda metrics: [('', '', metrics.queue_depth)])
+
+        return '\n'.join(lines) + '\n'
+
+
+metrics = DeliveryMetrics()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = metrics.export().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+def serve_metrics(port, host=''):
+    """
+    Serve the metrics of this process over HTTP from a background thread,
+    for processes without a web server such as the delivery commands.
+    Returns the server.
+    """
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,107 @@
+# Generated by Django 4.0 on 2026-10-18 16:55
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import djangridApp.models
+import djangridApp.utils
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Newsletter',
+            fields=[
+                ('title', models.CharField(max_length=200, verbose_name='newsletter title')),
+                ('slug', models.SlugField(unique=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('subject', models.CharField(max_length=150)),
+                ('contents', models.FileField(upload_to='uploaded_newsletters/')),
+                ('_id', models.AutoField(editable=False, primary_key=True, serialize=False)),
+            ],
+            options={
+                'verbose_name': 'newsletter',
+                'verbose_name_plural': 'newsletters',
+            },
+        ),
+        migrations.CreateModel(
+            name='Profile',
+            fields=[
+                ('name_field', models.CharField(blank=True, db_column='name', help_text='optional', max_length=200, null=True, verbose_name='name')),
+                ('email', models.EmailField(blank=True, db_column='email', db_index=True, max_length=254, null=True, unique=True, verbose_name='e-mail')),
+                ('confirmed', models.BooleanField(default=False)),
+                ('city', models.CharField(blank=True, max_length=200, null=True)),
+                ('postalCode', models.CharField(blank=True, max_length=200, null=True, verbose_name='post code')),
+                ('country', models.CharField(blank=True, max_length=200, null=True)),
+                ('ip', models.GenericIPAddressField(blank=True, null=True, verbose_name='IP address')),
+                ('subscribe_date', models.DateTimeField(default=django.utils.timezone.now, editable=False)),
+                ('conf_num', models.CharField(default=djangridApp.utils.make_activation_code, max_length=40, verbose_name='activation code')),
+                ('unsubscribed', models.BooleanField(db_index=True, default=False, verbose_name='unsubscribed')),
+                ('unsubscribe_date', models.DateTimeField(blank=True, null=True, verbose_name='unsubscribe date')),
+                ('_id', models.AutoField(editable=False, primary_key=True, serialize=False)),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='auth.user', verbose_name='user')),
+            ],
+            options={
+                'verbose_name': 'profile',
+                'verbose_name_plural': 'profiles',
+                'unique_together': {('user', 'email')},
+            },
+        ),
+        migrations.CreateModel(
+            name='Segment',
+            fields=[
+                ('segment_name', models.CharField(max_length=200, verbose_name='list segment name')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(blank=True, null=True)),
+                ('_id', models.AutoField(editable=False, primary_key=True, serialize=False)),
+                ('profiles', models.ManyToManyField(blank=True, db_index=True, help_text='Create a dynamic segment of people based on their behaviour or properties.', limit_choices_to={'unsubscribed': False}, to='djangridApp.Profile', verbose_name='profiles')),
+            ],
+            options={
+                'verbose_name': 'segment',
+                'verbose_name_plural': 'segments',
+            },
+        ),
+        migrations.CreateModel(
+            name='Campaign',
+            fields=[
+                ('_id', models.AutoField(editable=False, primary_key=True, serialize=False)),
+                ('title', models.CharField(default='Campaign_2026-10-18_16:55:46', max_length=200, verbose_name='campaign title')),
+                ('send_plain', models.BooleanField(default=True, help_text='Whether or not to send plaintext versions of e-mail.', verbose_name='send plaintext')),
+                ('send_html', models.BooleanField(default=True, help_text='Whether or not to send HTML versions of e-mail.', verbose_name='send html')),
+                ('use_template', models.BooleanField(default=False, help_text='Whether or not to format the html e-mail from a library template (if not uploading a html file).', verbose_name='use html template')),
+                ('publish_date', models.DateTimeField(blank=True, db_index=True, default=django.utils.timezone.now, null=True, verbose_name='publication date')),
+                ('publish', models.BooleanField(db_index=True, default=True, help_text='Publish in archive.', verbose_name='publish')),
+                ('prepared', models.BooleanField(db_index=True, default=False, editable=False, verbose_name='prepared')),
+                ('sent', models.BooleanField(db_index=True, default=False, editable=False, verbose_name='sent')),
+                ('sending', models.BooleanField(db_index=True, default=False, editable=False, verbose_name='sending')),
+                ('slug', models.SlugField(unique=True)),
+                ('emailmsg', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='djangridApp.newsletter', verbose_name='newsletter')),
+                ('recipients', models.ManyToManyField(blank=True, db_index=True, help_text='If you select none, the system will automatically find the recipients for you.', limit_choices_to={'unsubscribed': False}, to='djangridApp.Profile', verbose_name='recipients')),
+                ('segments', models.ManyToManyField(blank=True, db_index=True, help_text='If you select none, the system will automatically find the segments for you.', to='djangridApp.Segment', verbose_name='segments')),
+            ],
+            options={
+                'verbose_name': 'campaign',
+                'verbose_name_plural': 'campaigns',
+            },
+        ),
+        migrations.CreateModel(
+            name='Attachment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('file', models.FileField(upload_to=djangridApp.models.attachment_upload_to, verbose_name='attachment')),
+                ('campaign', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='attachments', to='djangridApp.newsletter', verbose_name='campaign')),
+            ],
+            options={
+                'verbose_name': 'attachment',
+                'verbose_name_plural': 'attachments',
+            },
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.0 on 2026-10-18 16:55
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djangridApp', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Delivery',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('queued', 'queued'), ('sent', 'sent'), ('failed', 'failed')], db_index=True, default='queued', max_length=10, verbose_name='status')),
+                ('updated', models.DateTimeField(default=django.utils.timezone.now, verbose_name='updated')),
+                ('message_id', models.CharField(blank=True, max_length=255, null=True, verbose_name='provider message id')),
+                ('campaign', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='deliveries', to='djangridApp.campaign', verbose_name='campaign')),
+                ('profile', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='deliveries', to='djangridApp.profile', verbose_name='profile')),
+            ],
+            options={
+                'verbose_name': 'delivery',
+                'verbose_name_plural': 'deliveries',
+                'unique_together': {('campaign', 'profile')},
+            },
+        ),
+    ]
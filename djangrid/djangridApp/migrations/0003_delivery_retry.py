@@ -0,0 +1,28 @@
+# Generated by Django 4.0 on 2026-10-18 16:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djangridApp', '0002_delivery'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='delivery',
+            name='attempts',
+            field=models.PositiveIntegerField(default=0, verbose_name='attempts'),
+        ),
+        migrations.AddField(
+            model_name='delivery',
+            name='error',
+            field=models.TextField(blank=True, default='', verbose_name='error'),
+        ),
+        migrations.AddField(
+            model_name='delivery',
+            name='next_attempt',
+            field=models.DateTimeField(blank=True, db_index=True, null=True, verbose_name='next attempt'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.0 on 2026-10-18 16:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djangridApp', '0003_delivery_retry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='campaign',
+            name='priority',
+            field=models.PositiveSmallIntegerField(default=1, help_text='Share of the send rate when other campaigns are being sent at the same time: a campaign with priority 2 goes out twice as fast as one with priority 1.', verbose_name='priority'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.0 on 2026-10-18 16:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djangridApp', '0004_campaign_priority'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='campaign',
+            name='claimed_by',
+            field=models.CharField(blank=True, default='', editable=False, max_length=200, verbose_name='claimed by'),
+        ),
+        migrations.AddField(
+            model_name='campaign',
+            name='lease_expires',
+            field=models.DateTimeField(blank=True, db_index=True, editable=False, null=True, verbose_name='lease expires'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.0 on 2026-10-18 16:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djangridApp', '0005_campaign_lease'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='campaign',
+            name='modified',
+            field=models.DateTimeField(auto_now=True, db_index=True, verbose_name='modified'),
+        ),
+    ]
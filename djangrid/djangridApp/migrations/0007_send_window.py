@@ -0,0 +1,38 @@
+# Generated by Django 4.0 on 2026-10-18 16:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djangridApp', '0006_campaign_modified'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='campaign',
+            name='local_time',
+            field=models.BooleanField(default=False, help_text="Start the send window at the publication time in each recipient's own time zone, where known.", verbose_name='local time'),
+        ),
+        migrations.AddField(
+            model_name='campaign',
+            name='send_window',
+            field=models.DurationField(blank=True, help_text='Spread delivery evenly over this long from the publication date, e.g. 03:00:00 for three hours. Leave empty to send as fast as allowed.', null=True, verbose_name='send window'),
+        ),
+        migrations.AddField(
+            model_name='delivery',
+            name='scheduled',
+            field=models.DateTimeField(blank=True, db_index=True, help_text="When it is due within the campaign's send window.", null=True, verbose_name='scheduled'),
+        ),
+        migrations.AddField(
+            model_name='profile',
+            name='time_zone',
+            field=models.CharField(blank=True, help_text='IANA time zone name, e.g. Europe/Dublin.', max_length=63, null=True, verbose_name='time zone'),
+        ),
+        migrations.AddField(
+            model_name='campaign',
+            name='resume_at',
+            field=models.DateTimeField(blank=True, db_index=True, editable=False, null=True, verbose_name='resume at'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 4.0 on 2026-10-18 16:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djangridApp', '0007_send_window'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='campaign',
+            name='failed_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='messages failed'),
+        ),
+        migrations.AddField(
+            model_name='campaign',
+            name='progress_started',
+            field=models.DateTimeField(blank=True, editable=False, null=True, verbose_name='submission started'),
+        ),
+        migrations.AddField(
+            model_name='campaign',
+            name='progress_updated',
+            field=models.DateTimeField(blank=True, editable=False, null=True, verbose_name='progress updated'),
+        ),
+        migrations.AddField(
+            model_name='campaign',
+            name='sent_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='messages sent'),
+        ),
+        migrations.AddField(
+            model_name='campaign',
+            name='total_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='recipients'),
+        ),
+    ]
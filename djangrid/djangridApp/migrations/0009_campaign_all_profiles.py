@@ -0,0 +1,18 @@
+# Generated by Django 4.0 on 2026-10-18 16:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djangridApp', '0008_campaign_progress'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='campaign',
+            name='all_profiles',
+            field=models.BooleanField(default=False, help_text='Send to all confirmed, subscribed profiles, besides the chosen segments.', verbose_name='all profiles'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 4.0 on 2026-10-18 16:56
+
+import django.core.serializers.json
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djangridApp', '0009_campaign_all_profiles'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Task',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, verbose_name='name')),
+                ('kwargs', models.JSONField(blank=True, default=dict, encoder=django.core.serializers.json.DjangoJSONEncoder, verbose_name='arguments')),
+                ('status', models.CharField(choices=[('queued', 'queued'), ('running', 'running'), ('done', 'done'), ('failed', 'failed')], db_index=True, default='queued', max_length=10, verbose_name='status')),
+                ('run_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now, verbose_name='run at')),
+                ('attempts', models.PositiveIntegerField(default=0, verbose_name='attempts')),
+                ('max_attempts', models.PositiveIntegerField(default=1, verbose_name='max attempts')),
+                ('claimed_by', models.CharField(blank=True, default='', editable=False, max_length=255, verbose_name='claimed by')),
+                ('lease_expires', models.DateTimeField(blank=True, db_index=True, editable=False, null=True, verbose_name='lease expires')),
+                ('result', models.JSONField(blank=True, encoder=django.core.serializers.json.DjangoJSONEncoder, null=True, verbose_name='result')),
+                ('error', models.TextField(blank=True, default='', verbose_name='error')),
+                ('created', models.DateTimeField(default=django.utils.timezone.now, verbose_name='created')),
+                ('started', models.DateTimeField(blank=True, null=True, verbose_name='started')),
+                ('finished', models.DateTimeField(blank=True, null=True, verbose_name='finished')),
+            ],
+            options={
+                'verbose_name': 'task',
+                'verbose_name_plural': 'tasks',
+                'ordering': ('-created',),
+            },
+        ),
+    ]
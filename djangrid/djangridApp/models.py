@@ -1,14 +1,16 @@
 import logging
 import os
-import time
-from django.db import models
+from django.db import connection, models, transaction
 from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
 from django.contrib.sites.models import Site
-from sendgrid import SendGridAPIClient
 from sendgrid.helpers.mail import Mail
 from django.core.mail import EmailMessage, EmailMultiAlternatives
+from django.core.mail.message import make_msgid
+from django.core.mail.utils import DNS_NAME
 # from django.contrib.auth.models import User
 import datetime
+from asgiref.sync import sync_to_async
 # import time
 # import calendar
 from django.template.loader import select_template
@@ -17,13 +19,59 @@ from django.utils.translation import gettext_lazy as _
 from django.utils.translation import gettext
 from django.utils.timezone import now, localtime
 from django.urls import reverse
+from .tokens import make_token
 from .utils import make_activation_code
 from django.template import engines
+from .delivery.aio import AsyncDeliveryEngine
+from .delivery.lease import LeaseKeeper, get_lease_expiry, get_worker_id
+from .delivery.ledger import (
+    DeliveryLedger, get_retry_delay, queue_deliveries
+)
+from .delivery.mime import SkeletonMessage
+from .delivery.pool import make_sender
+from .delivery.ratelimit import get_rate_limiter
+from .delivery.render import RenderPlan
+from .delivery.scheduler import FairScheduler
+from .delivery.sharding import submit_sharded
+from .delivery.window import SendWindow
+from .delivery.sendgrid import (
+    PersonalizationSender, SUBSTITUTION_TAGS, get_client, get_substitutions,
+    make_personalization
+)
+from .settings import newsletter_settings
+from .signals import message_queued, submission_finished
 
 logger = logging.getLogger(__name__)
 
 AUTH_USER_MODEL = getattr(settings, 'AUTH_USER_MODEL', 'auth.User')
 
+# Ways of delivering a campaign, see Campaign.submit().
+DELIVERY_MODES = ('backend', 'personalizations')
+
+# Profile fields loaded when sending, see Campaign.stream_recipients().
+RECIPIENT_FIELDS = (
+    '_id', 'email', 'name_field', 'conf_num', 'confirmed', 'unsubscribed',
+    'user', 'user__first_name', 'user__last_name', 'user__email',
+)
+
+
+# Campaign fields written by submissions with UPDATEs, see Campaign.save().
+PROGRESS_FIELDS = (
+    'total_count', 'sent_count', 'failed_count', 'progress_started',
+    'progress_updated',
+)
+# Campaign fields written by the queue with conditional UPDATEs only.
+STATE_FIELDS = (
+    'sending', 'sent', 'claimed_by', 'lease_expires', 'resume_at'
+)
+
+
+def get_delivery_mode(mode=None):
+    if mode is None:
+        mode = newsletter_settings.DELIVERY_MODE
+    assert mode in DELIVERY_MODES, 'Unknown delivery mode: %s' % mode
+    return mode
+
 
 class Profile(models.Model):
     user = models.ForeignKey(
@@ -76,6 +124,10 @@ class Profile(models.Model):
     city = models.CharField(max_length=200, null=True, blank=True)
     postalCode = models.CharField(max_length=200, verbose_name=_('post code'), null=True, blank=True)
     country = models.CharField(max_length=200, null=True, blank=True)
+    time_zone = models.CharField(
+        max_length=63, null=True, blank=True, verbose_name=_('time zone'),
+        help_text=_('IANA time zone name, e.g. Europe/Dublin.')
+    )
     ip = models.GenericIPAddressField(_("IP address"), blank=True, null=True)
     subscribe_date = models.DateTimeField(editable=False, default=now)
     conf_num = models.CharField(
@@ -177,14 +229,37 @@ class Newsletter(models.Model):
         except IndexError:
             return None
 
-    def send(self, request):
+    def send(self, request, mode=None):
+        mode = get_delivery_mode(mode)
+
         contents = self.contents.read().decode('utf-8')
         profiles = Profile.objects.filter(confirmed=True, unsubscribed=False)
-        sg = SendGridAPIClient(settings.SENDGRID_API_KEY)
+        sg = get_client()
         from_email = (settings.FROM_EMAIL, settings.SENDER_NAME)
         # print(from_email)
         django_engine = engines['django']
         template = django_engine.from_string(contents)
+        unsub_uri = request.build_absolute_uri('/newsletter/delete/')
+        unsub = '<br><br><br><small><a href="{}">Unsubscribe</a><small>'
+
+        if mode == 'personalizations':
+            context = {'first_name': SUBSTITUTION_TAGS['first_name']}
+            html_body = template.render(context=context, request=None)
+            sender = PersonalizationSender(
+                from_email, self.subject,
+                html_content=html_body + unsub.format(SUBSTITUTION_TAGS['unsub_url']),
+                client=sg
+            )
+            with sender:
+                for sub in profiles:
+                    unsub_url = '{}?token={}'.format(
+                        unsub_uri, make_token(sub.pk, 'unsubscribe'))
+                    substitutions = get_substitutions(sub.first_name, unsub_url)
+                    sender.add(
+                        make_personalization(sub.email, None, substitutions), sub
+                    )
+            return
+
         for sub in profiles:
             context = {'first_name': sub.first_name}
             html_body = template.render(context=context, request=None)
@@ -195,12 +270,22 @@ class Newsletter(models.Model):
                     html_content=html_body + (
                         # '<br><a href="{}/delete/?email={}&conf_num={}">Unsubscribe</a>.').format(
                             # request.build_absolute_uri(''),
-                        '<br><br><br><small><a href="{}?email={}&conf_num={}">Unsubscribe</a><small>').format(
-                            request.build_absolute_uri('/newsletter/delete/'),
-                            sub.email,
-                            sub.conf_num))
+                        '<br><br><br><small><a href="{}?token={}">Unsubscribe</a><small>').format(
+                            unsub_uri,
+                            make_token(sub.pk, 'unsubscribe')))
             sg.send(message)
 
+    def queue_send(self):
+        """
+        Queue sending to all confirmed, subscribed profiles as a prepared
+        campaign that is due now, instead of sending from this process like
+        `send()`. The recipients are only looked up when the campaign is
+        submitted, by the task workers or the delivery daemon; returns it.
+        """
+        return Campaign.from_message(
+            self, all_profiles=True, prepared=True, publish_date=now()
+        )
+
 def get_address(name, email):
     if name:
         return '%s <%s>' % (name, email)
@@ -272,6 +357,11 @@ class Campaign(models.Model):
         blank=True, db_index=True, verbose_name=_('recipients'),
         limit_choices_to={'unsubscribed': False}
     )
+    all_profiles = models.BooleanField(
+        default=False, verbose_name=_('all profiles'),
+        help_text=_('Send to all confirmed, subscribed profiles, besides '
+                    'the chosen segments.')
+    )
 
     send_plain = models.BooleanField(
         default=True, verbose_name=_('send plaintext'),
@@ -309,6 +399,60 @@ class Campaign(models.Model):
         default=False, verbose_name=_('sending'),
         db_index=True, editable=False
     )
+    claimed_by = models.CharField(
+        max_length=200, blank=True, default='',
+        verbose_name=_('claimed by'), editable=False
+    )
+    lease_expires = models.DateTimeField(
+        verbose_name=_('lease expires'), blank=True, null=True,
+        db_index=True, editable=False
+    )
+    modified = models.DateTimeField(
+        auto_now=True, verbose_name=_('modified'), db_index=True
+    )
+    # With a send window, when the next submission pass is due.
+    resume_at = models.DateTimeField(
+        verbose_name=_('resume at'), blank=True, null=True, db_index=True,
+        editable=False
+    )
+
+    # Progress of the current or last submission, see update_progress().
+    total_count = models.PositiveIntegerField(
+        default=0, verbose_name=_('recipients'), editable=False
+    )
+    sent_count = models.PositiveIntegerField(
+        default=0, verbose_name=_('messages sent'), editable=False
+    )
+    failed_count = models.PositiveIntegerField(
+        default=0, verbose_name=_('messages failed'), editable=False
+    )
+    progress_started = models.DateTimeField(
+        verbose_name=_('submission started'), blank=True, null=True,
+        editable=False
+    )
+    progress_updated = models.DateTimeField(
+        verbose_name=_('progress updated'), blank=True, null=True,
+        editable=False
+    )
+
+    send_window = models.DurationField(
+        blank=True, null=True, verbose_name=_('send window'),
+        help_text=_('Spread delivery evenly over this long from the '
+                    'publication date, e.g. 03:00:00 for three hours. Leave '
+                    'empty to send as fast as allowed.')
+    )
+    local_time = models.BooleanField(
+        default=False, verbose_name=_('local time'),
+        help_text=_("Start the send window at the publication time in each "
+                    "recipient's own time zone, where known.")
+    )
+
+    priority = models.PositiveSmallIntegerField(
+        default=1, verbose_name=_('priority'),
+        help_text=_('Share of the send rate when other campaigns are being '
+                    'sent at the same time: a campaign with priority 2 goes '
+                    'out twice as fast as one with priority 1.')
+    )
 
     slug = models.SlugField(db_index=True, unique=True)
 
@@ -340,19 +484,48 @@ class Campaign(models.Model):
 
 
     def get_recipients(self):
+        """
+        Add the members of the chosen segments to the recipients, and all
+        confirmed, subscribed profiles when `all_profiles` is set.
+        """
         logger.debug('Looking up members of chosen segments for %s', self)
-        segments = self.segments.all()
-        # print ('SEGMENTS:', segments)
-        profiles = segments.values('profiles___id')
-        # print ("Profiles:", profiles)
-        recipient_ids = [[id for key, id in profile.items()] for profile in profiles]
-        # print("IDs:", recipient_ids)
-        recipients = list(dict.fromkeys([i[0] for i in recipient_ids]))
-        # print ("recipients", recipients)
-        for recipient in recipients:
-            self.recipients.add(recipient)
+        self.add_recipients(
+            Profile.objects.filter(segment__in=self.segments.all())
+        )
+        if self.all_profiles:
+            self.add_recipients(
+                Profile.objects.filter(confirmed=True, unsubscribed=False)
+            )
         return self.recipients
 
+    def add_recipients(self, profiles):
+        """
+        Add the `profiles` queryset to the recipients. The profiles that
+        are not recipients yet are inserted into the through table with a
+        single INSERT ... SELECT, without loading them. Returns the number
+        added.
+        """
+        Recipient = Campaign.recipients.through
+        quote_name = connection.ops.quote_name
+
+        select, params = profiles.exclude(
+            _id__in=self.recipients.values('_id')
+        ).values('_id').distinct().query.sql_with_params()
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'INSERT INTO %s (%s, %s) SELECT %%s, profiles.%s FROM '
+                '(%s) profiles' % (
+                    quote_name(Recipient._meta.db_table),
+                    quote_name(Recipient._meta.get_field('campaign').column),
+                    quote_name(Recipient._meta.get_field('profile').column),
+                    quote_name(Profile._meta.pk.column),
+                    select,
+                ),
+                (self.pk,) + tuple(params)
+            )
+            return cursor.rowcount
+
     def get_templates(self, action):
         """
         Return a subject, text, HTML tuple with e-mail templates for
@@ -398,158 +571,620 @@ class Campaign(models.Model):
 
         return subject_template, text_template, html_template
 
-    def submit(self, request=None):
-        self.get_recipients()
-        recipients = self.recipients.filter(unsubscribed=False)
+    def submit(self, request=None, mode=None):
+        """
+        Send the campaign to its recipients. `mode` is one of
+        DELIVERY_MODES and defaults to the NEWSLETTER_DELIVERY_MODE setting:
+        'backend' sends one message per recipient through the configured
+        mail backend, 'personalizations' sends SendGrid v3 requests carrying
+        up to 1000 recipients each.
+        """
+        mode = get_delivery_mode(mode)
+        recipients, abs_uri = self.prepare_submission(request)
+        plan = self.get_render_plan(abs_uri)
 
-        logger.info(
-            gettext("Submitting %(campaign)s to %(count)d people"),
-            {'campaign': self, 'count': recipients.count()}
-        )
+        try:
+            self.deliver(recipients, plan, mode, get_rate_limiter())
+            self.sent = True
 
-        assert self.publish_date < now(), \
-            'Error -  campaign creation time in the future.'
+        finally:
+            plan.close()
+            self.finish_submission()
 
-        self.sending = True
-        self.save()
+    async def asubmit(self, request=None, mode=None):
+        """
+        Send the campaign from an event loop with the asyncio delivery
+        engine; see `submit()` for `mode`.
+        """
+        mode = get_delivery_mode(mode)
+        recipients, abs_uri = await sync_to_async(self.prepare_submission)(request)
+        plan = await sync_to_async(self.get_render_plan)(abs_uri)
+
+        try:
+            await self.adeliver(recipients, plan, mode, get_rate_limiter())
+            self.sent = True
 
+        finally:
+            plan.close()
+            await sync_to_async(self.finish_submission)()
+
+    def deliver(self, recipients, plan, mode, limiter=None):
+        """
+        Send the rendered campaign to `recipients`, recording the outcomes
+        in the delivery ledger. Returns a (sent, failed) tuple of message
+        counts.
+        """
+        recipients = self.stream_recipients(recipients)
+        window = self.get_send_window()
+        if window is not None:
+            recipients = window.track(recipients)
+
+        with DeliveryLedger(self) as ledger:
+            with self.open_sender(plan, mode, limiter, ledger) as sender:
+                for recipient in recipients:
+                    self.add_recipient(recipient, plan, mode, sender)
+
+        if limiter is not None:
+            logger.info(
+                gettext('Send rate for %(campaign)s ended at %(rate).1f/s'),
+                {'campaign': self, 'rate': limiter.rate}
+            )
+        if window is not None:
+            window.report()
+        return sender.sent, sender.failed
+
+    async def adeliver(self, recipients, plan, mode, limiter=None):
+        """ Like `deliver()`, with the asyncio delivery engine. """
+        recipients = self.stream_recipients(recipients)
+        window = self.get_send_window()
+        if window is not None:
+            recipients = window.track(recipients)
+        ledger = DeliveryLedger(self, autoflush=False)
+        engine = AsyncDeliveryEngine(
+            self, plan, mode, limiter=limiter, ledger=ledger
+        )
+        try:
+            await engine.run(recipients)
+        finally:
+            await sync_to_async(ledger.flush)()
+        if window is not None:
+            window.report()
+        return engine.sent, engine.failed
+
+    def get_recipient_queryset(self):
+        """
+        Subscribed recipients the campaign has not been delivered to yet,
+        according to the delivery ledger. Failed deliveries are left to the
+        retry worker, which keeps to their backoff and attempt limit. With a
+        send window, only those whose scheduled time has come, in that order
+        and annotated with it; the others are left for a later submission
+        pass.
+        """
+        recipients = self.recipients.filter(unsubscribed=False).exclude(
+            _id__in=self.deliveries.filter(
+                status__in=(Delivery.SENT, Delivery.FAILED)
+            ).values('profile')
+        )
+        if not self.send_window:
+            return recipients
+        return recipients.filter(
+            models.Q(deliveries__scheduled__isnull=True) |
+            models.Q(deliveries__scheduled__lte=now()),
+            deliveries__campaign=self
+        ).annotate(
+            scheduled=models.F('deliveries__scheduled')
+        ).order_by('scheduled', '_id')
+
+    def get_send_window(self):
+        """ A `SendWindow` tracking the submission, if it has a window. """
+        if self.send_window:
+            return SendWindow(self)
+        return None
+
+    def stream_recipients(self, recipients):
+        """
+        Iterate over a recipient queryset without caching it, fetching
+        NEWSLETTER_RECIPIENT_CHUNK_SIZE rows at a time (from a server-side
+        cursor where the database has them). Only the fields needed to
+        render and address a message are loaded, with the user in the
+        same query, so memory use does not grow with the list.
+        """
+        return recipients.select_related('user').only(
+            *RECIPIENT_FIELDS
+        ).iterator(chunk_size=newsletter_settings.RECIPIENT_CHUNK_SIZE)
+
+    def get_unsubscribe_uri(self, request=None):
         site_url = Site.objects.get_current().domain
-        print (site_url)
         if request:
             abs_uri = request.build_absolute_uri('/newsletter/delete/')
         else:
             site_url = 'http://127.0.0.1:8000/'  # REMOVE IN PRODUCTION
             abs_uri = f'{site_url}/newsletter/delete/'
             abs_uri = abs_uri.replace('//', '/')
-            print(abs_uri)
+        return abs_uri
+
+    def prepare_submission(self, request=None):
+        """
+        Resolve the recipients, queue them in the delivery ledger and mark
+        the campaign as sending. Recipients already delivered to by an
+        earlier, interrupted submission are skipped. Returns a
+        (recipients, abs_uri) tuple, `abs_uri` being the unsubscribe URL
+        the render plan is built with.
+        """
+        self.get_recipients()
+        queue_deliveries(self)
+        recipients = self.get_recipient_queryset()
+        count = recipients.count()
 
-        subject = self.emailmsg.subject.strip()
-        contents = self.emailmsg.contents.read().decode('utf-8')
+        logger.info(
+            gettext("Submitting %(campaign)s to %(count)d people"),
+            {'campaign': self, 'count': count}
+        )
+        if self.resume_at is None:
+            # With a send window, this is only its first pass; later passes
+            # add to the same progress.
+            if self.send_window:
+                count = self.deliveries.filter(
+                    status=Delivery.QUEUED, profile__unsubscribed=False
+                ).count()
+            self.start_progress(count)
 
-        (subject_template, text_template, html_template) = \
-            self.get_templates('message')
+        assert self.publish_date < now(), \
+            'Error -  campaign creation time in the future.'
 
-        try:
-            for idx, recipient in enumerate(recipients, start=1):
-                if hasattr(settings, 'NEWSLETTER_EMAIL_DELAY'):
-                    time.sleep(settings.NEWSLETTER_EMAIL_DELAY)
-                if hasattr(settings, 'NEWSLETTER_BATCH_SIZE') and settings.NEWSLETTER_BATCH_SIZE > 0:
-                    if idx % settings.NEWSLETTER_BATCH_SIZE == 0:
-                        time.sleep(settings.NEWSLETTER_BATCH_DELAY)
-                self.send_message(recipient, subject, contents, abs_uri, subject_template, text_template, html_template)
-                print (recipient) # Saran
-            self.sent = True
+        type(self).objects.filter(pk=self.pk).update(sending=True)
+        self.sending = True
 
-        finally:
-            self.sending = False
-            self.save()
-
-    def send_message(self, recipient, subject, contents, abs_uri, subject_template, text_template, html_template):
-        unsub_url = ("{}?email={}&conf_num={}").format(abs_uri, recipient.email, recipient.conf_num)
-        message_dict = {
-            'recipient': recipient,
-            'site': Site.objects.get_current(),
-            'campaign': self,
-            'subject': subject,
-            'message': self.emailmsg,
-            'contents': contents,
-            'date': self.publish_date,
-            'STATIC_URL': settings.STATIC_URL,
-            'MEDIA_URL': settings.MEDIA_URL,
-            'unsub_url': unsub_url,
-            'first_name':recipient.first_name
+        return recipients, self.get_unsubscribe_uri(request)
+
+    def start_progress(self, total):
+        """ Reset the progress counters for a submission to `total`. """
+        timestamp = now()
+        type(self).objects.filter(pk=self.pk).update(
+            total_count=total, sent_count=0, failed_count=0,
+            progress_started=timestamp, progress_updated=timestamp
+        )
+        self.total_count = total
+        self.sent_count = self.failed_count = 0
+        self.progress_started = self.progress_updated = timestamp
+
+    def update_progress(self, sent, failed, timestamp=None):
+        """
+        Add to the progress counters in a single UPDATE, which is safe from
+        any number of processes. Called by the delivery ledger when it
+        flushes, so once per NEWSLETTER_LEDGER_BATCH_SIZE messages.
+        """
+        type(self).objects.filter(pk=self.pk).update(
+            sent_count=models.F('sent_count') + sent,
+            failed_count=models.F('failed_count') + failed,
+            progress_updated=timestamp or now()
+        )
+
+    def get_progress(self):
+        """
+        Progress of the current or last submission from the persisted
+        counters, with the average rate and the estimated seconds left.
+        Failed messages count as done until they are retried.
+        """
+        done = self.sent_count + self.failed_count
+        rate = eta = None
+        if self.progress_started and self.progress_updated and done:
+            elapsed = (
+                self.progress_updated - self.progress_started
+            ).total_seconds()
+            if elapsed > 0:
+                rate = done / elapsed
+                eta = max(self.total_count - done, 0) / rate
+        return {
+            'total': self.total_count,
+            'sent': self.sent_count,
+            'failed': self.failed_count,
+            'percent': (
+                min(100.0, 100.0 * done / self.total_count)
+                if self.total_count else None
+            ),
+            'rate': rate,
+            'eta': eta if self.sending else None,
+            'sending': self.sending,
+            'queued': self.prepared and not self.sent and not self.sending,
+            'done': self.sent,
+            'started': self.progress_started,
+            'updated': self.progress_updated,
         }
-        unsub = ('<br><br><br><small><a href="{}">Unsubscribe</a><small>').format(unsub_url)
 
-        if self.send_plain:
-            plaintext = text_template.render(message_dict)
+    def finish_submission(self):
+        """
+        Mark the submission as over, releasing the claim on the campaign.
+        With a send window, a campaign whose every due recipient was sent to
+        is only marked sent when no recipients are left for later; otherwise
+        its next pass is scheduled in `resume_at`.
+        """
+        if self.sent and self.send_window:
+            self.resume_at = self.get_next_pass()
+            self.sent = self.resume_at is None
+
+        # Released and rescheduled campaigns are picked up by the daemon's
+        # polls for modified campaigns.
+        values = {
+            'sending': False, 'sent': self.sent, 'resume_at': self.resume_at,
+            'modified': now(),
+        }
+        if not self.claimed_by:
+            type(self).objects.filter(pk=self.pk).update(**values)
+            self.sending = False
+            submission_finished.send(sender=self)
+            return
+
+        # Release the claim, unless another worker has taken it over.
+        released = type(self).objects.filter(
+            pk=self.pk, claimed_by=self.claimed_by
+        ).update(claimed_by='', lease_expires=None, **values)
+        if not released:
+            logger.error(
+                gettext('%(campaign)s was taken over by another worker '
+                        'before %(worker)s finished it.'),
+                {'campaign': self, 'worker': self.claimed_by}
+            )
+        self.sending = False
+        self.claimed_by = ''
+        self.lease_expires = None
+        submission_finished.send(sender=self)
+
+    def get_next_pass(self):
+        """
+        When the next submission pass of a campaign with a send window is
+        due: when its next queued recipient is, but at most every
+        NEWSLETTER_WINDOW_INTERVAL seconds. None when none are queued.
+        """
+        scheduled = self.deliveries.filter(
+            status=Delivery.QUEUED, profile__unsubscribed=False
+        ).aggregate(next=models.Min('scheduled'))['next']
+        if scheduled is None:
+            return None
+        return max(scheduled, now() + datetime.timedelta(
+            seconds=newsletter_settings.WINDOW_INTERVAL
+        ))
+
+    def get_render_plan(self, abs_uri):
+        """ Compile templates and shared context once for a submission. """
+        return RenderPlan(self, abs_uri)
 
-            message = EmailMultiAlternatives(
-                subject, plaintext,
-                from_email=self.get_sender(),
+    def get_message_headers(self):
+        # Set the Message-ID up front so the ledger knows it once sent.
+        return {'Message-ID': make_msgid(domain=DNS_NAME)}
+
+    def build_message(self, recipient, plan):
+        plaintext, html_content = plan.render(recipient)
+
+        if self.send_plain:
+            message = SkeletonMessage(
+                plan.subject, plaintext,
+                from_email=plan.sender,
                 # to=[[recipient.get_recipient_addr() for recipient in self.recipients.all()]],
                 to=[recipient.get_recipient_addr()],
                 # headers=self.extra_headers,
+                headers=self.get_message_headers(),
+                skeleton=plan.skeleton,
             )
 
-            if self.send_html:
-                if self.use_template:
-                    html_content = html_template.render(message_dict)
-                else:
-                    django_engine = engines['django']
-                    template = django_engine.from_string(contents)
-                    context = {'first_name':recipient.first_name}
-                    html_body = template.render(context=context, request=None)
-                    html_content = html_body + unsub
-
+            if html_content is not None:
                 message.attach_alternative(html_content, "text/html")
         
         else:
-            django_engine = engines['django']
-            template = django_engine.from_string(contents)
-            context = {'first_name':recipient.first_name}
-            html_body = template.render(context=context, request=None)
-            html_content = html_body + unsub
-            message = EmailMessage(
-                subject, html_content,
-                from_email=self.get_sender(),
+            message = SkeletonMessage(
+                plan.subject, html_content,
+                from_email=plan.sender,
                 # to=[[recipient.get_recipient_addr() for recipient in self.recipients.all()]],
                 to=[recipient.get_recipient_addr()],
+                headers=self.get_message_headers(),
+                skeleton=plan.skeleton,
             )
             message.content_subtype = "html"
 
-        attachments = Attachment.objects.filter(campaign_id=self._id)
+        plan.attachments.attach_to(message)
 
-        for attachment in attachments:
-            message.attach_file(attachment.file.path)
+        return message
 
-        try:
-            logger.debug(
-                gettext('Submitting message to: %s.'),
-                recipient
+    def send_message(self, recipient, plan, sender):
+        """
+        Render a message for the recipient and queue it on the sender, which
+        delivers it with the rest of its batch.
+        """
+        message = self.build_message(recipient, plan)
+
+        logger.debug(
+            gettext('Submitting message to: %s.'),
+            recipient
+        )
+
+        sender.add(message, recipient)
+
+    def open_sender(self, plan, mode, limiter=None, ledger=None):
+        """
+        Return a sender to add recipients to with `add_recipient()`.
+        In 'personalizations' mode the message is rendered once here, with
+        substitution tags, and sent through SendGrid in batches of
+        personalizations.
+        """
+        if mode != 'personalizations':
+            return make_sender(limiter, ledger=ledger)
+
+        plaintext, html_content = plan.render_tagged()
+        attachments = list(plan.attachments.parts())
+
+        def sender_factory():
+            return PersonalizationSender(
+                plan.sender, plan.subject, plaintext, html_content,
+                attachments=attachments, limiter=limiter, ledger=ledger
             )
-            print (f'Submitting message to: {recipient}')
 
-            message.send(fail_silently=False)
+        return make_sender(limiter, sender_factory=sender_factory)
 
-        except Exception as e:
-            # TODO: Test coverage for this branch.
-            logger.error(
-                gettext('Message %(recipients)s failed '
-                        'with error: %(error)s'),
-                {'recipients': recipient,
-                 'error': e}
+    def add_recipient(self, recipient, plan, mode, sender):
+        """ Queue the campaign for one recipient on an `open_sender()` sender. """
+        message_queued.send(sender=self, recipient=recipient)
+        if mode == 'personalizations':
+            personalization = make_personalization(
+                recipient.email, recipient.name,
+                plan.get_substitutions(recipient)
             )
+            sender.add(personalization, recipient)
+        else:
+            self.send_message(recipient, plan, sender)
 
     @classmethod
-    def submit_queue(cls):
-        todo = cls.objects.filter(
-            prepared=True, sent=False, sending=False,
-            publish_date__lt=now()
+    def get_queue(cls):
+        """
+        Campaigns that are prepared and due, but not sent, and not being
+        sent by a worker that still holds its lease. Campaigns with a send
+        window are due again whenever their next pass is.
+        """
+        timestamp = now()
+        return cls.objects.filter(
+            models.Q(sending=False) | models.Q(lease_expires__lt=timestamp),
+            models.Q(resume_at__isnull=True) |
+            models.Q(resume_at__lte=timestamp),
+            prepared=True, sent=False, publish_date__lt=timestamp
+        )
+
+    def claim(self, owner):
+        """
+        Atomically claim the campaign for the queue worker `owner`, unless
+        it is no longer queued. The claim is a single conditional UPDATE,
+        so of several workers racing for a campaign only one wins it; it
+        holds for NEWSLETTER_LEASE_DURATION seconds unless renewed by a
+        `LeaseKeeper`. Returns whether the campaign was claimed.
+        """
+        expires = get_lease_expiry()
+        claimed = type(self).get_queue().filter(pk=self.pk).update(
+            sending=True, claimed_by=owner, lease_expires=expires
+        )
+        if claimed:
+            if self.sending:
+                logger.warning(
+                    gettext('Taking over %(campaign)s from %(worker)s, '
+                            'whose lease expired.'),
+                    {'campaign': self, 'worker': self.claimed_by}
+                )
+            self.sending = True
+            self.claimed_by = owner
+            self.lease_expires = expires
+        return bool(claimed)
+
+    @classmethod
+    def claim_queue(cls, owner):
+        """ Claim the due campaigns for `owner`; returns those it won. """
+        return [
+            campaign for campaign in cls.get_queue().order_by('publish_date')
+            if campaign.claim(owner)
+        ]
+
+    @classmethod
+    def submit_queue(cls, workers=1, engine='sync', mode=None, limiter=None):
+        """
+        Submit all due campaigns. With more than one worker, each campaign
+        is sharded across that many processes. Otherwise they are sent
+        together, interleaved by priority under one send rate, so a small
+        campaign is not held up behind a large one.
+
+        Campaigns are claimed first, so queue workers on any number of hosts
+        may run at once without sending a campaign twice; the campaigns of a
+        worker that died are taken over once its leases expire.
+
+        Single-process submissions share `limiter`, if given, e.g. with
+        other submissions running in the same process.
+        """
+        owner = get_worker_id()
+        todo = cls.claim_queue(owner)
+
+        with LeaseKeeper(todo, owner) as leases:
+            if workers > 1:
+                for campaign in todo:
+                    submit_sharded(
+                        campaign, workers, mode=mode, engine=engine
+                    )
+                    leases.release(campaign)
+            elif todo:
+                if limiter is None:
+                    limiter = get_rate_limiter()
+                FairScheduler(
+                    todo, get_delivery_mode(mode), limiter, leases=leases
+                ).run()
+
+    def get_due_retries(self):
+        """ Failed deliveries whose next attempt is due. """
+        return self.deliveries.filter(
+            status=Delivery.FAILED, next_attempt__lte=now()
+        )
+
+    def claim_due_retries(self, limit):
+        """
+        Claim up to `limit` due retries by clearing their `next_attempt`,
+        and return their ids. Where the database can skip locked rows, the
+        rows are locked while claimed, so concurrent retry workers each get
+        their own; elsewhere each row is claimed with a conditional UPDATE,
+        so of several workers racing for a retry only one wins it.
+        """
+        due = self.get_due_retries().order_by('next_attempt', 'pk')
+        if connection.features.has_select_for_update_skip_locked:
+            with transaction.atomic():
+                pks = list(
+                    due.select_for_update(skip_locked=True)
+                    .values_list('pk', flat=True)[:limit]
+                )
+                if pks:
+                    Delivery.objects.filter(pk__in=pks).update(
+                        next_attempt=None
+                    )
+            return pks
+
+        # Without row locks, e.g. on SQLite, a transaction would only add
+        # lock contention.
+        return [
+            pk for pk in due.values_list('pk', flat=True)[:limit]
+            if Delivery.objects.filter(
+                pk=pk, next_attempt__isnull=False
+            ).update(next_attempt=None)
+        ]
+
+    def retry(self, mode=None):
+        """
+        Retry the failed deliveries that are due, in chunks of
+        NEWSLETTER_RECIPIENT_CHUNK_SIZE; see `submit()` for `mode`. Each
+        chunk is claimed first by clearing its `next_attempt`, and failures
+        are rescheduled by the delivery ledger. Returns a (sent, failed)
+        tuple.
+        """
+        mode = get_delivery_mode(mode)
+        chunk_size = newsletter_settings.RECIPIENT_CHUNK_SIZE
+        sent = failed = 0
+        plan = None
+
+        try:
+            while True:
+                pks = self.claim_due_retries(chunk_size)
+                if not pks:
+                    break
+
+                if plan is None:
+                    plan = self.get_render_plan(self.get_unsubscribe_uri())
+                recipients = self.recipients.filter(
+                    unsubscribed=False, deliveries__pk__in=pks
+                )
+                chunk_sent, chunk_failed = self.deliver(
+                    recipients, plan, mode, get_rate_limiter()
+                )
+                sent += chunk_sent
+                failed += chunk_failed
+
+        finally:
+            if plan is not None:
+                plan.close()
+
+        if sent or failed:
+            logger.info(
+                gettext('Retried %(campaign)s: %(sent)d sent, '
+                        '%(failed)d failed'),
+                {'campaign': self, 'sent': sent, 'failed': failed}
+            )
+        return sent, failed
+
+    def get_delivery_counts(self):
+        """
+        Ledger counts by status, plus the deliveries waiting for a retry and
+        the most attempts made for any recipient.
+        """
+        counts = dict.fromkeys(
+            (status for status, label in Delivery.STATUS_CHOICES), 0
+        )
+        counts.update(
+            self.deliveries.values_list('status').annotate(
+                count=models.Count('pk')
+            ).order_by()
         )
+        counts['retrying'] = self.deliveries.filter(
+            status=Delivery.FAILED, next_attempt__isnull=False
+        ).count()
+        counts['max_attempts'] = self.deliveries.aggregate(
+            max_attempts=models.Max('attempts')
+        )['max_attempts'] or 0
+        return counts
+
+    @classmethod
+    def retry_queue(cls):
+        """ Retry the due failed deliveries of all campaigns. """
+        todo = cls.objects.filter(
+            deliveries__status=Delivery.FAILED,
+            deliveries__next_attempt__lte=now()
+        ).distinct()
 
         for campaign in todo:
-            campaign.submit()
+            campaign.retry()
 
     @classmethod
-    def from_message(cls, emailmsg, recipients):
+    async def asubmit_queue(cls):
+        owner = get_worker_id()
+        todo = await sync_to_async(cls.claim_queue)(owner)
+
+        with LeaseKeeper(todo, owner) as leases:
+            for campaign in todo:
+                await campaign.asubmit()
+                leases.release(campaign)
+
+    @classmethod
+    def from_message(cls, emailmsg, recipients=None, **kwargs):
+        """
+        Create a campaign sending `emailmsg` to the `recipients` queryset,
+        if given, with a title and unique slug derived from the newsletter.
+        Other field values can be passed as keyword arguments.
+        """
         logger.debug(gettext('Campaign for emailmsg %s'), emailmsg)
-        campaign = cls()
-        campaign.emailmsg = emailmsg
+        timestamp = localtime(now())
+        if 'title' not in kwargs:
+            suffix = timestamp.strftime(' %Y-%m-%d %H:%M:%S')
+            max_length = cls._meta.get_field('title').max_length
+            kwargs['title'] = (
+                emailmsg.title[:max_length - len(suffix)] + suffix
+            )
+        campaign = cls(emailmsg=emailmsg, **kwargs)
+        campaign.slug = cls.get_available_slug(
+            '%s-%s' % (emailmsg.slug, timestamp.strftime('%Y%m%d-%H%M%S'))
+        )
         campaign.save()
-        try:
-            campaign.recipients.set(recipients)
-        except AttributeError:  # Django < 1.10
-            campaign.recipients = recipients
+        if recipients is not None:
+            campaign.add_recipients(recipients)
         return campaign
 
+    @classmethod
+    def get_available_slug(cls, slug):
+        """ `slug`, or `slug` with a numeric suffix if it is taken. """
+        max_length = cls._meta.get_field('slug').max_length
+        slug = slug[:max_length]
+        candidate = slug
+        suffix = 1
+        while cls.objects.filter(slug=candidate).exists():
+            suffix += 1
+            tail = '-%d' % suffix
+            candidate = slug[:max_length - len(tail)] + tail
+        return candidate
+
     def save(self, **kwargs):
         """ Set the newsletter from associated message upon saving. """
         assert self.emailmsg
 
         self.emailmsg = self.emailmsg
 
-        return super().save()
+        if not self._state.adding and 'update_fields' not in kwargs:
+            # Progress and submission state are only written with UPDATEs,
+            # by whichever process is sending; do not overwrite them from an
+            # earlier copy, e.g. one saved in the admin during a submission.
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key
+                and field.name not in PROGRESS_FIELDS + STATE_FIELDS
+            ]
+
+        return super().save(**kwargs)
 
     def get_absolute_url(self):
         assert self.emailmsg.slug
@@ -565,10 +1200,241 @@ class Campaign(models.Model):
         )
 
 
+class Delivery(models.Model):
+    """
+    Delivery ledger: the outcome of a campaign for one recipient. Rows are
+    queued when a submission starts and updated in bulk as messages go
+    out, so an interrupted submission resumes where it stopped.
+
+    Failed deliveries are retried with exponential backoff until
+    NEWSLETTER_RETRY_MAX_ATTEMPTS attempts were made; `next_attempt` is
+    when the next one is due, or None when no retry is pending.
+    """
+    QUEUED = 'queued'
+    SENT = 'sent'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (QUEUED, _('queued')),
+        (SENT, _('sent')),
+        (FAILED, _('failed')),
+    )
+
+    campaign = models.ForeignKey(
+        'Campaign', verbose_name=_('campaign'), on_delete=models.CASCADE,
+        related_name='deliveries'
+    )
+    profile = models.ForeignKey(
+        'Profile', verbose_name=_('profile'), on_delete=models.CASCADE,
+        related_name='deliveries'
+    )
+    status = models.CharField(
+        max_length=10, choices=STATUS_CHOICES, default=QUEUED,
+        verbose_name=_('status'), db_index=True
+    )
+    updated = models.DateTimeField(default=now, verbose_name=_('updated'))
+    message_id = models.CharField(
+        max_length=255, blank=True, null=True,
+        verbose_name=_('provider message id')
+    )
+    attempts = models.PositiveIntegerField(
+        default=0, verbose_name=_('attempts')
+    )
+    scheduled = models.DateTimeField(
+        verbose_name=_('scheduled'), blank=True, null=True, db_index=True,
+        help_text=_("When it is due within the campaign's send window.")
+    )
+    next_attempt = models.DateTimeField(
+        blank=True, null=True, db_index=True,
+        verbose_name=_('next attempt')
+    )
+    error = models.TextField(blank=True, default='', verbose_name=_('error'))
+
+    objects = models.Manager()
+
+    class Meta:
+        verbose_name = _('delivery')
+        verbose_name_plural = _('deliveries')
+        unique_together = ('campaign', 'profile')
+
+    def __str__(self):
+        return _("%(campaign)s to %(profile)s: %(status)s") % {
+            'campaign': self.campaign,
+            'profile': self.profile,
+            'status': self.get_status_display()
+        }
+
+
+class Task(models.Model):
+    """
+    A background job, run by the task workers of the run_workers command;
+    see `djangridApp.tasks` for the jobs. Workers claim tasks with a lease
+    that they renew while running them, so the tasks of a worker that died
+    are run again once the lease expired. Failed tasks are retried with the
+    delivery retry backoff until NEWSLETTER_TASK_MAX_ATTEMPTS attempts were
+    made; the return value of a successful one is kept as its result.
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (QUEUED, _('queued')),
+        (RUNNING, _('running')),
+        (DONE, _('done')),
+        (FAILED, _('failed')),
+    )
+
+    name = models.CharField(max_length=100, verbose_name=_('name'))
+    kwargs = models.JSONField(
+        default=dict, blank=True, encoder=DjangoJSONEncoder,
+        verbose_name=_('arguments')
+    )
+    status = models.CharField(
+        max_length=10, choices=STATUS_CHOICES, default=QUEUED,
+        verbose_name=_('status'), db_index=True
+    )
+    run_at = models.DateTimeField(
+        default=now, db_index=True, verbose_name=_('run at')
+    )
+    attempts = models.PositiveIntegerField(
+        default=0, verbose_name=_('attempts')
+    )
+    max_attempts = models.PositiveIntegerField(
+        default=1, verbose_name=_('max attempts')
+    )
+    claimed_by = models.CharField(
+        max_length=255, blank=True, default='', editable=False,
+        verbose_name=_('claimed by')
+    )
+    lease_expires = models.DateTimeField(
+        blank=True, null=True, editable=False, db_index=True,
+        verbose_name=_('lease expires')
+    )
+    result = models.JSONField(
+        blank=True, null=True, encoder=DjangoJSONEncoder,
+        verbose_name=_('result')
+    )
+    error = models.TextField(blank=True, default='', verbose_name=_('error'))
+    created = models.DateTimeField(default=now, verbose_name=_('created'))
+    started = models.DateTimeField(
+        blank=True, null=True, verbose_name=_('started')
+    )
+    finished = models.DateTimeField(
+        blank=True, null=True, verbose_name=_('finished')
+    )
+
+    objects = models.Manager()
+
+    class Meta:
+        verbose_name = _('task')
+        verbose_name_plural = _('tasks')
+        ordering = ('-created',)
+
+    def __str__(self):
+        return _("%(name)s #%(pk)s: %(status)s") % {
+            'name': self.name,
+            'pk': self.pk,
+            'status': self.get_status_display()
+        }
+
+    @classmethod
+    def get_queue(cls):
+        """
+        Tasks that are due, and running tasks whose worker did not renew
+        its lease.
+        """
+        timestamp = now()
+        return cls.objects.filter(
+            models.Q(status=cls.QUEUED, run_at__lte=timestamp) |
+            models.Q(status=cls.RUNNING, lease_expires__lt=timestamp)
+        )
+
+    @classmethod
+    def claim_next(cls, owner, limit=10):
+        """
+        Claim the task due longest for the worker `owner`, or return None.
+        Where the database can skip locked rows, candidates locked by other
+        workers are skipped; either way the claim is a conditional UPDATE,
+        so of several workers racing for a task only one wins it.
+        """
+        due = cls.get_queue().order_by('run_at', 'pk')
+        if connection.features.has_select_for_update_skip_locked:
+            with transaction.atomic():
+                return cls.claim_first(
+                    owner, due.select_for_update(skip_locked=True)[:1]
+                )
+        # Without row locks, e.g. on SQLite, a transaction would only add
+        # lock contention.
+        return cls.claim_first(owner, due[:limit])
+
+    @classmethod
+    def claim_first(cls, owner, candidates):
+        """ Claim the first of `candidates` that is still due. """
+        for task in candidates:
+            expires = get_lease_expiry()
+            claimed = cls.get_queue().filter(pk=task.pk).update(
+                status=cls.RUNNING, claimed_by=owner, lease_expires=expires,
+                attempts=models.F('attempts') + 1, started=now()
+            )
+            if claimed:
+                if task.status == cls.RUNNING:
+                    logger.warning(
+                        gettext('Taking over %(task)s from %(worker)s, '
+                                'whose lease expired.'),
+                        {'task': task, 'worker': task.claimed_by}
+                    )
+                task.refresh_from_db()
+                return task
+        return None
+
+    def complete(self, result=None):
+        """
+        Store the result, unless the lease was lost meanwhile; returns
+        whether it was stored.
+        """
+        return self.finish(status=self.DONE, result=result, error='')
+
+    def fail(self, error):
+        """
+        Record a failed attempt, and queue the next one with backoff unless
+        this was the last.
+        """
+        if self.attempts < self.max_attempts:
+            return self.finish(
+                status=self.QUEUED, error=error, finished=None,
+                run_at=now() + datetime.timedelta(
+                    seconds=get_retry_delay(self.attempts)
+                )
+            )
+        return self.finish(status=self.FAILED, error=error)
+
+    def defer(self, run_at):
+        """ Queue the task again for `run_at`, not counting this attempt. """
+        return self.finish(
+            status=self.QUEUED, run_at=run_at, attempts=self.attempts - 1,
+            finished=None
+        )
+
+    def finish(self, **values):
+        """
+        Release the claim and update `values` with a conditional UPDATE;
+        returns whether the task was still claimed by this worker.
+        """
+        values.setdefault('finished', now())
+        values.update(claimed_by='', lease_expires=None)
+        updated = type(self).objects.filter(
+            pk=self.pk, claimed_by=self.claimed_by
+        ).update(**values)
+        if updated:
+            for name, value in values.items():
+                setattr(self, name, value)
+        return bool(updated)
+
+
 def attachment_upload_to(instance, filename):
     return os.path.join(
         'newsletter', 'attachments',
-        datetime.utcnow().strftime('%Y-%m-%d'),
+        datetime.datetime.utcnow().strftime('%Y-%m-%d'),
         str(instance.campaign._id),
         filename
     )
@@ -0,0 +1,180 @@
+""" App settings with defaults, overridable from Django's settings. """
+
+from django.conf import settings as django_settings
+
+from .utils import Singleton
+
+
+class Settings:
+    """
+    A settings object that proxies settings and handles defaults.
+
+    A single instance of this class is created as `newsletter_settings`,
+    from which `NEWSLETTER_SETTING_NAME` can be accessed as `SETTING_NAME`,
+    i.e.::
+
+        from djangridApp.settings import newsletter_settings
+
+        if newsletter_settings.SETTING_NAME:
+            ...
+
+    If a setting has not been explicitly defined in Django's settings, the
+    default is taken from the `DEFAULT_SETTING_NAME` class variable.
+    """
+
+    def __init__(self):
+        """ Assert app-specific prefix. """
+        assert hasattr(self, 'settings_prefix'), 'No prefix specified.'
+
+    def __getattr__(self, attr):
+        """
+        Return Django setting `PREFIX_SETTING` if explicitly specified,
+        otherwise return `DEFAULT_SETTING` if specified.
+        """
+        if attr.isupper():
+            # Require settings to have uppercase characters
+            try:
+                setting = getattr(
+                    django_settings,
+                    '%s_%s' % (self.settings_prefix, attr),
+                )
+            except AttributeError:
+                if not attr.startswith('DEFAULT_'):
+                    setting = getattr(self, 'DEFAULT_%s' % attr)
+                else:
+                    raise
+
+            return setting
+
+        else:
+            # Default behaviour
+            raise AttributeError(
+                'No setting or default available for \'%s\'' % attr
+            )
+
+
+class NewsletterSettings(Settings, metaclass=Singleton):
+    """ Django-newsletter style settings, prefixed with `NEWSLETTER_`. """
+
+    settings_prefix = 'NEWSLETTER'
+
+    # Bytes of encoded attachments kept in memory during a submission;
+    # anything beyond is spilled to a temporary file.
+    DEFAULT_ATTACHMENT_CACHE_SIZE = 10 * 1024 * 1024
+
+    # Newsletter bodies kept per submission, keyed by the personalization
+    # context, so recipients with the same first name share one render.
+    DEFAULT_RENDER_CACHE_SIZE = 1024
+
+    # Messages handed to the mail backend per send_messages() call.
+    DEFAULT_SEND_BATCH_SIZE = 100
+
+    # Seconds for which the signed links in confirmation e-mails and
+    # newsletters stay valid; None for no limit. Unsubscribe links in
+    # newsletters must keep working however old the newsletter is.
+    DEFAULT_CONFIRM_TOKEN_MAX_AGE = 7 * 24 * 60 * 60
+    DEFAULT_UNSUBSCRIBE_TOKEN_MAX_AGE = None
+
+    # Attempts made per recipient before a failed delivery is given up on,
+    # the backoff before the first retry, doubling with every further
+    # attempt up to the maximum (all in seconds, with random jitter), and
+    # how often the retry worker looks for due retries.
+    DEFAULT_RETRY_MAX_ATTEMPTS = 5
+    DEFAULT_RETRY_BACKOFF = 60
+    DEFAULT_RETRY_BACKOFF_MAX = 6 * 60 * 60
+    DEFAULT_RETRY_INTERVAL = 30
+
+    # Seconds a queue worker's claim on a campaign lasts without being
+    # renewed; the worker renews it every third of that while sending, so
+    # another worker only takes the campaign over when the first one died.
+    DEFAULT_LEASE_DURATION = 5 * 60
+
+    # Seconds between the submission passes of a campaign with a send
+    # window; each pass sends to the recipients that are due by then.
+    DEFAULT_WINDOW_INTERVAL = 60
+
+    # Seconds between the delivery daemon's checks for new and changed
+    # campaigns; it wakes up for publication dates it knows of regardless.
+    DEFAULT_DAEMON_POLL_INTERVAL = 30
+
+    # Attempts made at a background task before it is given up on (retried
+    # with the delivery retry backoff), and seconds between a task worker's
+    # checks for due tasks while idle.
+    DEFAULT_TASK_MAX_ATTEMPTS = 3
+    DEFAULT_TASK_POLL_INTERVAL = 2
+
+    # Processes, and threads per process, run by the run_workers command.
+    DEFAULT_WORKER_PROCESSES = 1
+    DEFAULT_WORKER_THREADS = 4
+
+    # The delivery engine ('sync' or 'async') of campaign submissions run
+    # by the task workers, and the processes each campaign is sharded over.
+    DEFAULT_SUBMIT_ENGINE = 'sync'
+    DEFAULT_SUBMIT_PROCESSES = 1
+
+    # The storage CSV exports are written to, as the dotted path to a
+    # storage class and the keyword arguments it is created with. Exports
+    # hold personal data: use a location that is not served publicly.
+    # Exporting is disabled until it is set. Exports are deleted after
+    # EXPORT_MAX_AGE seconds.
+    DEFAULT_EXPORT_STORAGE = None
+    DEFAULT_EXPORT_STORAGE_OPTIONS = {}
+    DEFAULT_EXPORT_MAX_AGE = 24 * 60 * 60
+
+    # Whether the sending commands and task workers collect delivery metrics
+    # (they do regardless when serving them with --metrics-port).
+    DEFAULT_METRICS = False
+
+    # Recipients fetched per round trip while streaming a submission.
+    DEFAULT_RECIPIENT_CHUNK_SIZE = 2000
+
+    # Delivery ledger rows inserted or updated per query.
+    DEFAULT_LEDGER_BATCH_SIZE = 500
+
+    # Sender threads per submission, each with its own backend connection.
+    DEFAULT_SEND_WORKERS = 1
+
+    # Messages per second shared by all sender threads, None for no limit,
+    # and the number of messages that may be sent at once after idling.
+    DEFAULT_SEND_RATE = None
+    DEFAULT_SEND_BURST = None
+
+    # Adapt the send rate to the provider's feedback: starting from
+    # SEND_RATE, raise it by SEND_RATE_INCREASE messages per second every
+    # second while sends succeed, and halve it when throttled, staying
+    # between SEND_RATE_MIN and SEND_RATE_MAX (None for no maximum).
+    DEFAULT_ADAPTIVE_RATE = False
+    DEFAULT_SEND_RATE_MIN = 1
+    DEFAULT_SEND_RATE_MAX = None
+    DEFAULT_SEND_RATE_INCREASE = 1
+
+    # In-flight sends and rendered messages queued ahead of them for the
+    # asyncio engine; the queue size defaults to four times the concurrency.
+    DEFAULT_ASYNC_CONCURRENCY = 50
+    DEFAULT_ASYNC_QUEUE_SIZE = None
+
+    # How the asyncio engine sends: 'sendgrid' posts to the v3 API directly,
+    # 'backend' uses EMAIL_BACKEND from threads and 'auto' picks 'sendgrid'
+    # when EMAIL_BACKEND is the SendGrid backend.
+    DEFAULT_ASYNC_TRANSPORT = 'auto'
+
+    # Seconds before a request of the asyncio engine to the SendGrid API
+    # fails, from sending it until its response was read; None to wait.
+    DEFAULT_ASYNC_TIMEOUT = 30
+
+    # Whether the ASGI application submits the campaign queue itself, and
+    # how many seconds it waits between runs.
+    DEFAULT_ASGI_DELIVERY = False
+    DEFAULT_ASGI_DELIVERY_INTERVAL = 60
+
+    # How campaigns are delivered by default, one of models.DELIVERY_MODES.
+    DEFAULT_DELIVERY_MODE = 'backend'
+
+    # Recipients per SendGrid request in 'personalizations' mode (max 1000).
+    DEFAULT_PERSONALIZATIONS_PER_REQUEST = 1000
+
+    # Base URL of the SendGrid v3 API; point it at a local fake for testing.
+    DEFAULT_SENDGRID_API_HOST = 'https://api.sendgrid.com'
+
+
+newsletter_settings = NewsletterSettings()
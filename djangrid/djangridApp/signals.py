@@ -0,0 +1,22 @@
+""" Signals sent while campaigns are delivered. """
+
+from django.dispatch import Signal
+
+# Sent by the campaign with `recipient` and `duration`, in seconds, when
+# its message was rendered.
+message_rendered = Signal()
+
+# Sent by the campaign with `recipient` when its message is queued for
+# sending, from the thread rendering the messages.
+message_queued = Signal()
+
+# Sent by the campaign with `recipients` and `message_id` when their
+# messages were accepted by the backend or provider, and with `recipient`
+# and `error` when a message failed. Senders may send these from their own
+# threads.
+messages_sent = Signal()
+message_failed = Signal()
+
+# Sent by the campaign when a submission, or a pass of its send window, is
+# over and its messages were sent or failed.
+submission_finished = Signal()
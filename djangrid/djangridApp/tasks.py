@@ -0,0 +1,282 @@
+"""
+Background jobs run by the task workers, see the run_workers command.
+
+A job is a function registered with `@task`, called with the keyword
+arguments it was enqueued with; its return value is stored as the task's
+result and must be serializable to JSON.
+"""
+
+import asyncio
+import csv
+import io
+import logging
+import traceback
+from datetime import timedelta
+
+from django.apps import apps
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile
+from django.db.utils import IntegrityError
+from django.utils.module_loading import import_string
+from django.utils.timezone import localtime, now
+from django.utils.translation import gettext
+
+from .delivery.lease import LeaseKeeper, get_worker_id
+from .settings import newsletter_settings
+
+logger = logging.getLogger(__name__)
+
+# Registered jobs by name.
+TASKS = {}
+
+
+class Defer(Exception):
+    """ Raised by a job to be run again at `run_at`, as the same attempt. """
+
+    def __init__(self, run_at):
+        super().__init__(run_at)
+        self.run_at = run_at
+
+
+def task(function=None, name=None):
+    """ Register `function` as a job, by its name unless `name` is given. """
+    def register(function):
+        TASKS[name or function.__name__] = function
+        return function
+
+    if function is None:
+        return register
+    return register(function)
+
+
+def enqueue(name, run_at=None, max_attempts=None, **kwargs):
+    """
+    Queue the job `name` with `kwargs`, to run at `run_at` or right away,
+    and return the task.
+    """
+    from .models import Task
+
+    assert name in TASKS, 'Unknown task: %s' % name
+    if max_attempts is None:
+        max_attempts = newsletter_settings.TASK_MAX_ATTEMPTS
+
+    task = Task(name=name, kwargs=kwargs, max_attempts=max_attempts)
+    if run_at is not None:
+        task.run_at = run_at
+    task.save()
+    return task
+
+
+def run_task(task):
+    """
+    Run a claimed task, renewing its lease meanwhile, and store its result
+    or error.
+    """
+    if task.attempts > task.max_attempts:
+        # Its worker died during the last attempt.
+        task.fail(gettext('Lease expired during the last attempt.'))
+        return
+
+    function = TASKS.get(task.name)
+    if function is None:
+        task.fail(gettext('Unknown task: %s') % task.name)
+        return
+
+    logger.info(gettext('Running %s.'), task)
+    with LeaseKeeper([task], task.claimed_by):
+        try:
+            result = function(**task.kwargs)
+        except Defer as e:
+            logger.info(gettext('Deferring %s until %s.'), task, e.run_at)
+            task.defer(e.run_at)
+            return
+        except Exception:
+            logger.exception(gettext('Error running %s.'), task)
+            task.fail(traceback.format_exc())
+            return
+
+    if not task.complete(result):
+        logger.error(
+            gettext('Lost the lease on %s; its result is discarded.'), task
+        )
+
+
+@task
+def submit_campaign(campaign_id, engine=None, workers=None, mode=None):
+    """
+    Submit a prepared campaign with `engine` from `workers` processes,
+    NEWSLETTER_SUBMIT_ENGINE and NEWSLETTER_SUBMIT_PROCESSES by default.
+    The task is deferred while the campaign is not due, or is being sent by
+    a queue worker that holds its lease, and is done once it was sent.
+    """
+    from .delivery.sharding import submit_sharded
+    from .models import Campaign
+
+    if engine is None:
+        engine = newsletter_settings.SUBMIT_ENGINE
+    if workers is None:
+        workers = newsletter_settings.SUBMIT_PROCESSES
+
+    campaign = Campaign.objects.get(pk=campaign_id)
+    owner = get_worker_id()
+    if not campaign.sent and not campaign.claim(owner):
+        campaign.refresh_from_db()
+        defer_campaign(campaign)
+
+    if not campaign.sent:
+        try:
+            with LeaseKeeper([campaign], owner):
+                if workers > 1:
+                    submit_sharded(
+                        campaign, workers, mode=mode, engine=engine
+                    )
+                elif engine == 'async':
+                    asyncio.run(campaign.asubmit(mode=mode))
+                else:
+                    campaign.submit(mode=mode)
+        finally:
+            if campaign.claimed_by == owner:
+                # Failed before the submission started; retry without
+                # waiting for the lease to expire.
+                campaign.finish_submission()
+
+        campaign.refresh_from_db()
+        defer_campaign(campaign)
+
+    return {
+        'sent': campaign.sent_count,
+        'failed': campaign.failed_count,
+    }
+
+
+def defer_campaign(campaign):
+    """
+    Defer a submission until `campaign` can be claimed, unless it was sent.
+    """
+    if campaign.sent:
+        return
+    timestamp = now()
+    if not campaign.prepared:
+        raise ValueError(gettext('%s is not prepared.') % campaign)
+    if campaign.publish_date and campaign.publish_date > timestamp:
+        raise Defer(campaign.publish_date)
+    if campaign.resume_at and campaign.resume_at > timestamp:
+        # The next pass of its send window.
+        raise Defer(campaign.resume_at)
+    if campaign.sending and campaign.lease_expires \
+            and campaign.lease_expires > timestamp:
+        # Another worker is sending it; check again once its lease would
+        # have expired, unless renewed.
+        raise Defer(campaign.lease_expires)
+    raise RuntimeError(gettext('%s was not sent.') % campaign)
+
+
+@task
+def import_profiles(addresses):
+    """
+    Create profiles for `addresses`, which maps e-mail addresses to dicts of
+    name, city, postalCode and country as returned by the import form.
+    """
+    from .admin_utils import make_profile
+
+    added = duplicates = 0
+    for email, fields in addresses.items():
+        try:
+            make_profile(
+                email, fields['name'], fields['city'], fields['postalCode'],
+                fields['country']
+            ).save()
+            added += 1
+        except IntegrityError:
+            logger.warning(
+                gettext('Email already exists. Dropping duplicate: <%s>.'),
+                email
+            )
+            duplicates += 1
+
+    return {'added': added, 'duplicates': duplicates}
+
+
+def get_export_storage():
+    """
+    Return the storage exports are written to, or None when
+    NEWSLETTER_EXPORT_STORAGE is not configured.
+    """
+    if not newsletter_settings.EXPORT_STORAGE:
+        return None
+    storage_class = import_string(newsletter_settings.EXPORT_STORAGE)
+    return storage_class(**newsletter_settings.EXPORT_STORAGE_OPTIONS)
+
+
+@task
+def export_csv(model, pks, profiles=False):
+    """
+    Export the `model` objects with primary keys `pks` to a CSV file in the
+    export storage; with `profiles`, export the profiles in the selected
+    segments instead. Returns the name of the file and the number of rows.
+    """
+    from .admin_utils import write_csv, write_profiles_csv
+
+    storage = get_export_storage()
+    if storage is None:
+        raise ImproperlyConfigured(
+            gettext('NEWSLETTER_EXPORT_STORAGE is not set.')
+        )
+    purge_exports()
+
+    model = apps.get_model(model)
+    queryset = model.objects.filter(pk__in=pks)
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if profiles:
+        rows = write_profiles_csv(writer, queryset)
+    else:
+        rows = write_csv(writer, queryset)
+
+    filename = '{}_{}.csv'.format(
+        str(model._meta).replace('.', '_'),
+        localtime(now()).strftime("%Y-%m-%d__%H_%M_%S")
+    )
+    name = storage.save(
+        filename, ContentFile(buffer.getvalue().encode('utf-8'))
+    )
+    return {'file': name, 'filename': filename, 'rows': rows}
+
+
+@task
+def purge_exports():
+    """
+    Delete the exports older than NEWSLETTER_EXPORT_MAX_AGE, including files
+    whose task is gone, and clear the file from the results of their tasks.
+    """
+    from .models import Task
+
+    storage = get_export_storage()
+    if storage is None:
+        return {'deleted': 0}
+    cutoff = now() - timedelta(seconds=newsletter_settings.EXPORT_MAX_AGE)
+
+    try:
+        names = storage.listdir('')[1]
+    except FileNotFoundError:
+        # Nothing was exported yet.
+        names = []
+
+    deleted = 0
+    for name in names:
+        if storage.get_modified_time(name) < cutoff:
+            storage.delete(name)
+            deleted += 1
+
+    # Their download links are gone too.
+    expired = Task.objects.filter(
+        name='export_csv', status=Task.DONE, finished__lt=cutoff
+    ).exclude(result__file=None)
+    for export in expired.only('pk', 'result').iterator():
+        export.result['file'] = None
+        Task.objects.filter(pk=export.pk).update(result=export.result)
+
+    if deleted:
+        logger.info(gettext('Deleted %d expired exports.'), deleted)
+    return {'deleted': deleted}
@@ -1,3 +1,1000 @@
-from django.test import TestCase
+import datetime
+import pickle
+import re
+import shutil
+import tempfile
+import time
+import zoneinfo
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from django.core import mail, signing
+from django.core.files.base import ContentFile
+from django.core.mail import EmailMultiAlternatives
+from django.core.mail.backends.locmem import EmailBackend
+from django.template import Context, Engine, engines
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils.safestring import mark_safe
+from django.utils.timezone import localtime, now
+from python_http_client.exceptions import (
+    BadRequestsError, TooManyRequestsError
+)
+
+from .delivery.fake_sendgrid import FakeSendGridServer
+from .delivery.lease import LeaseKeeper
+from .delivery.mime import MessageSkeleton, SkeletonMessage
+from .delivery.ratelimit import AdaptiveTokenBucket
+from .delivery.render import SimpleTemplate
+from .delivery.scheduler import FairScheduler
+from .delivery.sendgrid import MAX_PERSONALIZATIONS, PersonalizationSender
+from .delivery.window import SendWindow, WindowSchedule
+from .metrics import CampaignMetrics, DeliveryMetrics
+from .models import (
+    Campaign, Delivery, Newsletter, Profile, Segment, Task
+)
+from .settings import newsletter_settings
+from .signals import message_queued
+from .tasks import enqueue, run_task, task
+from .tokens import TOKEN_ACTIONS, check_token, make_token
+
+
+class MediaMixin:
+    """ Keep the files saved by a test case in a temporary MEDIA_ROOT. """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.media_root = tempfile.mkdtemp()
+        cls.media_settings = override_settings(MEDIA_ROOT=cls.media_root)
+        cls.media_settings.enable()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.media_settings.disable()
+        shutil.rmtree(cls.media_root, ignore_errors=True)
+        super().tearDownClass()
+
+
+class FakeSendGridMixin:
+    """
+    Point the SendGrid client at a `FakeSendGridServer`, started with
+    `server_options`, for the whole test case.
+    """
+    server_options = {}
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = FakeSendGridServer(**cls.server_options).start()
+        cls.server_settings = override_settings(
+            NEWSLETTER_SENDGRID_API_HOST=cls.server.url,
+            SENDGRID_API_KEY='test-key'
+        )
+        cls.server_settings.enable()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server_settings.disable()
+        cls.server.stop()
+        super().tearDownClass()
+
+    def setUp(self):
+        super().setUp()
+        with self.server.lock:
+            self.server.requests = []
+            self.server.request_count = 0
+            self.server.messages = 0
+            self.server.throttled = 0
+
+    def get_sent_emails(self):
+        """ The addresses of all personalizations the server accepted. """
+        return [
+            personalization['to'][0]['email']
+            for request in self.server.requests
+            for personalization in request['personalizations']
+        ]
+
+
+class CampaignMixin(MediaMixin):
+    """ A due campaign with `profile_count` subscribed recipients. """
+    profile_count = 5
+
+    def setUp(self):
+        super().setUp()
+        Profile.objects.bulk_create([
+            Profile(
+                email='test%d@example.com' % i, name_field='Test%d User' % i,
+                confirmed=True, conf_num='code%d' % i
+            )
+            for i in range(self.profile_count)
+        ])
+        Profile.objects.create(
+            email='gone@example.com', confirmed=True, unsubscribed=True
+        )
+
+        segment = Segment.objects.create(segment_name='Test segment')
+        segment.profiles.set(Profile.objects.all())
+
+        self.newsletter = Newsletter(
+            title='Test newsletter', slug='test-newsletter', subject='Test'
+        )
+        self.newsletter.contents.save(
+            'test.html', ContentFile(b'<p>Hello {{ first_name }}</p>'),
+            save=False
+        )
+        self.newsletter.save()
+
+        self.campaign = Campaign.objects.create(
+            emailmsg=self.newsletter, slug='test-campaign',
+            title='Test campaign',
+            publish_date=now() - datetime.timedelta(minutes=1)
+        )
+        self.campaign.segments.add(segment)
+
+    def get_subscribed_emails(self):
+        return set(
+            Profile.objects.filter(unsubscribed=False)
+            .values_list('email', flat=True)
+        )
+
+
+@override_settings(
+    NEWSLETTER_SEND_WORKERS=1, NEWSLETTER_SEND_RATE=None,
+    NEWSLETTER_PERSONALIZATIONS_PER_REQUEST=2
+)
+class PersonalizationsTestCase(FakeSendGridMixin, CampaignMixin, TestCase):
+    """ Sending in batches of SendGrid personalizations. """
+
+    def test_batches(self):
+        self.campaign.submit(mode='personalizations')
+
+        self.assertEqual(
+            [len(request['personalizations'])
+             for request in self.server.requests],
+            [2, 2, 1]
+        )
+        emails = self.get_sent_emails()
+        self.assertEqual(len(emails), len(set(emails)))
+        self.assertEqual(set(emails), self.get_subscribed_emails())
+
+        self.campaign.refresh_from_db()
+        self.assertTrue(self.campaign.sent)
+        self.assertEqual(
+            self.campaign.deliveries.filter(status=Delivery.SENT).count(), 5
+        )
+
+    def test_substitutions(self):
+        self.campaign.submit(mode='personalizations')
+
+        # One body, rendered once with substitution tags.
+        request = self.server.requests[0]
+        self.assertIn('-first_name-', request['content'][-1]['value'])
+        for personalization in request['personalizations']:
+            substitutions = personalization['substitutions']
+            self.assertIn('-first_name-', substitutions)
+            self.assertIn('token=', substitutions['-unsub_url-'])
+
+    def test_batch_size_limit(self):
+        sender = PersonalizationSender(
+            'test@example.com', 'Test', plaintext='Test', client=object(),
+            batch_size=MAX_PERSONALIZATIONS * 2
+        )
+        self.assertEqual(sender.batch_size, MAX_PERSONALIZATIONS)
+
+
+class FakeClock:
+    """ A monotonic clock for rate limiters, advanced by the test. """
+
+    def __init__(self):
+        self.time = 1000.0
+
+    def __call__(self):
+        return self.time
+
+    def advance(self, seconds):
+        self.time += seconds
+
+
+class AdaptiveRateTestCase(TestCase):
+    """ The AIMD send rate following the provider's throttling. """
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.limiter = AdaptiveTokenBucket(
+            10, min_rate=2, max_rate=12, increase=1, decrease=0.5,
+            cooldown=1.0, clock=self.clock
+        )
+
+    def throttle(self, retry_after=None):
+        headers = {'retry-after': str(retry_after)} if retry_after else {}
+        self.limiter.on_error(
+            TooManyRequestsError(429, 'Too Many Requests', b'', headers)
+        )
+
+    def test_decrease(self):
+        self.throttle()
+        self.assertEqual(self.limiter.rate, 5)
+        self.assertEqual(self.limiter.throttled, 1)
+
+        # Errors from messages already in flight count once per cooldown.
+        self.throttle()
+        self.assertEqual(self.limiter.rate, 5)
+        self.clock.advance(1)
+        self.throttle()
+        self.assertEqual(self.limiter.rate, 2.5)
+        self.clock.advance(1)
+        self.throttle()
+        self.assertEqual(self.limiter.rate, 2)
+        self.assertEqual(self.limiter.throttled, 4)
+
+    def test_increase(self):
+        self.throttle()
+        # A second's worth of accepted messages adds `increase`.
+        self.limiter.on_success(5)
+        self.assertEqual(self.limiter.rate, 6)
+        for i in range(20):
+            self.limiter.on_success(10)
+        self.assertEqual(self.limiter.rate, 12)
+
+    def test_retry_after(self):
+        self.throttle(retry_after=3)
+        self.assertAlmostEqual(self.limiter.reserve(1), 3)
+        self.clock.advance(2)
+        self.assertAlmostEqual(self.limiter.reserve(1), 1)
+        self.clock.advance(1)
+        # The bucket was emptied when pausing.
+        self.assertAlmostEqual(self.limiter.reserve(1), 1 / 5)
+        self.clock.advance(1 / 5)
+        self.assertEqual(self.limiter.reserve(1), 0)
+
+    def test_other_errors(self):
+        self.limiter.on_error(BadRequestsError(400, 'Bad Request', b'', {}))
+        self.limiter.on_error(ValueError())
+        self.assertEqual(self.limiter.rate, 10)
+        self.assertEqual(self.limiter.throttled, 0)
+
+
+@override_settings(
+    NEWSLETTER_SEND_WORKERS=1, NEWSLETTER_PERSONALIZATIONS_PER_REQUEST=1
+)
+class ThrottlingTestCase(FakeSendGridMixin, CampaignMixin, TestCase):
+    """ Backing off when the SendGrid API answers 429 Too Many Requests. """
+    server_options = {'rate_limit': 5, 'burst': 2}
+    profile_count = 8
+
+    def test_backoff(self):
+        limiter = AdaptiveTokenBucket(50, burst=5, min_rate=1)
+        recipients, abs_uri = self.campaign.prepare_submission()
+        plan = self.campaign.get_render_plan(abs_uri)
+        try:
+            sent, failed = self.campaign.deliver(
+                recipients, plan, 'personalizations', limiter
+            )
+        finally:
+            plan.close()
+            self.campaign.finish_submission()
+
+        self.assertGreater(self.server.throttled, 0)
+        self.assertGreater(limiter.throttled, 0)
+        self.assertLess(limiter.rate, 50)
+
+        # Throttled messages are left to be retried.
+        self.assertGreater(failed, 0)
+        self.assertEqual(sent + failed, 8)
+        self.assertEqual(sent, self.server.messages)
+        self.assertEqual(
+            self.campaign.deliveries.filter(
+                status=Delivery.FAILED, next_attempt__isnull=False
+            ).count(),
+            failed
+        )
+
+
+class Interrupted(Exception):
+    """ Stands in for a crash in the middle of a submission. """
+
+
+@override_settings(
+    NEWSLETTER_SEND_WORKERS=1, NEWSLETTER_SEND_RATE=None,
+    NEWSLETTER_SEND_BATCH_SIZE=1, NEWSLETTER_PERSONALIZATIONS_PER_REQUEST=2
+)
+class ResumeTestCase(FakeSendGridMixin, CampaignMixin, TestCase):
+    """
+    Resuming an interrupted submission from the delivery ledger, without
+    sending to anyone twice.
+    """
+
+    def submit_interrupted(self, mode, after):
+        """ Submit the campaign, crashing after `after` messages. """
+        queued = []
+
+        def interrupt(sender, recipient, **kwargs):
+            queued.append(recipient)
+            if len(queued) > after:
+                raise Interrupted()
+
+        message_queued.connect(interrupt, dispatch_uid='test-interrupt')
+        try:
+            with self.assertRaises(Interrupted):
+                self.campaign.submit(mode=mode)
+        finally:
+            message_queued.disconnect(dispatch_uid='test-interrupt')
+        self.campaign.refresh_from_db()
+
+    def test_personalizations(self):
+        self.submit_interrupted('personalizations', after=4)
+        self.assertFalse(self.campaign.sent)
+        self.assertFalse(self.campaign.sending)
+        self.assertEqual(len(self.get_sent_emails()), 4)
+        self.assertEqual(
+            self.campaign.deliveries.filter(status=Delivery.SENT).count(), 4
+        )
+
+        self.campaign.submit(mode='personalizations')
+
+        emails = self.get_sent_emails()
+        self.assertEqual(len(emails), len(set(emails)))
+        self.assertEqual(set(emails), self.get_subscribed_emails())
+        self.campaign.refresh_from_db()
+        self.assertTrue(self.campaign.sent)
+
+    def test_backend(self):
+        self.submit_interrupted('backend', after=3)
+        self.assertEqual(len(mail.outbox), 3)
+
+        self.campaign.submit(mode='backend')
+
+        emails = [message.to[0] for message in mail.outbox]
+        self.assertEqual(len(emails), len(set(emails)))
+        self.assertEqual(len(emails), len(self.get_subscribed_emails()))
+        self.assertEqual(
+            self.campaign.deliveries.filter(status=Delivery.SENT).count(), 5
+        )
+
+
+@task(name='test_echo')
+def echo(value):
+    return {'value': value}
+
+
+@task(name='test_fail')
+def fail():
+    raise ValueError('Test failure')
+
+
+class TaskTestCase(TestCase):
+    """ Claiming, leasing and retrying background tasks. """
+
+    def expire_lease(self, task):
+        Task.objects.filter(pk=task.pk).update(
+            lease_expires=now() - datetime.timedelta(seconds=1)
+        )
+
+    def test_claim(self):
+        queued = enqueue('test_echo', value=1)
+
+        claimed = Task.claim_next('worker-a')
+        self.assertEqual(claimed.pk, queued.pk)
+        self.assertEqual(claimed.status, Task.RUNNING)
+        self.assertEqual(claimed.claimed_by, 'worker-a')
+        self.assertEqual(claimed.attempts, 1)
+        self.assertGreater(claimed.lease_expires, now())
+        self.assertIsNone(Task.claim_next('worker-b'))
+
+        run_task(claimed)
+        claimed.refresh_from_db()
+        self.assertEqual(claimed.status, Task.DONE)
+        self.assertEqual(claimed.result, {'value': 1})
+        self.assertEqual(claimed.claimed_by, '')
+
+    def test_not_due(self):
+        enqueue(
+            'test_echo', value=1, run_at=now() + datetime.timedelta(hours=1)
+        )
+        self.assertIsNone(Task.claim_next('worker-a'))
+
+    def test_lease_takeover(self):
+        enqueue('test_echo', value=1, max_attempts=2)
+        first = Task.claim_next('worker-a')
+        self.expire_lease(first)
+
+        second = Task.claim_next('worker-b')
+        self.assertEqual(second.pk, first.pk)
+        self.assertEqual(second.claimed_by, 'worker-b')
+        self.assertEqual(second.attempts, 2)
+
+        # The first worker lost its lease, so its result is discarded.
+        self.assertFalse(first.complete({'value': 'stale'}))
+        self.assertTrue(second.complete({'value': 1}))
+        second.refresh_from_db()
+        self.assertEqual(second.result, {'value': 1})
+
+    def test_lease_expired_on_last_attempt(self):
+        enqueue('test_echo', value=1, max_attempts=1)
+        self.expire_lease(Task.claim_next('worker-a'))
+
+        claimed = Task.claim_next('worker-b')
+        run_task(claimed)
+        claimed.refresh_from_db()
+        self.assertEqual(claimed.status, Task.FAILED)
+        self.assertIn('Lease expired', claimed.error)
+
+    def test_retry(self):
+        queued = enqueue('test_fail', max_attempts=2)
+
+        run_task(Task.claim_next('worker-a'))
+        queued.refresh_from_db()
+        self.assertEqual(queued.status, Task.QUEUED)
+        self.assertEqual(queued.attempts, 1)
+        self.assertGreater(queued.run_at, now())
+        self.assertIn('Test failure', queued.error)
+        self.assertEqual(queued.claimed_by, '')
+        # Not before its backoff is over.
+        self.assertIsNone(Task.claim_next('worker-a'))
+
+        Task.objects.filter(pk=queued.pk).update(run_at=now())
+        run_task(Task.claim_next('worker-a'))
+        queued.refresh_from_db()
+        self.assertEqual(queued.status, Task.FAILED)
+        self.assertEqual(queued.attempts, 2)
+        self.assertIsNone(Task.claim_next('worker-a'))
+
+
+@override_settings(NEWSLETTER_SEND_WORKERS=1, NEWSLETTER_SEND_RATE=None)
+class SubmitCampaignTaskTestCase(CampaignMixin, TestCase):
+    """ The submit_campaign job, deferred until its campaign is due. """
+
+    def test_deferred_until_due(self):
+        publish_date = now() + datetime.timedelta(hours=1)
+        Campaign.objects.filter(pk=self.campaign.pk).update(
+            prepared=True, publish_date=publish_date
+        )
+        queued = enqueue('submit_campaign', campaign_id=self.campaign.pk)
+
+        run_task(Task.claim_next('worker-a'))
+        queued.refresh_from_db()
+        self.assertEqual(queued.status, Task.QUEUED)
+        self.assertEqual(queued.attempts, 0)
+        self.assertEqual(queued.run_at, publish_date)
+        self.assertEqual(len(mail.outbox), 0)
+
+        Campaign.objects.filter(pk=self.campaign.pk).update(
+            publish_date=now()
+        )
+        Task.objects.filter(pk=queued.pk).update(run_at=now())
+        run_task(Task.claim_next('worker-a'))
+        queued.refresh_from_db()
+        self.assertEqual(queued.status, Task.DONE)
+        self.assertEqual(queued.result, {'sent': 5, 'failed': 0})
+        self.assertEqual(len(mail.outbox), 5)
+        self.campaign.refresh_from_db()
+        self.assertTrue(self.campaign.sent)
+        self.assertEqual(self.campaign.claimed_by, '')
+
+
+@override_settings(
+    NEWSLETTER_SEND_WORKERS=1, NEWSLETTER_SEND_RATE=None,
+    NEWSLETTER_SEND_BATCH_SIZE=1, NEWSLETTER_WINDOW_INTERVAL=60
+)
+class SendWindowTestCase(CampaignMixin, TestCase):
+    """ Submitting a campaign with a send window in passes. """
+
+    def setUp(self):
+        super().setUp()
+        self.campaign.send_window = datetime.timedelta(hours=1)
+        self.campaign.save()
+
+    def make_due(self):
+        """ Move the scheduled times of all queued deliveries to now. """
+        self.campaign.deliveries.filter(status=Delivery.QUEUED).update(
+            scheduled=now()
+        )
+
+    def test_passes(self):
+        # The first of the five recipients is due right away, the others
+        # every 12 minutes after.
+        self.campaign.submit()
+        self.assertEqual(len(mail.outbox), 1)
+        self.campaign.refresh_from_db()
+        self.assertFalse(self.campaign.sent)
+        self.assertFalse(self.campaign.sending)
+        next_due = self.campaign.deliveries.filter(
+            status=Delivery.QUEUED
+        ).order_by('scheduled')[0].scheduled
+        self.assertEqual(self.campaign.resume_at, next_due)
+        self.assertEqual(
+            self.campaign.deliveries.filter(status=Delivery.QUEUED).count(), 4
+        )
+
+        # Not queued again before its next pass is due.
+        self.assertNotIn(self.campaign, Campaign.get_queue())
+
+        self.make_due()
+        self.campaign.submit()
+        self.assertEqual(len(mail.outbox), 5)
+        self.campaign.refresh_from_db()
+        self.assertTrue(self.campaign.sent)
+        self.assertIsNone(self.campaign.resume_at)
+        self.assertEqual(
+            {message.to[0] for message in mail.outbox},
+            {'Test%d User <test%d@example.com>' % (i, i) for i in range(5)}
+        )
+
+    def test_schedule(self):
+        self.campaign.publish_date = now() + datetime.timedelta(days=1)
+        schedule = WindowSchedule(self.campaign, {None: 4})
+        self.assertEqual(
+            [schedule.next() - self.campaign.publish_date for i in range(4)],
+            [datetime.timedelta(minutes=15 * i) for i in range(4)]
+        )
+
+        # A window that started already starts now.
+        timestamp = self.campaign.publish_date + datetime.timedelta(hours=2)
+        schedule = WindowSchedule(self.campaign, {None: 2}, timestamp)
+        self.assertEqual(schedule.next(), timestamp)
+
+    def test_local_time(self):
+        self.campaign.local_time = True
+        self.campaign.publish_date = now() + datetime.timedelta(days=1)
+        zones = ('Europe/Dublin', 'America/New_York')
+        schedule = WindowSchedule(self.campaign, {zone: 1 for zone in zones})
+
+        for zone in zones:
+            time_zone = zoneinfo.ZoneInfo(zone)
+            self.assertEqual(
+                localtime(schedule.next(zone), time_zone).time(),
+                localtime(self.campaign.publish_date).time()
+            )
+
+    def test_track(self):
+        window = SendWindow(self.campaign)
+        timestamp = now()
+        recipients = [
+            SimpleNamespace(scheduled=None),
+            SimpleNamespace(scheduled=timestamp - datetime.timedelta(hours=1)),
+            SimpleNamespace(scheduled=timestamp + datetime.timedelta(hours=1)),
+            SimpleNamespace(scheduled=None),
+        ]
+        # Sending stops at the first recipient that is not due yet.
+        self.assertEqual(list(window.track(iter(recipients))), recipients[:2])
+        self.assertEqual(window.count, 2)
+        self.assertGreaterEqual(window.lag, 3600)
+        self.assertFalse(window.on_schedule)
+
+    def test_failed_not_resent(self):
+        failing = 'test0@example.com'
+        send_messages = EmailBackend.send_messages
+
+        def fail_once(backend, messages):
+            if any(failing in message.to[0] for message in messages):
+                raise ConnectionRefusedError('Test failure')
+            return send_messages(backend, messages)
+
+        with mock.patch.object(EmailBackend, 'send_messages', fail_once):
+            self.campaign.submit()
+        failed = self.campaign.deliveries.get(profile__email=failing)
+        self.assertEqual(failed.status, Delivery.FAILED)
+        self.assertIsNotNone(failed.next_attempt)
+
+        # The next pass leaves the failed delivery to the retry worker.
+        self.make_due()
+        self.campaign.refresh_from_db()
+        self.campaign.submit()
+
+        recipients = [message.to[0] for message in mail.outbox]
+        self.assertEqual(len(recipients), 4)
+        self.assertFalse(any(failing in to for to in recipients))
+        failed.refresh_from_db()
+        self.assertEqual(failed.status, Delivery.FAILED)
+        self.assertEqual(failed.attempts, 1)
+
+
+class ShardMetricsTestCase(TestCase):
+    """ Adding up the delivery metrics of the shards of a campaign. """
+
+    def shard(self, sent, render):
+        shard_metrics = CampaignMetrics()
+        for i in range(sent):
+            shard_metrics.on_rendered(render)
+        shard_metrics.on_sent([Profile(pk=i) for i in range(sent)])
+        # As sent back from a worker process.
+        return pickle.loads(pickle.dumps(shard_metrics))
+
+    def test_merge(self):
+        metrics = DeliveryMetrics()
+        metrics.merge('c', self.shard(3, .001))
+        metrics.merge('c', self.shard(2, .003))
+
+        merged = metrics.campaigns['c']
+        self.assertEqual(merged.rendered, 5)
+        self.assertEqual(merged.sent, 5)
+        self.assertEqual(merged.render_seconds.count, 5)
+        self.assertAlmostEqual(merged.render_seconds.mean, .0018)
+        self.assertIn('djangrid_messages_sent_total{campaign="c"} 5',
+                      metrics.export())
+
+
+class SimpleTemplateTestCase(TestCase):
+    """ Rendering plain templates without the template engine. """
+
+    def compile(self, source, engine=None):
+        if engine is None:
+            template = engines['django'].from_string(source)
+        else:
+            template = engine.from_string(source)
+        return template, SimpleTemplate.compile(template)
+
+    def assertSameRender(self, source, context, engine=None):
+        template, simple = self.compile(source, engine)
+        self.assertIsNotNone(simple)
+        if engine is None:
+            expected = template.render(context)
+        else:
+            expected = template.render(
+                Context(context, autoescape=engine.autoescape)
+            )
+        self.assertEqual(simple.render(context), expected)
+        return expected
+
+    def test_escaping(self):
+        output = self.assertSameRender(
+            '<p>Hello {{ first_name }} &amp; co</p>',
+            {'first_name': 'Ann <b>"O\'Neil" & co</b>'}
+        )
+        self.assertIn('&lt;b&gt;', output)
+        self.assertSameRender('{{ html }}', {'html': mark_safe('<b>hi</b>')})
+
+    def test_autoescape_off(self):
+        engine = Engine(autoescape=False)
+        output = self.assertSameRender(
+            '{{ name }}', {'name': '<b>'}, engine=engine
+        )
+        self.assertEqual(output, '<b>')
+
+    def test_values(self):
+        self.assertSameRender(
+            '{{ number }} {{ price }} {{ date }} {{ none }} {{ flag }}', {
+                'number': 1234, 'price': 12.5, 'none': None, 'flag': True,
+                'date': datetime.date(2022, 3, 1),
+            }
+        )
+
+    def test_missing(self):
+        output = self.assertSameRender('Hi {{ first_name }}!', {})
+        self.assertEqual(output, 'Hi !')
+
+    def test_fallback(self):
+        for source in ('{{ name|upper }}', '{% if name %}x{% endif %}',
+                       '{{ user.name }}', '{{ _("Hello") }}',
+                       '{% comment %}x{% endcomment %}'):
+            self.assertIsNone(self.compile(source)[1], source)
+        engine = Engine(string_if_invalid='INVALID')
+        self.assertIsNone(self.compile('{{ name }}', engine)[1])
+
+
+class TokenTestCase(TestCase):
+    """ Signed tokens in confirm and unsubscribe links. """
+
+    def setUp(self):
+        self.profile = Profile.objects.create(
+            email='test@example.com', conf_num='secret'
+        )
+
+    def visit(self, view, **params):
+        response = self.client.get(reverse(view), params)
+        self.assertEqual(response.status_code, 200)
+        self.profile.refresh_from_db()
+        return response.context['action']
+
+    def test_round_trip(self):
+        for action in TOKEN_ACTIONS:
+            token = make_token(self.profile.pk, action)
+            self.assertEqual(check_token(token, action), self.profile.pk)
+        # Each action is signed with its own salt.
+        token = make_token(self.profile.pk, 'confirm')
+        self.assertIsNone(check_token(token, 'unsubscribe'))
+
+    def test_tampered(self):
+        other = Profile.objects.create(email='other@example.com')
+        token = make_token(self.profile.pk, 'unsubscribe')
+        signature = token.split(':', 1)[1]
+        forged = signing.b62_encode(other.pk) + ':' + signature
+        self.assertIsNone(check_token(forged, 'unsubscribe'))
+        self.assertIsNone(check_token(token[:-1], 'unsubscribe'))
+
+        self.assertEqual(self.visit('delete', token=forged), 'denied')
+        other.refresh_from_db()
+        self.assertFalse(other.unsubscribed)
+
+    def test_confirm(self):
+        token = make_token(self.profile.pk, 'confirm')
+        self.assertEqual(self.visit('confirm', token=token), 'confirmed')
+        self.assertTrue(self.profile.confirmed)
+
+    def test_confirm_expired(self):
+        max_age = newsletter_settings.CONFIRM_TOKEN_MAX_AGE
+        with mock.patch('time.time', return_value=time.time() - max_age - 1):
+            token = make_token(self.profile.pk, 'confirm')
+        self.assertIsNone(check_token(token, 'confirm'))
+        self.assertEqual(self.visit('confirm', token=token), 'denied')
+        self.assertFalse(self.profile.confirmed)
+
+    def test_unsubscribe(self):
+        # Unsubscribe links do not expire.
+        with mock.patch('time.time', return_value=time.time() - 10 ** 8):
+            token = make_token(self.profile.pk, 'unsubscribe')
+        self.assertEqual(self.visit('delete', token=token), 'unsubscribed')
+        self.assertTrue(self.profile.unsubscribed)
+        self.assertIsNotNone(self.profile.unsubscribe_date)
+
+    def test_legacy_links(self):
+        self.assertEqual(
+            self.visit('confirm', email=self.profile.email, conf_num='wrong'),
+            'denied'
+        )
+        self.assertFalse(self.profile.confirmed)
+        self.assertEqual(
+            self.visit('confirm', email=self.profile.email,
+                       conf_num='secret'),
+            'confirmed'
+        )
+        self.assertTrue(self.profile.confirmed)
+        self.assertEqual(
+            self.visit('delete', email=self.profile.email, conf_num='secret'),
+            'unsubscribed'
+        )
+        self.assertTrue(self.profile.unsubscribed)
+
+
+@override_settings(NEWSLETTER_SEND_WORKERS=1, NEWSLETTER_SEND_RATE=None)
+class FairSchedulerTestCase(CampaignMixin, TestCase):
+    """ Interleaving the messages of several campaigns by priority. """
+    profile_count = 6
+
+    def add_campaign(self, slug, recipients, priority=1):
+        segment = Segment.objects.create(segment_name=slug)
+        segment.profiles.set(
+            Profile.objects.filter(unsubscribed=False)[:recipients]
+        )
+        campaign = Campaign.objects.create(
+            emailmsg=self.newsletter, slug=slug, title=slug,
+            priority=priority, publish_date=self.campaign.publish_date
+        )
+        campaign.segments.add(segment)
+        return campaign
+
+    def run_scheduler(self, campaigns):
+        """ Submit `campaigns` together; returns the slugs sent, in order. """
+        order = []
+
+        def record(sender, recipient, **kwargs):
+            order.append(sender.slug)
+
+        message_queued.connect(record, dispatch_uid='test-order')
+        try:
+            FairScheduler(campaigns, 'backend').run()
+        finally:
+            message_queued.disconnect(dispatch_uid='test-order')
+        return order
+
+    def test_weighted(self):
+        low = self.add_campaign('low', 6)
+        high = self.add_campaign('high', 6, priority=2)
+
+        order = self.run_scheduler([low, high])
+
+        # Twice as many messages for the campaign with twice the priority,
+        # for as long as both have recipients left.
+        self.assertEqual(order[:9], ['low', 'high', 'high'] * 3)
+        self.assertEqual(order[9:], ['low'] * 3)
+        self.assertEqual(len(mail.outbox), 12)
+        for campaign in (low, high):
+            campaign.refresh_from_db()
+            self.assertTrue(campaign.sent)
+
+    def test_no_starvation(self):
+        large = self.add_campaign('large', 6, priority=3)
+        small = self.add_campaign('small', 2)
+
+        order = self.run_scheduler([large, small])
+
+        # The small campaign is done within two rounds instead of waiting
+        # for the large one, even with a lower priority.
+        self.assertEqual(
+            order, ['large', 'small'] + ['large'] * 3 + ['small'] +
+            ['large'] * 2
+        )
+
+
+@override_settings(NEWSLETTER_SEND_WORKERS=1, NEWSLETTER_SEND_RATE=None)
+class LeaseTestCase(CampaignMixin, TestCase):
+    """ Claiming campaigns and taking over those of stalled workers. """
+
+    def setUp(self):
+        super().setUp()
+        self.campaign.prepared = True
+        self.campaign.save()
+
+    def get_campaign(self):
+        return Campaign.objects.get(pk=self.campaign.pk)
+
+    def expire_lease(self):
+        Campaign.objects.filter(pk=self.campaign.pk).update(
+            lease_expires=now() - datetime.timedelta(seconds=1)
+        )
+
+    def test_claim(self):
+        self.assertTrue(self.get_campaign().claim('worker-a'))
+        # Claimed campaigns are not queued while the lease holds.
+        self.assertFalse(self.get_campaign().claim('worker-b'))
+        self.assertEqual(Campaign.claim_queue('worker-b'), [])
+
+        campaign = self.get_campaign()
+        self.assertTrue(campaign.sending)
+        self.assertEqual(campaign.claimed_by, 'worker-a')
+        self.assertGreater(campaign.lease_expires, now())
+
+    def test_renew(self):
+        campaign = self.get_campaign()
+        campaign.claim('worker-a')
+        self.expire_lease()
+
+        leases = LeaseKeeper([campaign], 'worker-a')
+        self.assertEqual(leases.renew(), 1)
+        self.assertGreater(self.get_campaign().lease_expires, now())
+        self.assertFalse(self.get_campaign().claim('worker-b'))
+
+    def test_takeover(self):
+        stalled = self.get_campaign()
+        stalled.claim('worker-a')
+        self.expire_lease()
+
+        taken = self.get_campaign()
+        self.assertTrue(taken.claim('worker-b'))
+        self.assertEqual(self.get_campaign().claimed_by, 'worker-b')
+
+        # The stalled worker finds out at its next heartbeat.
+        leases = LeaseKeeper([stalled], 'worker-a')
+        self.assertEqual(leases.renew(), 0)
+        self.assertTrue(leases.is_lost(stalled))
+
+        # Its submission ending does not release the other's claim.
+        stalled.finish_submission()
+        campaign = self.get_campaign()
+        self.assertTrue(campaign.sending)
+        self.assertEqual(campaign.claimed_by, 'worker-b')
+
+    def test_release(self):
+        campaign = self.get_campaign()
+        campaign.claim('worker-a')
+        leases = LeaseKeeper([campaign], 'worker-a')
+        campaign.finish_submission()
+
+        self.assertEqual(leases.renew(), 0)
+        self.assertFalse(leases.is_lost(campaign))
+        self.assertEqual(self.get_campaign().claimed_by, '')
+
+    def test_lost_lease_stops_sending(self):
+        campaign = self.get_campaign()
+        campaign.claim('worker-a')
+        leases = LeaseKeeper([campaign], 'worker-a')
+
+        def take_over(sender, recipient, **kwargs):
+            self.expire_lease()
+            self.get_campaign().claim('worker-b')
+            leases.renew()
+
+        message_queued.connect(take_over, dispatch_uid='test-take-over')
+        try:
+            FairScheduler([campaign], 'backend', leases=leases).run()
+        finally:
+            message_queued.disconnect(dispatch_uid='test-take-over')
+
+        self.assertEqual(len(mail.outbox), 1)
+        campaign = self.get_campaign()
+        self.assertFalse(campaign.sent)
+        self.assertEqual(campaign.claimed_by, 'worker-b')
+
+
+class SkeletonMessageTestCase(TestCase):
+    """ Messages built around a MessageSkeleton, compared with Django's. """
+
+    subject = 'Nouvelles de l’été'
+    from_email = 'Zoë Newsletter <news@example.com>'
+
+    def setUp(self):
+        self.skeleton = MessageSkeleton(self.subject, self.from_email)
+
+    def make_messages(self, body='Hello Ann', **kwargs):
+        """ The same message as a SkeletonMessage and as Django makes it. """
+        options = dict(
+            subject=self.subject, body=body, from_email=self.from_email,
+            to=['Ann Lée <ann@example.com>'], headers={
+                'Date': 'Tue, 01 Mar 2022 10:00:00 -0000',
+                'Message-ID': '<test@example.com>',
+                'List-Unsubscribe': '<https://example.com/unsubscribe>',
+            }
+        )
+        options.update(kwargs)
+        messages = []
+        for message in (SkeletonMessage(skeleton=self.skeleton, **options),
+                        EmailMultiAlternatives(**options)):
+            message.attach_alternative('<p>%s</p>' % body, 'text/html')
+            message.attach('data.txt', 'attached data', 'text/plain')
+            messages.append(message.message())
+        return messages
+
+    def normalize(self, msg):
+        """ The message as bytes, with its boundaries numbered in order. """
+        data = msg.as_bytes()
+        boundaries = re.findall(rb'boundary="([^"]+)"', data)
+        for index, boundary in enumerate(boundaries):
+            data = data.replace(boundary, b'boundary-%d' % index)
+        return data
+
+    def test_same_message(self):
+        skeleton_msg, django_msg = self.make_messages()
+        self.assertEqual(
+            self.normalize(skeleton_msg), self.normalize(django_msg)
+        )
+        self.assertEqual(
+            [part.get_boundary() for part in skeleton_msg.walk()
+             if part.is_multipart()],
+            self.skeleton.boundaries
+        )
+
+    def test_boundary_in_body(self):
+        # The generator picks boundaries that do not occur in the parts.
+        body = 'Hello %s' % self.skeleton.boundaries[0]
+        skeleton_msg, django_msg = self.make_messages(body=body)
+        self.assertEqual(
+            self.normalize(skeleton_msg), self.normalize(django_msg)
+        )
+        self.assertNotIn(
+            self.skeleton.boundaries[0].encode(),
+            re.findall(rb'boundary="([^"]+)"', skeleton_msg.as_bytes())
+        )
+
+    def test_fallback(self):
+        skeleton_msg, django_msg = self.make_messages(
+            subject='Another subject', reply_to=['reply@example.com']
+        )
+        self.assertEqual(
+            self.normalize(skeleton_msg), self.normalize(django_msg)
+        )
+
+
+class AddRecipientsTestCase(CampaignMixin, TestCase):
+    """ Adding recipients with a single INSERT ... SELECT. """
+
+    def test_idempotent(self):
+        profiles = Profile.objects.all()
+        self.assertEqual(self.campaign.add_recipients(profiles), 6)
+        self.assertEqual(self.campaign.add_recipients(profiles), 0)
+        self.assertEqual(self.campaign.recipients.count(), 6)
+
+    def test_partial(self):
+        some = Profile.objects.filter(email__in=(
+            'test0@example.com', 'test1@example.com'
+        ))
+        self.assertEqual(self.campaign.add_recipients(some), 2)
+        self.assertEqual(
+            self.campaign.add_recipients(Profile.objects.all()), 4
+        )
+        self.assertEqual(
+            set(self.campaign.recipients.values_list('email', flat=True)),
+            set(Profile.objects.values_list('email', flat=True))
+        )
+
+    def test_overlapping_segments(self):
+        segment = Segment.objects.create(segment_name='Another segment')
+        segment.profiles.set(Profile.objects.all())
+        self.campaign.segments.add(segment)
+        self.campaign.all_profiles = True
+
+        # Profiles in both segments and in all profiles are added once, and
+        # resubmitting adds nobody twice.
+        for i in range(2):
+            self.campaign.get_recipients()
+            self.assertEqual(self.campaign.recipients.count(), 6)
@@ -0,0 +1,41 @@
+""" Signed tokens identifying a profile in subscription links. """
+
+from django.core import signing
+
+from .settings import newsletter_settings
+
+# Actions a token can be made for; each is signed with its own salt, so a
+# confirmation token cannot be used to unsubscribe and vice versa.
+TOKEN_ACTIONS = ('confirm', 'unsubscribe')
+
+
+def get_signer(action):
+    assert action in TOKEN_ACTIONS, 'Unknown token action: %s' % action
+    return signing.TimestampSigner(salt='djangridApp.tokens.%s' % action)
+
+
+def get_max_age(action):
+    """ Seconds a token for `action` is valid for, or None for no limit. """
+    if action == 'confirm':
+        return newsletter_settings.CONFIRM_TOKEN_MAX_AGE
+    return newsletter_settings.UNSUBSCRIBE_TOKEN_MAX_AGE
+
+
+def make_token(profile_id, action):
+    """
+    Return a token for `action` on the profile with the given id. Making
+    one takes no database access, so it is cheap to do per recipient.
+    """
+    return get_signer(action).sign(signing.b62_encode(profile_id))
+
+
+def check_token(token, action):
+    """
+    Return the id of the profile a token was made for, or None when the
+    token is invalid or has expired.
+    """
+    try:
+        value = get_signer(action).unsign(token, max_age=get_max_age(action))
+    except signing.BadSignature:
+        return None
+    return signing.b62_decode(value)
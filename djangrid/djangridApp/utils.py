@@ -1,5 +1,6 @@
 """ Generic helper functions """
 
+import itertools
 import logging
 
 
@@ -19,6 +20,16 @@ def make_activation_code():
     return get_random_string(length=40)
 
 
+def chunked(iterable, size):
+    """ Yield lists of up to `size` items from `iterable`. """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
 def get_default_sites():
     """ Get a list of id's for all sites; the default for newsletters. """
     return [site.id for site in Site.objects.all()]
@@ -8,6 +8,7 @@ import random
 from sendgrid import SendGridAPIClient
 from sendgrid.helpers.mail import Mail
 from django.utils.timezone import now
+from .tokens import check_token, make_token
 from .utils import make_activation_code
 
 # def random_digits():
@@ -22,8 +23,8 @@ def subscribe(request):
                 sub.unsubscribed = False
                 sub.conf_num = make_activation_code()
                 sub.save()
-                message = send_conf_email(request, sub.email, sub.conf_num)
-                message = send_conf_email(request, sub.email, sub.conf_num)
+                message = send_conf_email(request, sub)
+                message = send_conf_email(request, sub)
                 sg = SendGridAPIClient(settings.SENDGRID_API_KEY)
                 response = sg.send(message)
                 return render(request, 'index.html', {'email': sub.email, 'action': 'added', 'form': ProfileForm()})
@@ -31,7 +32,7 @@ def subscribe(request):
             sub = Profile(email=request.POST['email'], conf_num=make_activation_code())
             sub.save()
 
-            message = send_conf_email(request, sub.email, sub.conf_num)
+            message = send_conf_email(request, sub)
             sg = SendGridAPIClient(settings.SENDGRID_API_KEY)
             response = sg.send(message)
 
@@ -39,35 +40,52 @@ def subscribe(request):
     else:
         return render(request, 'index.html', {'form': ProfileForm()})
 
-def send_conf_email(request, email, conf_num):
+def send_conf_email(request, sub):
     message = Mail(
                 from_email=settings.MAIL_FROM,
-                to_emails=email,
+                to_emails=sub.email,
                 subject='Newsletter Confirmation',
                 html_content='Thank you for signing up to our newsletter! \
                     Please complete the process by \
-                    <a href="{}?email={}&conf_num={}"> clicking here to \
+                    <a href="{}?token={}"> clicking here to \
                     confirm your registration</a>.'.format((request.build_absolute_uri('/newsletter/confirm/').replace('/subscribe', '')),  # request.build_absolute_uri('/confirm/')
-                                                        email,
-                                                        conf_num))
+                                                        make_token(sub.pk, 'confirm')))
     return message
 
-def confirm(request):
+def get_link_profile(request, action):
+    """
+    Return the profile a confirm or unsubscribe link is for, and whether
+    the link is valid. Links carry a signed token with the profile id;
+    links sent before tokens were introduced carry the e-mail address and
+    activation code instead.
+    """
+    if 'token' in request.GET:
+        profile_id = check_token(request.GET['token'], action)
+        if profile_id is None:
+            return None, False
+        sub = Profile.objects.filter(pk=profile_id).first()
+        return sub, sub is not None
+
     sub = Profile.objects.get(email=request.GET['email'])
-    if sub.conf_num == request.GET['conf_num']:
+    return sub, sub.conf_num == request.GET['conf_num']
+
+def confirm(request):
+    sub, valid = get_link_profile(request, 'confirm')
+    if valid:
         sub.confirmed = True
         sub.save()
         return render(request, 'index.html', {'email': sub.email, 'action': 'confirmed'})
     else:
-        return render(request, 'index.html', {'email': sub.email, 'action': 'denied'})
+        return render(request, 'index.html', {'email': sub and sub.email, 'action': 'denied'})
 
 
 def delete(request):
-    sub = Profile.objects.get(email=request.GET['email'])
-    if sub.conf_num == request.GET['conf_num']:
+    sub, valid = get_link_profile(request, 'unsubscribe')
+    if valid:
         # sub.delete()
         sub.unsubscribed = True
-        sub.unsubscribe_date = now
+        sub.unsubscribe_date = now()
+        sub.save()
         return render(request, 'index.html', {'email': sub.email, 'action': 'unsubscribed'})
     else:
-        return render(request, 'index.html', {'email': sub.email, 'action': 'denied'})
\ No newline at end of file
+        return render(request, 'index.html', {'email': sub and sub.email, 'action': 'denied'})
\ No newline at end of file
@@ -0,0 +1,111 @@
+""" Task workers running the background jobs queued in the task table. """
+
+import logging
+import threading
+
+from django.db import close_old_connections, connection, connections
+from django.utils.translation import gettext
+
+from .delivery.lease import get_worker_id
+from .delivery.sharding import bootstrap, get_database_names, get_mp_context
+from .metrics import metrics
+from .settings import newsletter_settings
+from .tasks import run_task
+
+logger = logging.getLogger(__name__)
+
+
+class TaskWorker(object):
+    """
+    Runs due tasks on `threads` threads, each claiming one task at a time.
+    Idle threads look for due tasks every `poll_interval` seconds. `stop`
+    may be an event shared with other processes, see `run_workers()`.
+    """
+
+    def __init__(self, threads=None, poll_interval=None, stop=None):
+        if threads is None:
+            threads = newsletter_settings.WORKER_THREADS
+        if poll_interval is None:
+            poll_interval = newsletter_settings.TASK_POLL_INTERVAL
+
+        self.threads = threads
+        self.poll_interval = poll_interval
+        self._stop = stop if stop is not None else threading.Event()
+
+    def stop(self):
+        """ Stop after the tasks in progress; safe from signal handlers. """
+        self._stop.set()
+
+    def run_next(self, owner):
+        """ Claim and run one due task; returns whether there was one. """
+        from .models import Task
+
+        task = Task.claim_next(owner)
+        if task is None:
+            return False
+        run_task(task)
+        return True
+
+    def _loop(self):
+        owner = get_worker_id()
+        try:
+            while not self._stop.is_set():
+                # Long-running: do not hold on to broken or expired connections.
+                close_old_connections()
+                try:
+                    if self.run_next(owner):
+                        continue
+                except Exception:
+                    logger.exception(gettext('Error claiming a task.'))
+                self._stop.wait(self.poll_interval)
+        finally:
+            # Each thread has its own database connection.
+            connection.close()
+
+    def run(self):
+        logger.info(
+            gettext('Task worker started with %d threads.'), self.threads
+        )
+        threads = [
+            threading.Thread(target=self._loop, name='task-worker-%d' % i)
+            for i in range(self.threads)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        logger.info(gettext('Task worker stopped.'))
+
+
+def run_worker_process(threads, poll_interval, stop):
+    """ Worker process target, see `start_workers()`. """
+    if newsletter_settings.METRICS:
+        # Each process collects its own metrics.
+        metrics.connect()
+    TaskWorker(threads, poll_interval, stop).run()
+
+
+def start_workers(processes, threads=None, poll_interval=None):
+    """
+    Start `processes` worker processes with `threads` threads each. Returns
+    a (stop, processes) tuple; setting the `stop` event makes them exit
+    after the tasks in progress.
+    """
+    context = get_mp_context()
+    stop = context.Event()
+    # Close the connections used so far before starting the workers.
+    connections.close_all()
+    databases = get_database_names()
+
+    workers = [
+        context.Process(
+            target=bootstrap,
+            args=(__name__ + '.run_worker_process', databases, threads,
+                  poll_interval, stop),
+            name='task-worker-%d' % i
+        )
+        for i in range(processes)
+    ]
+    for worker in workers:
+        worker.start()
+    return stop, workers